@@ -16,6 +16,10 @@ setuptools.setup(name='slidecrop_pyqt',
         'scipy',
         'matplotlib',        
         'scikit-image',
-        'tifffile'
+        'tifffile>=2022.2.2',
+        'imagecodecs>=2022.2.22'
       ],      
+      entry_points={
+        'console_scripts': ['slidecrop=slidecrop.cli:main']
+      },
       zip_safe=False)
\ No newline at end of file
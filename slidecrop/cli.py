@@ -0,0 +1,513 @@
+"""
+Command line interface for cropping batches of slides without
+the GUI - nothing here imports PyQt so it can run on cluster
+nodes without a display, e.g.
+
+    slidecrop crop /data/slides --workers 16 --report run.json
+    slidecrop crop manifest.json --method yen --channel 1
+
+or in two steps, planning where the slides can be looked at and
+cropping on a machine with the I/O for it:
+
+    slidecrop plan /data/slides --threshold 200 --plan plan.json
+    slidecrop run plan.json --workers 16 --report run.json
+
+and on a cluster each array job takes a share of the plan, balanced
+by the area of the sections, and the shard manifests are merged:
+
+    slidecrop run plan.json --shard $SLURM_ARRAY_TASK_ID/8
+    slidecrop merge plan_shard_*_of_8_report.json --report run.json
+
+A manifest is a JSON list of slides (or {"slides": [...]}) each
+either a path or a dict with "path" and optionally "channel",
+"threshold" (manual), "method" (auto) and "output". Relative
+paths are taken from the folder of the manifest.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+
+from .ims.slide import SlideImage
+from .processing.batch import BatchCrop, scan_slides
+from .processing.threshold import METHODS
+from .processing.plan import CropPlan, plan_slide
+from .processing.shard import merge_manifests, plan_digest, shard_plan
+
+
+def _manifest_slides(path):
+    """
+    Read the slides listed in a manifest
+
+    :returns list of dicts
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('slides', [])
+    base = os.path.dirname(os.path.abspath(path))
+    slides = []
+    for entry in manifest:
+        if not isinstance(entry, dict):
+            entry = {'path': entry}
+        entry = dict(entry)
+        entry['path'] = os.path.join(base, entry['path'])
+        if entry.get('output'):
+            entry['output'] = os.path.join(base, entry['output'])
+        slides.append(entry)
+    return slides
+
+
+def collect_slides(inputs):
+    """
+    Slides named on the command line - folders are searched for
+    *.ims files and *.json files are read as manifests
+
+    :param inputs: folders, manifests and slides
+    :type inputs: list
+    :returns list of dicts holding at least the path of each slide
+    """
+    slides = []
+    for item in inputs:
+        if os.path.isdir(item):
+            slides.extend(
+                {'path': os.path.join(item, filename)}
+                for filename in sorted(os.listdir(item))
+                if filename.endswith('.ims')
+            )
+        elif item.endswith('.json'):
+            slides.extend(_manifest_slides(item))
+        else:
+            slides.append({'path': item})
+    return slides
+
+
+def _settings(slides, args):
+    """
+    Fill in the channel, output and threshold (or threshold
+    method) of each slide from the command line defaults
+    """
+    for slide in slides:
+        slide.setdefault('channel', args.channel)
+        if not slide.get('output'):
+            slide['output'] = args.output or os.path.dirname(slide['path'])
+        if slide.get('threshold') is None:
+            if args.threshold is not None and not slide.get('method'):
+                slide['threshold'] = args.threshold
+            else:
+                slide.setdefault('method', args.method)
+                slide['method'] = slide['method'].lower()
+    return slides
+
+
+def _check_slides(slides):
+    """
+    Open each slide (only its index is read) so that missing or
+    broken slides are reported rather than stopping the run
+
+    :returns list of (slide, error) for slides that cannot be read
+    """
+    failures = []
+    for slide in slides:
+        try:
+            with SlideImage(slide['path']) as image:
+                if not 0 <= slide['channel'] < image.size_c:
+                    raise ValueError(
+                        'channel {} not in slide with {} channels'.
+                        format(slide['channel'], image.size_c)
+                    )
+        except Exception as e:
+            failures.append((slide, '{}: {}'.format(type(e).__name__, e)))
+    return failures
+
+
+def _auto_thresholds(slides, workers):
+    """
+    Threshold the slides that have a method rather than a value,
+    one pool per method
+
+    :returns list of (slide, error) for slides that could not be
+    thresholded
+    """
+    failures = []
+    methods = sorted(set(s['method'] for s in slides if s.get('threshold') is None))
+    for method in methods:
+        todo = [s for s in slides if s.get('threshold') is None and s['method'] == method]
+        errors = {}
+        _, thresholds = scan_slides(
+            [s['path'] for s in todo], method, workers,
+            error=lambda sid, e: errors.update({sid: e})
+        )
+        for sid, (slide, thresh) in enumerate(zip(todo, thresholds)):
+            if thresh is None:
+                failures.append((slide, errors.get(sid, 'could not threshold')))
+            else:
+                slide['threshold'] = float(thresh[slide['channel']])
+    return failures
+
+
+def _usable(slides, workers):
+    """
+    Check the slides and find their auto thresholds
+
+    :returns list of slides that can be cropped and list of
+    (slide, error) for those that cannot
+    """
+    bad = _check_slides(slides)
+    broken = set(id(slide) for slide, _ in bad)
+    slides = [s for s in slides if id(s) not in broken]
+    bad.extend(_auto_thresholds(slides, workers))
+    broken = set(id(slide) for slide, _ in bad)
+    return [s for s in slides if id(s) not in broken], bad
+
+
+def _jsonable(value):
+    """
+    Numpy numbers in the records as plain Python numbers
+    """
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def _write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(_jsonable(report), f, indent=2)
+
+
+def crop(args):
+    """
+    Crop every slide and write the JSON report
+
+    :returns exit status - 1 if any slide failed
+    """
+    started = datetime.datetime.now()
+    tic = time.time()
+    slides = _settings(collect_slides(args.inputs), args)
+    if not slides:
+        print('No slides found in {}'.format(args.inputs))
+        return 1
+
+    slides, bad = _usable(slides, args.workers)
+
+    budget = None
+    if args.memory_budget is not None:
+        budget = int(args.memory_budget * 2**20)
+    batch = BatchCrop(workers=args.workers, memory_budget=budget)
+
+    def progress(sid, rid):
+        print('{} section {} done'.format(
+            os.path.basename(slides[sid]['path']), rid
+        ))
+
+    for slide in slides:
+        os.makedirs(slide['output'], exist_ok=True)
+    failures = []
+    if slides:
+        failures = batch.run(
+            [s['path'] for s in slides],
+            [s['output'] for s in slides],
+            [s['channel'] for s in slides],
+            [s['threshold'] for s in slides],
+            progress=progress
+        )
+
+    records = []
+    for sid, slide in enumerate(slides):
+        record = dict(batch.records.get(sid, {}))
+        record['method'] = slide.get('method')
+        records.append(record)
+    for slide, error in bad:
+        records.append({
+            'path': slide['path'], 'output': slide['output'],
+            'channel': slide['channel'], 'status': 'failed',
+            'error': error, 'regions': []
+        })
+
+    report = {
+        'started': started.isoformat(),
+        'seconds': time.time() - tic,
+        'workers': batch.workers,
+        'memory_budget': batch.memory_budget,
+        'slides': records,
+        'failures': len(failures) + len(bad),
+        'regions': sum(len(r['regions']) for r in records),
+        'bytes_read': sum(
+            r.get('segment_bytes_read', 0) + r.get('bytes_read', 0)
+            for r in records
+        ),
+        'bytes_written': sum(r.get('bytes_written', 0) for r in records)
+    }
+    report_path = args.report
+    if report_path is None:
+        report_path = os.path.join(args.output or os.getcwd(), 'slidecrop_report.json')
+    _write_report(report, report_path)
+
+    print('{} slides, {} sections, {} failed in {:.1f} s - report in {}'.format(
+        len(records), report['regions'], report['failures'],
+        report['seconds'], report_path
+    ))
+    return 1 if report['failures'] else 0
+
+
+def plan(args):
+    """
+    Segment every slide and write the crop plan - nothing is
+    cropped
+
+    :returns exit status - 1 if any slide could not be planned
+    """
+    slides = _settings(collect_slides(args.inputs), args)
+    if not slides:
+        print('No slides found in {}'.format(args.inputs))
+        return 1
+
+    slides, bad = _usable(slides, args.workers)
+
+    crop_plan = CropPlan()
+    for slide in slides:
+        try:
+            with SlideImage(slide['path']) as image:
+                # auto thresholds have already been found from the
+                # slide histograms - segment with the value but keep
+                # the method in the plan
+                entry = plan_slide(
+                    image, slide['output'], crop_level=args.crop_level,
+                    seg_channel=slide['channel'], seg_level=args.seg_level,
+                    threshold=slide['threshold'], refine=args.refine
+                )
+                entry['method'] = slide.get('method') or 'manual'
+                crop_plan.add(entry)
+        except Exception as e:
+            bad.append((slide, '{}: {}'.format(type(e).__name__, e)))
+    for slide, error in bad:
+        print('Could not plan {} - {}'.format(slide['path'], error))
+
+    crop_plan.save(args.plan)
+    print('{} slides, {} sections, {:.1f} MB planned in {}'.format(
+        len(crop_plan), crop_plan.region_count,
+        crop_plan.nbytes / 2.0**20, args.plan
+    ))
+    return 1 if bad else 0
+
+
+def _shard(text):
+    """
+    Parse a shard given as index/count, e.g. 3/8
+    """
+    try:
+        index, count = [int(v) for v in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'shard must be index/count, e.g. 0/4 - got {}'.format(text)
+        )
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            'shard index must be from 0 to {}'.format(count - 1)
+        )
+    return index, count
+
+
+def run(args):
+    """
+    Crop the slides of a plan, or of one shard of it, and write
+    the JSON report
+
+    :returns exit status - 1 if any slide failed
+    """
+    started = datetime.datetime.now()
+    tic = time.time()
+    crop_plan = CropPlan.load(args.plan)
+    budget = None
+    if args.memory_budget is not None:
+        budget = int(args.memory_budget * 2**20)
+    batch = BatchCrop(workers=args.workers, memory_budget=budget)
+    report = {'started': started.isoformat()}
+    if args.shard is not None:
+        index, count = args.shard
+        report.update(
+            plan_digest=plan_digest(crop_plan), shard=index, shards=count
+        )
+        crop_plan, report['cost'] = shard_plan(crop_plan, index, count)
+
+    def progress(sid, rid):
+        print('{} section {} done'.format(
+            os.path.basename(crop_plan.slides[sid]['path']), rid
+        ))
+
+    batch.run_plan(crop_plan, progress=progress)
+    records = [batch.records[sid] for sid in range(len(crop_plan))]
+    report.update({
+        'seconds': time.time() - tic,
+        'workers': batch.workers,
+        'memory_budget': batch.memory_budget,
+        'plan': os.path.abspath(args.plan),
+        'slides': records,
+        'failures': sum(r['status'] != 'done' for r in records),
+        'regions': sum(len(r['regions']) for r in records),
+        'bytes_planned': crop_plan.nbytes,
+        'bytes_read': sum(r.get('bytes_read', 0) for r in records),
+        'bytes_written': sum(r.get('bytes_written', 0) for r in records)
+    })
+    report_path = args.report
+    if report_path is None:
+        report_path = os.path.splitext(args.plan)[0]
+        if args.shard is not None:
+            report_path += '_shard_{}_of_{}'.format(*args.shard)
+        report_path += '_report.json'
+    _write_report(report, report_path)
+
+    print('{} slides, {} sections, {} failed in {:.1f} s - report in {}'.format(
+        len(records), report['regions'], report['failures'],
+        report['seconds'], report_path
+    ))
+    return 1 if report['failures'] else 0
+
+
+def merge(args):
+    """
+    Combine the manifests of every shard of a plan into one report
+
+    :returns exit status - 1 if any slide failed
+    """
+    manifests = []
+    for path in args.manifests:
+        with open(path, 'r') as f:
+            manifests.append(json.load(f))
+    report = merge_manifests(manifests)
+    _write_report(report, args.report)
+    print('{} shards, {} slides, {} sections, {} failed - report in {}'.format(
+        report['shards'], len(report['slides']), report['regions'],
+        report['failures'], args.report
+    ))
+    return 1 if report['failures'] else 0
+
+
+def _slide_options(command):
+    """
+    Options choosing the slides and how they are segmented,
+    shared by crop and plan
+    """
+    command.add_argument(
+        'inputs', nargs='+',
+        help='folders of *.ims slides, slides or *.json manifests'
+    )
+    command.add_argument(
+        '-o', '--output',
+        help='output directory - default is the folder of each slide'
+    )
+    command.add_argument(
+        '--workers', type=int, default=None,
+        help='number of worker processes - default is the number of cores'
+    )
+    command.add_argument(
+        '--channel', type=int, default=0,
+        help='channel used for segmentation'
+    )
+    command.add_argument(
+        '--threshold', type=float, default=None,
+        help='manual threshold - default is to use --method'
+    )
+    command.add_argument(
+        '--method', default='otsu', type=str.lower, choices=sorted(METHODS),
+        help='auto threshold method'
+    )
+
+
+def parser():
+    """
+    :returns argparse.ArgumentParser of the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog='slidecrop',
+        description='Segment slide scanner images and crop each section'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    crop_parser = commands.add_parser(
+        'crop', help='crop a batch of slides on a pool of processes'
+    )
+    _slide_options(crop_parser)
+    crop_parser.add_argument(
+        '--memory-budget', type=float, default=None,
+        help='memory cropping may use at once (MB) - default is half the free memory'
+    )
+    crop_parser.add_argument(
+        '--report', default=None,
+        help='path of the JSON report - default is slidecrop_report.json in the output directory'
+    )
+    crop_parser.set_defaults(run=crop)
+
+    plan_parser = commands.add_parser(
+        'plan', help='segment slides and write a crop plan without cropping'
+    )
+    _slide_options(plan_parser)
+    plan_parser.add_argument(
+        '--plan', default='slidecrop_plan.json',
+        help='path of the JSON plan - default is slidecrop_plan.json'
+    )
+    plan_parser.add_argument(
+        '--crop-level', type=int, default=None,
+        help='resolution level cropped - default is full resolution'
+    )
+    plan_parser.add_argument(
+        '--seg-level', type=int, default=None,
+        help='resolution level segmented - default is the lowest resolution'
+    )
+    plan_parser.add_argument(
+        '--refine', action='store_true',
+        help='tighten section borders at the finer levels'
+    )
+    plan_parser.set_defaults(run=plan)
+
+    run_parser = commands.add_parser(
+        'run', help='crop the slides of a plan made by slidecrop plan'
+    )
+    run_parser.add_argument('plan', help='*.json plan')
+    run_parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of worker processes - default is the number of cores'
+    )
+    run_parser.add_argument(
+        '--memory-budget', type=float, default=None,
+        help='memory cropping may use at once (MB) - default is half the free memory'
+    )
+    run_parser.add_argument(
+        '--report', default=None,
+        help='path of the JSON report - default is <plan>_report.json or '
+             '<plan>_shard_<index>_of_<count>_report.json'
+    )
+    run_parser.add_argument(
+        '--shard', type=_shard, default=None,
+        help='crop only shard index/count of the plan, e.g. 0/4'
+    )
+    run_parser.set_defaults(run=run)
+
+    merge_parser = commands.add_parser(
+        'merge', help='combine the reports of every shard of a plan'
+    )
+    merge_parser.add_argument(
+        'manifests', nargs='+', help='*.json reports written by run --shard'
+    )
+    merge_parser.add_argument(
+        '--report', default='slidecrop_report.json',
+        help='path of the merged report - default is slidecrop_report.json'
+    )
+    merge_parser.set_defaults(run=merge)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,9 +20,12 @@ class BatchTable(QtWidgets.QWidget):
         self.table_widget = table_widget
         self.table_widget.setSelectionBehavior(QtWidgets.QTableView.SelectRows)
         self.table_widget.setSelectionMode(QtWidgets.QTableView.SingleSelection)
+        # rows of slides that could not be imported
+        self.failed = set()
 
     def update(self, folder, channels, thresholds):
         self.table_widget.clear()
+        self.failed = set()
         if folder:
             file_count = 0
             for f in os.listdir(folder):
@@ -95,6 +98,35 @@ class BatchTable(QtWidgets.QWidget):
                     
                     rid += 1
 
+    def setRow(self, rid, channels, thresholds):
+        """
+        Fill in the channels and thresholds of a row once
+        its slide has been imported
+        """
+        chan = QtWidgets.QTableWidgetItem('{}'.format(channels))
+        chan.setFlags(QtCore.Qt.ItemIsEnabled)
+        self.table_widget.setItem(rid, 2, chan)
+
+        thresholds = ', '.join('{:.2f}'.format(t) for t in thresholds)
+        self.table_widget.setItem(
+            rid, 4, QtWidgets.QTableWidgetItem('{}'.format(thresholds))
+        )
+
+    def setFailedRow(self, rid, error):
+        """
+        Mark the row of a slide that could not be imported - it
+        is left out of the batch and the error is shown over it
+        """
+        self.failed.add(rid)
+        reason = error.strip().splitlines()[-1] if error.strip() else 'unknown error'
+        item = QtWidgets.QTableWidgetItem('Could not threshold - {}'.format(reason))
+        item.setFlags(QtCore.Qt.ItemIsEnabled)
+        item.setToolTip(error)
+        item.setForeground(QtGui.QBrush(QtGui.QColor(200, 40, 40)))
+        self.table_widget.setItem(rid, 4, item)
+        self.combos[rid].setEnabled(False)
+        self.preview_btns[rid].setEnabled(False)
+
     def methodChanged(self):
         """
         Triggered when a combo box in the table changed
@@ -155,9 +187,18 @@ class BatchTable(QtWidgets.QWidget):
             self.parent.roi_table.update(rois)
             self.parent.scaled_regions = result
 
+    def activeRows(self):
+        """
+        :returns indices of the rows of slides that were imported
+        """
+        return [
+            r for r in range(self.table_widget.rowCount())
+            if r not in self.failed
+        ]
+
     def getRows(self):
         rows = []
-        for r in range(self.table_widget.rowCount()):
+        for r in self.activeRows():
             row = []
             # get slide path from second column
             row.append(self.table_widget.item(r, 1).text())
@@ -196,6 +237,11 @@ class BatchDialog(QtWidgets.QDialog):
         # self.channels = []
         # self.thresholds = ''
         self.threshold_method = 'otsu'
+        # number of processes used by a batch crop
+        settings = QtCore.QSettings('Dan', 'slidecrop')
+        self.workers = settings.value(
+            'batch_workers', os.cpu_count() or 1, type=int
+        )
         
         self.init_ui()
 
@@ -213,8 +259,9 @@ class BatchDialog(QtWidgets.QDialog):
 
         self.ui.folder_btn.clicked.connect(self.folderClicked)
         self.ui.run_btn.clicked.connect(self.runClicked)
-        # self.ui.stop_btn.clicked.connect(self.stopClicked)
-        self.ui.stop_btn.hide()
+        self.ui.stop_btn.clicked.connect(self.stopClicked)
+        self.ui.stop_btn.setEnabled(False)
+        self.worker = None
 
         self.threadpool = self.parent.threadpool
 
@@ -255,6 +302,8 @@ class BatchDialog(QtWidgets.QDialog):
         self.ui.run_btn.setEnabled(False)
         self.ui.stop_btn.setEnabled(True)
         rows = self.batch_table.getRows()
+        # slides of the batch are numbered without the failed rows
+        self.batch_rows = self.batch_table.activeRows()
         # try:
         input_paths = []
         output_dirs = []
@@ -276,7 +325,7 @@ class BatchDialog(QtWidgets.QDialog):
         #     pass
 
     def stopClicked(self):
-        if self.ui.stop_btn.isEnabled():
+        if self.ui.stop_btn.isEnabled() and self.worker is not None:
             if not self.worker.is_stopped():
                 self.worker.stop()
                 for bar in self.batch_table.bars:
@@ -290,8 +339,15 @@ class BatchDialog(QtWidgets.QDialog):
                     count += 1
             self.import_progress = Progress(self, count - 1, 'Slide import')
 
-            import_worker = Worker(threads._batch_import, folder, method)
+            # rows are added straight away and filled in as
+            # each slide is imported
+            self.batch_table.update(folder, [''] * count, [''] * count)
+
+            import_worker = Worker(
+                threads._batch_import, folder, method, workers=self.workers
+            )
             import_worker.signals.progress.connect(self.updateImportProgress)
+            import_worker.signals.custom_callback.connect(self.updateRow)
             import_worker.signals.result.connect(self.updateParameters)
             import_worker.signals.error.connect(self.parseCancelled)
             import_worker.signals.finished.connect(self.importFinished)
@@ -299,6 +355,10 @@ class BatchDialog(QtWidgets.QDialog):
             if not self.import_progress.isVisible():          
                 self.import_progress.show()
 
+            # the stop button cancels the import until it is done
+            self.worker = import_worker
+            self.ui.run_btn.setEnabled(False)
+            self.ui.stop_btn.setEnabled(True)
             self.threadpool.start(import_worker)
 
     def parseCancelled(self):
@@ -307,11 +367,11 @@ class BatchDialog(QtWidgets.QDialog):
         self.thresholds = ''
 
     def setTableBarMax(self, val):
-        bar = self.batch_table.bars[val[0]]
+        bar = self.batch_table.bars[self.batch_rows[val[0]]]
         bar.setMaximum(val[1] - 1)
 
     def updateTableProgressBars(self, val):
-        bar = self.batch_table.bars[val[0]]
+        bar = self.batch_table.bars[self.batch_rows[val[0]]]
         bar.setValue(val[1])
 
     def updateImportProgress(self, val):
@@ -319,23 +379,39 @@ class BatchDialog(QtWidgets.QDialog):
             self.import_progress.updateBar(val)        
 
     def batchFinished(self):
+        self.worker = None
         self.ui.run_btn.setEnabled(True)
         self.ui.stop_btn.setEnabled(False)
         for bar in self.batch_table.bars:
             bar.setValue(0)
 
     def importFinished(self):
+        self.worker = None
+        self.ui.run_btn.setEnabled(True)
+        self.ui.stop_btn.setEnabled(False)
         if self.import_progress.isVisible():
             self.import_progress.close()
 
+    def updateRow(self, val):
+        sid, channels, thresholds = val
+        if channels is None:
+            # thresholds holds the error of a slide that failed
+            self.batch_table.setFailedRow(sid, thresholds)
+        else:
+            self.batch_table.setRow(sid, channels, thresholds)
+
     def updateParameters(self, results):
         if results:
-            channels = [str(c) for c in results[0]]
+            # slides that could not be read are left blank
+            channels = ['' if c is None else str(c) for c in results[0]]
             thresholds = []
             for thresh in results[1]:
+                if thresh is None:
+                    thresholds.append('')
+                    continue
                 thresholds.append(', '.join('{:.2f}'.format(t) for t in thresh))
 
-            self.batch_table.update(self.folder, channels, thresholds)
+            # the table has been filled in row by row
             self.channels = channels
             self.thresholds = thresholds
 
@@ -354,16 +430,20 @@ class BatchDialog(QtWidgets.QDialog):
         settings.setValue('folder', self.folder)
         settings.setValue('channels', self.channels)
         settings.setValue('thresholds', self.thresholds)
+        settings.setValue('batch_workers', self.workers)
 
 
     def _runBatch(self, input_paths, output_dirs, seg_channels, thresholds):
 
         batch_worker = Worker(
             threads._batch_crop, input_paths,
-            output_dirs, seg_channels, thresholds
+            output_dirs, seg_channels, thresholds,
+            workers=self.workers
         )
         batch_worker.signals.custom_callback.connect(self.setTableBarMax)
         batch_worker.signals.progress.connect(self.updateTableProgressBars)
         batch_worker.signals.finished.connect(self.batchFinished)
 
+        # kept so that the stop button can cancel it
+        self.worker = batch_worker
         self.threadpool.start(batch_worker)
\ No newline at end of file
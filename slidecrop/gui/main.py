@@ -1,4 +1,5 @@
 import os
+from math import ceil, log
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 import numpy as np
@@ -12,6 +13,13 @@ from .threads import Worker
 from .roi import ROITable
 from .roi import ROIItem
 from ..ims.slide import SlideImage
+from ..ims import lowres
+from ..ims.cache import LRUCache
+from .tiles import choose_level, level_ratios, visible_tiles
+from .compositor import DisplayCompositor
+from ..processing.threshold_cache import (
+    DEFAULT_CACHE_PATH, ThresholdCache, set_threshold_cache, threshold_cache
+)
 
 
 class SlideViewer(QtWidgets.QGraphicsView):
@@ -19,6 +27,12 @@ class SlideViewer(QtWidgets.QGraphicsView):
     QGraphicsView for displaying and interacting with
     a low resolution representation of the slide to
     be segemented and cropped.
+
+    Once zoomed in past the pixels of the low resolution image,
+    tiles of the finest level needed are read on a worker thread
+    and laid over it - nearest the centre of the view first. The
+    rendered tiles are kept in a memory bounded cache so panning
+    back over them does not read them again.
     """
     slideClicked = QtCore.pyqtSignal(QtCore.QPoint)
 
@@ -35,8 +49,26 @@ class SlideViewer(QtWidgets.QGraphicsView):
         self._empty = True
         self._scene = QtWidgets.QGraphicsScene()
         self._slide = QtWidgets.QGraphicsPixmapItem()
+        self._slide.setZValue(-2)
         self._scene.addItem(self._slide)
+        # threshold mask drawn over the slide and any tiles
+        self._mask = QtWidgets.QGraphicsPixmapItem()
+        self._mask.setZValue(-0.5)
+        self._scene.addItem(self._mask)
         self.setScene(self._scene)
+
+        # tiles of the finer resolution levels
+        self.tile_cache = LRUCache(256 * 2**20)
+        self.tile_channel = 'All'
+        self.tile_colors = []
+        self._tile_source = None
+        self._tile_items = {}
+        self._tile_wanted = set()
+        self._tile_worker = None
+        self._tile_timer = QtCore.QTimer(self)
+        self._tile_timer.setSingleShot(True)
+        self._tile_timer.setInterval(100)
+        self._tile_timer.timeout.connect(self._updateTiles)
         self._scene.newItem = None
         self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
         self.setResizeAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
@@ -59,10 +91,18 @@ class SlideViewer(QtWidgets.QGraphicsView):
         self._empty = True
         self._zoom = 0
         self.factor = None
+        self._stopTiles()
+        self._tile_items = {}
+        self._tile_source = None
+        self.tile_cache.clear()
         self._scene.clear()
         self._clearTabs()
         self._slide = QtWidgets.QGraphicsPixmapItem()
+        self._slide.setZValue(-2)
         self._scene.addItem(self._slide)        
+        self._mask = QtWidgets.QGraphicsPixmapItem()
+        self._mask.setZValue(-0.5)
+        self._scene.addItem(self._mask)
 
     def clearScene(self):
         """
@@ -105,6 +145,140 @@ class SlideViewer(QtWidgets.QGraphicsView):
             self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
             self._slide.setPixmap(QtGui.QPixmap())
         self.fitInView()
+        self._scheduleTiles()
+
+    def setMask(self, qimg=None):
+        """
+        Show a threshold mask over the slide, or hide it
+        """
+        if qimg is None:
+            self._mask.setPixmap(QtGui.QPixmap())
+        else:
+            self._mask.setPixmap(QtGui.QPixmap.fromImage(qimg))
+
+    def setTileSource(self, slide):
+        """
+        Use the resolution levels of a slide for the tiles
+        shown when zoomed in
+        """
+        self._stopTiles()
+        self._removeTiles()
+        self.tile_cache.clear()
+        self._tile_source = {
+            'path': slide.filepath,
+            'ratios': level_ratios(slide),
+            'sizes': [slide.level_dimensions(r) for r in range(slide.size_r)],
+            'level': slide.segmentation_level
+        }
+        # allow zooming in until level 0 is shown at full size
+        finest = max(self._tile_source['ratios'][0])
+        self.max_zoom = 10 + int(ceil(log(finest) / log(1.25)))
+
+    def setTileChannel(self, channel, colors):
+        """
+        Show tiles of a channel ('All' for the first three
+        channels) in the given colours
+        """
+        if channel != self.tile_channel or colors != self.tile_colors:
+            self.tile_channel = channel
+            self.tile_colors = colors
+            self._removeTiles()
+            self._scheduleTiles()
+
+    def _scheduleTiles(self):
+        """
+        Update the tiles once zooming or panning has paused
+        """
+        if self._tile_source is not None:
+            self._tile_timer.start()
+
+    def _stopTiles(self):
+        if self._tile_worker is not None:
+            self._tile_worker.stop()
+            self._tile_worker = None
+
+    def _removeTiles(self, keep=()):
+        for key in list(self._tile_items):
+            if key not in keep:
+                self._scene.removeItem(self._tile_items.pop(key))
+
+    def _updateTiles(self):
+        """
+        Show the tiles of the level matching the zoom that are in
+        view - those cached straight away, the rest once read
+        """
+        source = self._tile_source
+        if source is None or not self.hasSlide():
+            return
+        level = choose_level(source['ratios'], self.transform().m11())
+        if level >= source['level']:
+            # the low resolution image is fine enough
+            self._stopTiles()
+            self._removeTiles()
+            self._tile_wanted = set()
+            return
+
+        view = self.mapToScene(self.viewport().rect()).boundingRect()
+        tiles = visible_tiles(
+            [view.left(), view.top(), view.right(), view.bottom()],
+            source['sizes'][level], source['ratios'][level]
+        )
+        channel = self.tile_channel
+        keys = [(level, channel, tuple(tile)) for tile in tiles]
+        self._tile_wanted = set(keys)
+        self._removeTiles(keep=self._tile_wanted)
+
+        missing = []
+        for key, tile in zip(keys, tiles):
+            if key in self._tile_items:
+                continue
+            rgba = self.tile_cache.get(key)
+            if rgba is None:
+                missing.append(tile)
+            else:
+                self._addTile(key, rgba)
+
+        # only the tiles now in view are read
+        self._stopTiles()
+        if missing:
+            worker = Worker(
+                threads._load_tiles, source['path'], level, missing,
+                channel, self.tile_colors
+            )
+            worker.signals.progress.connect(self._onTileLoaded)
+            self._tile_worker = worker
+            self.parent.threadpool.start(worker)
+
+    def _onTileLoaded(self, val):
+        level, channel, tile, rgba = val
+        key = (level, channel, tile)
+        self.tile_cache.put(key, rgba)
+        if key in self._tile_wanted and key not in self._tile_items:
+            self._addTile(key, rgba)
+
+    def _addTile(self, key, rgba):
+        """
+        Lay a tile over the low resolution image
+        """
+        level, _, (x, y, w, h) = key
+        rx, ry = self._tile_source['ratios'][level]
+        qimg = QtGui.QImage(
+            rgba.data, w, h, 4 * w, QtGui.QImage.Format_RGBA8888
+        ).copy()
+        item = QtWidgets.QGraphicsPixmapItem(QtGui.QPixmap.fromImage(qimg))
+        item.setTransform(QtGui.QTransform.fromScale(1.0 / rx, 1.0 / ry))
+        item.setPos(x / rx, y / ry)
+        item.setZValue(-1)
+        self._scene.addItem(item)
+        self._tile_items[key] = item
+
+    def scrollContentsBy(self, dx, dy):
+        super(SlideViewer, self).scrollContentsBy(dx, dy)
+        self._scheduleTiles()
+
+    def resizeEvent(self, event):
+        super(SlideViewer, self).resizeEvent(event)
+        self._scheduleTiles()
 
     def wheelEvent(self, event):
     
@@ -125,6 +299,8 @@ class SlideViewer(QtWidgets.QGraphicsView):
                 # print(self._zoom)
                 self._zoom = 0
 
+            self._scheduleTiles()
+
             # rect = QtCore.QRectF(self._slide.pixmap().rect())
             # viewrect = self.viewport().rect()
             # print('viewrect {}'.format(viewrect))
@@ -249,12 +425,17 @@ class Window(QtWidgets.QMainWindow):
         self.curr_channel = None
         self.thresh_channel = 0
         self.curr_img = None
+        self.compositor = None
+        self.display_channel = None
         self.slide_histogram = []
         self.threshold = []
         self.thresh_dialog = None
         self.batch_dialog = None
         self.rois = []
         self.scaled_regions = []
+        # component trees of the segmentation channels - used
+        # to find regions while the threshold line is dragged
+        self.seg_trees = {}
 
         # widgets
         self.viewer = SlideViewer(self, self.ui.slide_tabWidget)
@@ -271,6 +452,19 @@ class Window(QtWidgets.QMainWindow):
         # thread pool
         self.threadpool = QtCore.QThreadPool()
 
+        # auto thresholds are kept between sessions
+        set_threshold_cache(ThresholdCache(DEFAULT_CACHE_PATH))
+
+        # segmentation for a new threshold waits until the line
+        # has settled and only the latest threshold is segmented -
+        # a running worker it supersedes is stopped
+        self.seg_worker = None
+        self.seg_request = None
+        self.seg_timer = QtCore.QTimer(self)
+        self.seg_timer.setSingleShot(True)
+        self.seg_timer.setInterval(200)
+        self.seg_timer.timeout.connect(self._startSegmentation)
+
     # events
     def dragEnterEvent(self, event):
         """
@@ -315,6 +509,7 @@ class Window(QtWidgets.QMainWindow):
         event.ignore()
 
         if result == QtWidgets.QMessageBox.Yes:
+            threshold_cache().save()
             event.accept()
 
     # actions
@@ -372,17 +567,16 @@ class Window(QtWidgets.QMainWindow):
             # respond to changes in the threshold line
             thresh_line = self.thresh_dialog.thresh_line
             thresh_line.sigPositionChangeFinished.connect(self._lineMoved)
+            thresh_line.sigPositionChanged.connect(self._lineDragged)
+            self._buildSegmentationTree(channel)
 
             if not self.thresh_dialog.isVisible():
                 self.thresh_dialog.show()
 
             self._updateDisplayImage(self.curr_channel)
 
-            seg_worker = Worker(
-                threads._segment, self.slide_path, channel, threshold
-            )
-            seg_worker.signals.result.connect(self.onSegmentationFinished)
-            self.threadpool.start(seg_worker)
+            self.seg_request = (channel, threshold)
+            self._startSegmentation()
 
     def cropClicked(self):
         """
@@ -440,6 +634,7 @@ class Window(QtWidgets.QMainWindow):
         self.basepath = os.path.dirname(self.slide_path)
         self.basename = os.path.splitext(self.slide_path)[0]
         self.slide = slide
+        self.seg_trees = {}
 
         # get the microscope mode
         self.microscope_mode = self.slide.microscope_mode
@@ -456,12 +651,13 @@ class Window(QtWidgets.QMainWindow):
 
         # update the image display tabs
         self.viewer.updateTabs(self.channel_names)
+        self.viewer.setTileSource(slide)
 
         # set current channel
         self.curr_channel = 'All'
         
         # set current image in display
-        self.curr_img = self.slide.low_resolution_image()
+        self.curr_img = lowres.low_resolution_image(self.slide)
 
         # update the display
         self._updateDisplayImage(self.curr_channel, show_mask=False)
@@ -493,7 +689,9 @@ class Window(QtWidgets.QMainWindow):
                 threshold = self.threshold[channel]
                 self.thresh_dialog.updatePlot(threshold, data)
                 thresh_line = self.thresh_dialog.thresh_line
-                thresh_line.sigPositionChangeFinished.connect(self._lineMoved)                
+                thresh_line.sigPositionChangeFinished.connect(self._lineMoved)
+                thresh_line.sigPositionChanged.connect(self._lineDragged)
+                self._buildSegmentationTree(channel)
 
             self._updateDisplayImage(self.curr_channel, show_mask=show_mask)
 
@@ -518,6 +716,17 @@ class Window(QtWidgets.QMainWindow):
             self.roi_table.update(rois)
             self.scaled_regions = result
 
+    def onTreeFailed(self, trees, channel, error):
+        """
+        Forget the placeholder of a component tree that could
+        not be built
+        """
+        if trees.get(channel, False) is None:
+            trees.pop(channel)
+
+    def onTreeFinished(self, trees, channel, tree):
+        trees[channel] = tree
+
     def onHistogramFinished(self, result):
         if result:
             self.slide_histogram = result
@@ -534,48 +743,49 @@ class Window(QtWidgets.QMainWindow):
     def _updateDisplayImage(self, channel, show_mask=True):
         """
         Updates the display of the low resolution slide image
-        to show the result of any thresholding - probably
-        needs refactoring (doing too many things).
+        to show the result of any thresholding. The view of each
+        channel is built once by the compositor and the threshold
+        is shown as a separate mask layer, so only the mask is
+        redrawn when the threshold moves.
         """
-        # image is being split for RGB for testing only
-        # finally only 'All' tab will be displayed
         print("curr_channel {}".format(self.curr_channel))
         print("threshold {}".format(self.threshold))
 
         img = self.curr_img
-        _, h, w = img.shape
-        img_RGB = np.zeros((h, w, 4), dtype=np.uint8)
-        if isinstance(channel, int):
-            color = self.channel_colors[channel]
-            img_RGB[:, :, 0] = img[channel, :, :] * color[0]
-            img_RGB[:, :, 1] = img[channel, :, :] * color[1]
-            img_RGB[:, :, 2] = img[channel, :, :] * color[2]
-            img_RGB[:, :, 3] = 255
-            if self.threshold and show_mask:
-                threshold = self.threshold[channel]
-                if 'bright' in self.microscope_mode:
-                    mask = img_RGB[:, :, channel] < threshold
-                elif 'fluoro' in self.microscope_mode:
-                    mask = img_RGB[:, :, channel] > threshold
-                img_RGB[mask, 0] = 255
-                img_RGB[mask, 1] = 255
+        if self.compositor is None or self.compositor.image is not img:
+            ranges = [
+                self.slide.histogram_range(c=c) for c in range(self.channels)
+            ]
+            self.compositor = DisplayCompositor(img, self.channel_colors, ranges)
+            self.display_channel = None
+
+        if channel != self.display_channel:
+            rgba = self.compositor.rgba(channel)
+            h, w = rgba.shape[:2]
+            qimg = QtGui.QImage(
+                rgba.data, w, h, 4 * w, QtGui.QImage.Format_RGBA8888
+            )
+            self.viewer.setTileChannel(channel, self.channel_colors)
+            self.viewer.setSlide(qimg)
+            self.display_channel = channel
+
+        if self.threshold and show_mask:
+            threshold = self.threshold[channel if isinstance(channel, int) else 0]
+            self._showMask(channel, threshold)
         else:
-            img_RGB[:, :, 0] = img[0, :, :]
-            img_RGB[:, :, 1] = img[1, :, :]
-            img_RGB[:, :, 2] = img[2, :, :]
-            img_RGB[:, :, 3] = 255
-            if self.threshold and show_mask:
-                threshold = self.threshold[0]
-                print("rgb threshold {}".format(threshold))
-                if 'bright' in self.microscope_mode:
-                    mask = img_RGB[:, :, 0] < threshold
-                elif 'fluoro' in self.microscope_mode:
-                    mask = img_RGB[:, :, 0] > threshold
-                img_RGB[mask, 0] = 255
-
-        qimg = QtGui.QImage(img_RGB.data, w, h, QtGui.QImage.Format_RGBA8888)
-
-        self.viewer.setSlide(qimg)     
+            self.viewer.setMask(None)
+
+    def _showMask(self, channel, threshold):
+        """
+        Draw the threshold mask of a channel over the slide
+        """
+        mask = self.compositor.mask(channel, threshold, self.microscope_mode)
+        if mask is None:
+            self.viewer.setMask(None)
+            return
+        h, w = mask.shape[:2]
+        qimg = QtGui.QImage(mask.data, w, h, 4 * w, QtGui.QImage.Format_RGBA8888)
+        self.viewer.setMask(qimg)
 
     def _lineMoved(self, line):
         """
@@ -599,12 +809,115 @@ class Window(QtWidgets.QMainWindow):
 
         self._updateDisplayImage(self.curr_channel)
 
+        tree = self.seg_trees.get(channel)
+        if tree is not None:
+            self._cancelSegmentation()
+            self._showRegions(
+                tree.regions(line.value(), self.slide.scale_factor)
+            )
+        else:
+            self.seg_request = (channel, line.value())
+            self.seg_timer.start()
+
+    def _startSegmentation(self):
+        """
+        Segment the low resolution image at the latest threshold
+        requested on a worker thread, stopping any earlier one
+        """
+        if self.seg_request is None:
+            return
+        channel, threshold = self.seg_request
+        self.seg_request = None
+        if self.seg_worker is not None:
+            self.seg_worker.stop()
+
         seg_worker = Worker(
-            threads._segment, self.slide_path, channel, line.value()
+            threads._segment, self.slide_path, channel, threshold
+        )
+        seg_worker.signals.result.connect(
+            lambda regions: self._onSegmentResult(seg_worker, regions)
         )
-        seg_worker.signals.result.connect(self.onSegmentationFinished)
+        self.seg_worker = seg_worker
         self.threadpool.start(seg_worker)
-        
+
+    def _onSegmentResult(self, worker, regions):
+        """
+        Show the regions of a segmentation worker unless a newer
+        one has been started since
+        """
+        if worker is self.seg_worker:
+            self.seg_worker = None
+            self.onSegmentationFinished(regions)
+
+    def _cancelSegmentation(self):
+        """
+        Drop any waiting or running segmentation
+        """
+        self.seg_timer.stop()
+        self.seg_request = None
+        if self.seg_worker is not None:
+            self.seg_worker.stop()
+            self.seg_worker = None
+
+    def _lineDragged(self, line):
+        """
+        Responds to the threshold line being dragged - once the
+        component tree of the channel is built the regions are
+        looked up and shown as the line moves.
+        """
+        channel = self.curr_channel
+        if isinstance(channel, str):
+            channel = 0
+
+        # the mask is cheap enough to follow the line
+        if self.compositor is not None:
+            self._showMask(self.curr_channel, line.value())
+
+        tree = self.seg_trees.get(channel)
+        if tree is not None:
+            self._showRegions(
+                tree.regions(line.value(), self.slide.scale_factor)
+            )
+
+    def _buildSegmentationTree(self, channel):
+        """
+        Build the component tree of a channel of the low
+        resolution image on a worker thread
+        """
+        if channel in self.seg_trees:
+            return
+
+        # the tree is stored in the dict of the slide it was
+        # started for, a new slide replaces the dict
+        trees = self.seg_trees
+        trees[channel] = None
+        tree_worker = Worker(
+            threads._component_tree, self.curr_img[channel],
+            self.microscope_mode
+        )
+        tree_worker.signals.result.connect(
+            lambda tree: self.onTreeFinished(trees, channel, tree)
+        )
+        # a failed build is tried again next time
+        tree_worker.signals.error.connect(
+            lambda error: self.onTreeFailed(trees, channel, error)
+        )
+        self.threadpool.start(tree_worker)
+
+    def _showRegions(self, regions):
+        """
+        Replace the ROIs shown with a new set of regions
+        """
+        if self.rois:
+            self.viewer.clearScene()
+
+        if regions:
+            self.onSegmentationFinished(regions)
+        else:
+            self.rois = []
+            self.scaled_regions = []
+            self.roi_table.clear()
+
 
 if __name__ == '__main__':
 
@@ -8,19 +8,19 @@ from PyQt5.QtCore import QThread, QRunnable, QObject
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
 
 import numpy as np
-from skimage.filters import (
-    threshold_isodata,
-    threshold_mean,
-    threshold_otsu,
-    threshold_triangle,
-    threshold_yen
-)
 
 # from slidecrop.processing.otsu import threshold_otsu
 from ..ims.slide import SlideImage
+from ..ims import lowres
 from ..processing.crop import CropSlide
-from ..processing.segmentation import Segment
-from ..ome.ometiff import OMETiffGenerator
+from ..processing.segmentation import Segment, auto_threshold
+from ..processing.multicrop import MultiCrop
+from ..processing.batch import BatchCrop, scan_slides
+from ..processing.threshold import histogram_threshold
+from ..processing.threshold_cache import threshold_cache
+from ..processing.component_tree import ComponentTree
+from ..processing.cancel import CancelToken, Cancelled
+from .tiles import render_tile, tile_channels
 
 
 # need to move over to this to tidy up threading
@@ -48,8 +48,12 @@ class WorkerSignals(QObject):
     custom_callback
         `object` any other type of signal (e.g. partial results)
 
+    cancelled
+        No data - the worker was stopped before it finished
+
     '''
     finished = pyqtSignal()
+    cancelled = pyqtSignal()
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
     progress = pyqtSignal(object)
@@ -68,6 +72,10 @@ class Worker(QRunnable):
     :param args: Arguments to pass to the callback function
     :param kwargs: Keywords to pass to the callback function
 
+    The callback is also passed a CancelToken as cancel_token -
+    long running callbacks check it between tiles, regions or
+    slides so that stop() ends them early.
+
     '''
 
     def __init__(self, fn, *args, **kwargs):
@@ -82,6 +90,18 @@ class Worker(QRunnable):
         # Add the callback to our kwargs
         self.kwargs['progress_callback'] = self.signals.progress
         self.kwargs['custom_callback'] = self.signals.custom_callback        
+        self.token = CancelToken()
+        self.kwargs['cancel_token'] = self.token
+
+    def stop(self):
+        '''
+        Ask the callback to stop - it does so the next
+        time it checks its cancel token
+        '''
+        self.token.cancel()
+
+    def is_stopped(self):
+        return self.token.cancelled
 
     @pyqtSlot()
     def run(self):
@@ -92,6 +112,8 @@ class Worker(QRunnable):
         # Retrieve args/kwargs here; and fire processing using them
         try:
             result = self.fn(*self.args, **self.kwargs)
+        except Cancelled:
+            self.signals.cancelled.emit()
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
@@ -105,80 +127,82 @@ class Worker(QRunnable):
 # functions to run in threads
 def _import(slide_path,
             progress_callback=None,
-            custom_callback=None):
+            custom_callback=None,
+            cancel_token=None):
 
     slide = SlideImage(slide_path)
     threshold = _get_threshold(slide, 'otsu')
-    hist = []
-    for c in range(slide.size_c):
-        hist.append(slide.get_histogram(c=c))
+    hist = lowres.histograms(slide)
+    # decode the low resolution image here rather than in the
+    # GUI thread - the window takes it from the cache
+    lowres.low_resolution_image(slide)
     return (slide, threshold, hist)
 
 
-def _batch_import(folder, thresh_method,
+def _batch_import(folder, thresh_method, workers=None,
                   progress_callback=None,
-                  custom_callback=None):
-
-    channels = []
-    thresholds = []
-    count = 0
-    for filename in os.listdir(folder):
-        if filename.endswith('.ims'):
-            slide_path = os.path.join(folder, filename)
-
-            with SlideImage(slide_path) as slide:
-                channels.append(slide.size_c)
-                thresholds.append(_get_threshold(slide, thresh_method))
-
-            progress_callback.emit(count)
-            time.sleep(0.2)
-            count += 1    
-
-    return (channels, thresholds)
+                  custom_callback=None,
+                  cancel_token=None):
+
+    slide_paths = [
+        os.path.join(folder, filename) for filename in os.listdir(folder)
+        if filename.endswith('.ims')
+    ]
+
+    # each slide is sent to the table as soon as it is done -
+    # a slide that could not be thresholded is sent without
+    # channels and with its error in place of the thresholds
+    done = []
+    def row(sid, size_c, thresholds):
+        custom_callback.emit((sid, size_c, thresholds))
+        progress_callback.emit(len(done))
+        done.append(sid)
+
+    def failed(sid, error):
+        row(sid, None, error)
+
+    return scan_slides(
+        slide_paths, thresh_method, workers, row, failed, cancel=cancel_token
+    )
 
 def _get_histogram(slide,
                    progress_callback=None,
-                   custom_callback=None):
+                   custom_callback=None,
+                   cancel_token=None):
 
-    y = []
-    for c in range(slide.size_c):
-        y.append(slide.get_histogram(c=c))
-    return y
+    return lowres.histograms(slide)
 
 
 def _auto_threshold(plane, method):
-    if 'isodata' in method:
-        thresh = threshold_isodata(plane)        
-    elif 'mean' in method:
-        thresh = threshold_mean(plane)
-    elif 'otsu' in method:
-        thresh = threshold_otsu(plane)
-    elif 'triangle' in method:
-        thresh = threshold_triangle(plane)
-    elif 'yen' in method:
-        thresh = threshold_yen(plane)
-    else:
-        raise NotImplementedError('thresholding method not supported')
-    return thresh       
+    return auto_threshold(plane, method)
 
 
 def _get_threshold(slide, method,
                    progress_callback=None,
-                   custom_callback=None):
-
-    low = slide.low_resolution_image()
-    size_c = slide.size_c
-    thresh = []
-    for c in range(size_c):
-        plane = low[c, :, :]  
-        thresh.append(_auto_threshold(plane, method))       
+                   custom_callback=None,
+                   cancel_token=None):
+
+    # thresholds come from the histograms stored in the
+    # slide so no pixels need to be read, and each is only
+    # found once for a slide, level and method - the memo is
+    # written to disk when the window is closed
+    cache = threshold_cache()
+    level = slide.segmentation_level
+    thresh = cache.get_channels(slide.filepath, level, method, slide.size_c)
+    if thresh is None:
+        thresh = []
+        for c, hist in enumerate(lowres.histograms(slide)):
+            centers = lowres.bin_centers(slide, c=c)
+            thresh.append(histogram_threshold(hist, method, centers))
+        cache.put_channels(slide.filepath, level, method, thresh)
 
     return thresh
 
 
 def _threshold(slide_path, method,
                progress_callback=None,
-               custom_callback=None):
+               custom_callback=None,
+               cancel_token=None):
 
     with SlideImage(slide_path) as slide:
         threshold = _get_threshold(slide, method)
@@ -189,13 +213,20 @@ def _threshold(slide_path, method,
 def _segment(slide_path,
              channel, threshold,
              progress_callback=None,
-             custom_callback=None):
+             custom_callback=None,
+             cancel_token=None):
 
+    # a newer threshold may have superseded this one while
+    # it was queued or while the image was being read
+    if cancel_token is not None:
+        cancel_token.check()
     with SlideImage(slide_path) as slide:
         mode = slide.microscope_mode
-        lo = slide.low_resolution_image()
+        lo = lowres.low_resolution_image(slide)
         factor = slide.scale_factor
 
+        if cancel_token is not None:
+            cancel_token.check()
         segmenter = Segment(
             mode, factor, channel=channel,
             thresh_method='manual', threshold=threshold
@@ -204,47 +235,67 @@ def _segment(slide_path,
     return regions
 
 
-def _make_ome(slide, outputdir, region, rid):
-    filename = slide.basename + '_section_{}.ome.tif'.format(rid)    
-    channels = [c for c in range(slide.size_c)]    
-    ometiff = OMETiffGenerator(
-        slide,
-        filename,
-        outputdir,
-        channels, 0, 0
-    )
-    ometiff.run(region)
+def _component_tree(plane, mode, filters=None,
+                    progress_callback=None,
+                    custom_callback=None,
+                    cancel_token=None):
+
+    return ComponentTree(plane, mode, filters)
+
+
+def _load_tiles(slide_path, level, tiles, channel, colors,
+                progress_callback=None,
+                custom_callback=None,
+                cancel_token=None):
+
+    # tiles are sent back one at a time, in the order given,
+    # so the viewer can show each as soon as it is read
+    with SlideImage(slide_path) as slide:
+        channels = tile_channels(channel, slide.size_c)
+        for tile in tiles:
+            if cancel_token is not None:
+                cancel_token.check()
+            pixels = np.stack([
+                slide.read_region(tile, level, c) for c in channels
+            ])
+            rgba = render_tile(pixels, channel, colors)
+            progress_callback.emit((level, channel, tuple(tile), rgba))
+
+
+def _multi_crop(slide, outputdir, regions, progress=None, cancel=None):
+    filenames = [
+        slide.basename + '_section_{}.ome.tif'.format(rid)
+        for rid in range(len(regions))
+    ]
+    channels = [c for c in range(slide.size_c)]
+    crop = MultiCrop(slide, outputdir, channels, 0, 0, cancel=cancel)
+    crop.run(regions, filenames, progress=progress)
 
 
 def _crop_regions(slide_path,
                   outputdir, regions,
                   progress_callback=None,
-                  custom_callback=None):
+                  custom_callback=None,
+                  cancel_token=None):
 
     with SlideImage(slide_path) as slide:
-        for rid, region in enumerate(regions):
-            _make_ome(slide, outputdir, region, rid)
-            time.sleep(0.1)
-            progress_callback.emit(rid)
+        _multi_crop(
+            slide, outputdir, regions, progress_callback.emit, cancel_token
+        )
 
 
 def _batch_crop(input_paths, output_dirs, channels,
-                thresholds, progress_callback=None,
-                custom_callback=None):
-
-    count = 0
-    for sid, slide_path in enumerate(input_paths):
-        seg_channel = channels[sid]
-        threshold = thresholds[sid]
-
-        # segment
-        regions = _segment(slide_path, seg_channel, threshold)
-        custom_callback.emit((sid, len(regions)))
-
-        # crop
-        with SlideImage(slide_path) as slide:
-            for rid, region in enumerate(regions):
-
-                _make_ome(slide, output_dirs[sid], region, rid)
-                progress_callback.emit((sid, rid))
-                count += 1
+                thresholds, workers=None, memory_budget=None,
+                progress_callback=None, custom_callback=None,
+                cancel_token=None):
+
+    # slides are segmented and cropped on a pool of processes -
+    # progress comes back to this thread and is emitted from here
+    # so the dialog is only ever updated through queued signals
+    batch = BatchCrop(workers=workers, memory_budget=memory_budget)
+    return batch.run(
+        input_paths, output_dirs, channels, thresholds,
+        sections=lambda sid, n: custom_callback.emit((sid, n)),
+        progress=lambda sid, rid: progress_callback.emit((sid, rid)),
+        cancel=cancel_token
+    )
@@ -107,8 +107,10 @@ class ThresholdDialog(QtWidgets.QDialog):
         if bd is not None and bd.isVisible():
             self.parent.batch_dialog.batch_table.updateThreshMethodCell(val)
 
+        # thresholds are found from the histograms of the
+        # slide (or the memo of earlier ones)
         thresh_worker = Worker(
-            threads._threshold, self.parent.slide_path, method
+            threads._get_threshold, self.parent.slide, method
         )
         thresh_worker.signals.result.connect(self.updateLineAndDisplay)
 
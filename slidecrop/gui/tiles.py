@@ -0,0 +1,113 @@
+from math import ceil, floor, hypot
+
+import numpy as np
+
+
+# size of the tiles read from the finer levels (pixels of that level)
+TILE_SIZE = 512
+
+
+def level_ratios(slide):
+    """
+    Pixels of each resolution level per pixel of the
+    segmentation level - the viewer scene is in pixels
+    of the segmentation level
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :returns list of (x, y) ratios indexed by level
+    """
+    low_x, low_y = slide.level_dimensions(slide.segmentation_level)
+    ratios = []
+    for r in range(slide.size_r):
+        size_x, size_y = slide.level_dimensions(r)
+        ratios.append((float(size_x) / low_x, float(size_y) / low_y))
+    return ratios
+
+
+def choose_level(ratios, scale):
+    """
+    Coarsest level with at least one pixel for each screen
+    pixel at the current zoom - level 0 once zoomed past it
+
+    :param ratios: ratios returned by level_ratios
+    :type ratios: list
+    :param scale: screen pixels per segmentation level pixel
+    :type scale: float
+    :returns level
+    """
+    best = 0
+    for level, (rx, ry) in enumerate(ratios):
+        if min(rx, ry) >= scale:
+            best = level
+    return best
+
+
+def visible_tiles(rect, level_size, ratio, tile_size=TILE_SIZE):
+    """
+    Tiles of a level under a rectangle of the scene, nearest the
+    centre of the rectangle first so those are loaded first
+
+    :param rect: x0, y0, x1, y1 of the visible scene
+    :type rect: list
+    :param level_size: x, y size of the level
+    :type level_size: tuple
+    :param ratio: x, y pixels of the level per scene pixel
+    :type ratio: tuple
+    :param tile_size: size of the tiles
+    :type tile_size: int
+    :returns list of x, y, w, h of the tiles in the level
+    """
+    size_x, size_y = level_size
+    x0 = max(int(floor(rect[0] * ratio[0])) // tile_size, 0)
+    y0 = max(int(floor(rect[1] * ratio[1])) // tile_size, 0)
+    x1 = min(int(ceil(rect[2] * ratio[0] / tile_size)), int(ceil(float(size_x) / tile_size)))
+    y1 = min(int(ceil(rect[3] * ratio[1] / tile_size)), int(ceil(float(size_y) / tile_size)))
+    cx = (rect[0] + rect[2]) * ratio[0] / 2.0
+    cy = (rect[1] + rect[3]) * ratio[1] / 2.0
+
+    tiles = []
+    for row in range(y0, y1):
+        for col in range(x0, x1):
+            x, y = col * tile_size, row * tile_size
+            w, h = min(tile_size, size_x - x), min(tile_size, size_y - y)
+            tiles.append((hypot(x + w / 2.0 - cx, y + h / 2.0 - cy), [x, y, w, h]))
+    tiles.sort(key=lambda t: t[0])
+    return [tile for _, tile in tiles]
+
+
+def render_tile(pixels, channel, colors):
+    """
+    Turn the pixels of a tile into RGBA as the low resolution
+    image is shown - one channel in its colour or the first
+    three channels as red, green and blue
+
+    :param pixels: numpy array of shape (c, h, w) holding the
+    channels returned by tile_channels
+    :type pixels: numpy array
+    :param channel: channel shown or 'All'
+    :type channel: int or str
+    :param colors: colour of each channel
+    :type colors: list
+    :returns numpy array of shape (h, w, 4)
+    """
+    _, h, w = pixels.shape
+    rgba = np.zeros((h, w, 4), dtype=np.uint8)
+    if isinstance(channel, int):
+        color = colors[channel]
+        for i in range(3):
+            rgba[:, :, i] = pixels[0] * color[i]
+    else:
+        for i in range(min(3, pixels.shape[0])):
+            rgba[:, :, i] = pixels[i]
+    rgba[:, :, 3] = 255
+    return rgba
+
+
+def tile_channels(channel, size_c):
+    """
+    :returns list of the channels needed to render a tile
+    """
+    if isinstance(channel, int):
+        return [channel]
+    return list(range(min(3, size_c)))
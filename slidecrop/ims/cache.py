@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Least recently used cache of numpy arrays bounded by the
+    total number of bytes held rather than the number of items.
+
+    A budget of 0 disables the cache - nothing is stored and
+    every lookup is a miss. The budget can be changed at any
+    time and the cache is trimmed straight away.
+
+    Can be used as follows:
+    cache = LRUCache(256 * 2**20)
+    block = cache.get(key)
+    if block is None:
+        block = read(key)
+        cache.put(key, block)
+    """
+    def __init__(self, budget=0):
+        """
+        Constructor
+        :param budget: maximum number of bytes held
+        :type budget: int
+        """
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._budget = int(budget)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def budget(self):
+        """
+        :returns maximum number of bytes held by the cache
+        """
+        return self._budget
+
+    @budget.setter
+    def budget(self, value):
+        """
+        Sets the byte budget, evicting items if it has shrunk
+        """
+        with self._lock:
+            self._budget = max(int(value), 0)
+            self._evict()
+
+    @property
+    def enabled(self):
+        return self._budget > 0
+
+    @property
+    def stats(self):
+        """
+        :returns dict of hits, misses, items, bytes held and budget
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self._items),
+            'nbytes': self.nbytes,
+            'budget': self._budget
+        }
+
+    def get(self, key):
+        """
+        :returns cached value or None and updates the counters
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Store a value - values larger than the budget are not held
+        """
+        size = value.nbytes
+        with self._lock:
+            if size > self._budget:
+                return
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._items[key] = value
+            self.nbytes += size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self.nbytes > self._budget and self._items:
+            _, value = self._items.popitem(last=False)
+            self.nbytes -= value.nbytes
@@ -0,0 +1,79 @@
+import zlib
+
+import h5py
+import numpy as np
+
+
+class ChunkDecoder:
+    """
+    Decodes the raw (still compressed) bytes of a chunk read
+    from an HDF5 dataset with read_direct_chunk.
+
+    Only the filters used by Imaris files are supported -
+    deflate (gzip), shuffle and the fletcher32 checksum.
+    zlib releases the GIL while decompressing so chunks
+    can be decoded on a pool of threads.
+    """
+    SUPPORTED = (
+        h5py.h5z.FILTER_DEFLATE,
+        h5py.h5z.FILTER_SHUFFLE,
+        h5py.h5z.FILTER_FLETCHER32
+    )
+
+    def __init__(self, data):
+        """
+        Constructor
+
+        :param data: the dataset whose chunks will be decoded
+        :type data: h5py dataset
+        :raises ValueError: if the dataset is not chunked or uses
+        a filter that is not supported
+        """
+        if data.chunks is None:
+            raise ValueError('dataset is not chunked')
+        self.shape = data.chunks
+        self.dtype = data.dtype
+        self.fillvalue = data.fillvalue
+
+        dcpl = data.id.get_create_plist()
+        self.filters = []
+        for i in range(dcpl.get_nfilters()):
+            code = dcpl.get_filter(i)[0]
+            if code not in self.SUPPORTED:
+                raise ValueError('unsupported HDF5 filter {}'.format(code))
+            self.filters.append(code)
+
+    def decode(self, raw, filter_mask=0):
+        """
+        :param raw: chunk bytes or None if the chunk was never written
+        :type raw: bytes
+        :param filter_mask: bit i is set if filter i was skipped
+        :type filter_mask: int
+        :returns chunk as numpy array
+        """
+        if raw is None:
+            return np.full(self.shape, self.fillvalue, dtype=self.dtype)
+
+        # filters are undone in the reverse of the order applied
+        buf = raw
+        for i in reversed(range(len(self.filters))):
+            if filter_mask & (1 << i):
+                continue
+            code = self.filters[i]
+            if code == h5py.h5z.FILTER_DEFLATE:
+                buf = zlib.decompress(buf)
+            elif code == h5py.h5z.FILTER_SHUFFLE:
+                buf = self._unshuffle(buf)
+            elif code == h5py.h5z.FILTER_FLETCHER32:
+                buf = buf[:-4]
+        return np.frombuffer(buf, dtype=self.dtype).reshape(self.shape)
+
+    def _unshuffle(self, buf):
+        """
+        Undo the byte shuffle filter
+        """
+        size = self.dtype.itemsize
+        if size == 1:
+            return buf
+        shuffled = np.frombuffer(buf, dtype=np.uint8)
+        return shuffled.reshape(size, -1).T.tobytes()
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+
+
+INDEX_VERSION = 2
+DEFAULT_INDEX_DIR = os.path.join(os.path.expanduser('~'), '.slidecrop', 'index')
+# overrides DEFAULT_INDEX_DIR - read on every open so it also
+# reaches pool workers started by the process
+INDEX_DIR_ENV = 'SLIDECROP_INDEX_DIR'
+
+
+def default_index_dir():
+    """
+    Directory holding index files when none is given - the
+    SLIDECROP_INDEX_DIR environment variable if it is set,
+    otherwise ~/.slidecrop/index
+
+    :returns str
+    """
+    return os.environ.get(INDEX_DIR_ENV) or DEFAULT_INDEX_DIR
+
+
+def _file_key(filepath):
+    """
+    Identity of a slide file - an index is only valid while
+    path, size and modification time all match
+
+    :returns dict of path, size and mtime
+    """
+    stat = os.stat(filepath)
+    return {
+        'path': os.path.abspath(filepath),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+
+
+def index_path(filepath, index_dir=None):
+    """
+    Location of the index for a slide
+
+    :param filepath: path to the slide image in *.ims format
+    :type filepath: str
+    :param index_dir: directory holding index files - default
+    is default_index_dir()
+    :type index_dir: str
+    :returns path to the *.json index file
+    """
+    if index_dir is None:
+        index_dir = default_index_dir()
+    abspath = os.path.abspath(filepath)
+    digest = hashlib.sha1(abspath.encode('utf-8')).hexdigest()[:16]
+    basename = os.path.splitext(os.path.basename(abspath))[0]
+    return os.path.join(index_dir, '{}_{}.json'.format(basename, digest))
+
+
+def build_index(slide):
+    """
+    Collect the structure and metadata of an open slide
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :returns index as dict
+    """
+    size_r = slide.size_r
+    size_c = slide.size_c
+    histograms = []
+    histogram_ranges = []
+    for r in range(size_r):
+        histograms.append(
+            [slide.get_histogram(r=r, c=c).tolist() for c in range(size_c)]
+        )
+        histogram_ranges.append(
+            [slide.histogram_range(r=r, c=c) for c in range(size_c)]
+        )
+
+    return {
+        'version': INDEX_VERSION,
+        'file': _file_key(slide.filepath),
+        'size_r': size_r,
+        'size_c': size_c,
+        'size_t': slide.size_t,
+        'level_dimensions': [
+            list(slide.level_dimensions(r)) for r in range(size_r)
+        ],
+        'channel_names': slide.channel_names,
+        'channel_colors': slide.channel_colors,
+        'attributes': slide._attributes(),
+        'histograms': histograms,
+        'histogram_ranges': histogram_ranges
+    }
+
+
+def load_index(filepath, index_dir=None):
+    """
+    Read the index of a slide if there is one and it
+    still matches the file on disk
+
+    :returns index as dict or None
+    """
+    path = index_path(filepath, index_dir)
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+    if index.get('file') != _file_key(filepath):
+        return None
+    return index
+
+
+def save_index(index, index_dir=None):
+    """
+    Write an index next to the others in index_dir. The
+    file is replaced atomically so concurrent readers
+    never see a partial index.
+
+    :returns path to the *.json index file or None if
+    it could not be written
+    """
+    path = index_path(index['file']['path'], index_dir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        return None
+    return path
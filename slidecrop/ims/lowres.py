@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+
+from .cache import LRUCache
+
+# one cache per process shared by every SlideImage opened in it -
+# workers open their own handle on a slide so the low resolution
+# image cannot be kept on the handle itself
+_cache = LRUCache(512 * 2**20)
+
+
+def _key(slide, *parts):
+    """
+    Cache key of a slide - the modification time is part of the
+    key so a slide that is rewritten is read again
+    """
+    path = os.path.realpath(slide.filepath)
+    return (path, os.path.getmtime(path)) + parts
+
+
+def low_resolution_image(slide, r=None):
+    """
+    Whole slide image of a level, decoded once per process
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :param r: resolution level - defaults to the segmentation level
+    :type r: int
+    :returns read only numpy array of shape (c, h, w) - copy it
+    before changing it
+    """
+    if r is None:
+        r = slide.segmentation_level
+
+    key = _key(slide, 'image', r)
+    image = _cache.get(key)
+    if image is None:
+        image = slide.low_resolution_image(r)
+        image.flags.writeable = False
+        _cache.put(key, image)
+    return image
+
+
+def histogram(slide, r=None, c=0):
+    """
+    Histogram of a channel stored in the slide, read once per process
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :param r: resolution level - defaults to the segmentation level
+    :type r: int
+    :param c: channel
+    :type c: int
+    :returns read only numpy array
+    """
+    if r is None:
+        r = slide.segmentation_level
+
+    key = _key(slide, 'histogram', r, c)
+    hist = _cache.get(key)
+    if hist is None:
+        hist = slide.get_histogram(r=r, c=c)
+        hist.flags.writeable = False
+        _cache.put(key, hist)
+    return hist
+
+
+def bin_centers(slide, r=None, c=0):
+    """
+    Intensity of each bin of the stored histogram of a channel,
+    spread evenly between HistogramMin and HistogramMax - for an
+    8 bit slide bin i is intensity i
+
+    :returns numpy array or None if the range is not stored, in
+    which case bin i is taken to be intensity i
+    """
+    hist_range = slide.histogram_range(r=r, c=c)
+    if hist_range is None:
+        return None
+    return np.linspace(hist_range[0], hist_range[1], histogram(slide, r, c).size)
+
+
+def histograms(slide, r=None):
+    """
+    :returns list of the histograms of every channel
+    """
+    return [histogram(slide, r, c) for c in range(slide.size_c)]
+
+
+def set_budget(nbytes):
+    """
+    Sets the number of bytes the cache may hold - 0 disables it
+    """
+    _cache.budget = nbytes
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    """
+    :returns dict of cache hits, misses and bytes held
+    """
+    return _cache.stats
@@ -0,0 +1,228 @@
+import os
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from .slide import SlideImage
+
+
+# the slide opened by each worker process
+_worker_slide = None
+
+
+def _init_worker(filepath):
+    """
+    Runs once in every worker - each worker has its own
+    read only HDF5 handle to the slide
+    """
+    global _worker_slide
+    _worker_slide = SlideImage(filepath)
+
+
+def _read_into_shared(name, shape, dtype, region, offset, r, c, t):
+    """
+    Decode a region in a worker and copy the pixels into a
+    block of shared memory owned by the parent process
+
+    :returns number of chunks decoded
+    """
+    shm = SharedMemory(name=name)
+    try:
+        before = _worker_slide.chunk_reads
+        pix = _worker_slide.read_region(region, r, c, t)
+        if pix is None:
+            raise IOError(
+                'Could not read region {} of level {} channel {}'.
+                format(region, r, c)
+            )
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        y, x = offset
+        view[y: y + pix.shape[0], x: x + pix.shape[1]] = pix
+        del view
+        return _worker_slide.chunk_reads - before
+    finally:
+        shm.close()
+
+
+class ParallelReader:
+    """
+    Reads pixel data from a slide using a pool of processes.
+
+    HDF5 does not allow a file to be read from several threads
+    so each worker process opens its own handle to the slide.
+    Regions are split into chunk aligned tiles which are decoded
+    by the workers and handed back through shared memory.
+
+    Can be used as follows:
+    with SlideImage(path) as slide:
+        with ParallelReader(slide, workers=8) as reader:
+            pix = reader.read_region(region, r, c)
+
+    """
+    def __init__(self, slide, workers=None, tile_size=(1024, 1024)):
+        """
+        Constructor
+
+        :param slide: SlideImage instance used for the slide geometry
+        :type slide: SlideImage class instance
+        :param workers: number of worker processes - defaults to the
+        number of cores
+        :type workers: int
+        :param tile_size: minimum yx size of the tiles given to workers
+        :type tile_size: tuple
+        """
+        self.slide = slide
+        self.workers = workers or os.cpu_count() or 1
+        self.tile_size = tile_size
+        # number of regions in flight when streaming
+        self.window = 2 * self.workers
+        self.chunk_reads = 0
+        ctx = mp.get_context('spawn')
+        self.pool = ctx.Pool(
+            self.workers, initializer=_init_worker,
+            initargs=(slide.filepath,)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shut down the worker processes
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _clipped_shape(self, region, r, c, t):
+        """
+        Shape of a region clipped to the stored extent of the
+        dataset, matching SlideImage.read_region
+        """
+        rows, cols = self.slide._dataset(r, t, c).shape[-2:]
+        h = min(region[1] + region[3], rows) - region[1]
+        w = min(region[0] + region[2], cols) - region[0]
+        return (max(h, 0), max(w, 0))
+
+    def _submit(self, tiles, region, r, c, t):
+        """
+        Allocate shared memory for a region and hand its tiles
+        to the workers
+
+        :returns tuple of shared memory, shape, dtype and async results
+        """
+        dtype = self.slide._dataset(r, t, c).dtype
+        shape = self._clipped_shape(region, r, c, t)
+        nbytes = shape[0] * shape[1] * dtype.itemsize
+        if nbytes == 0:
+            return (None, shape, dtype, [])
+
+        shm = SharedMemory(create=True, size=nbytes)
+        results = []
+        for x, y, w, h in tiles:
+            offset = (y - region[1], x - region[0])
+            results.append(self.pool.apply_async(
+                _read_into_shared,
+                (shm.name, shape, dtype.str, (x, y, w, h), offset, r, c, t)
+            ))
+        return (shm, shape, dtype, results)
+
+    def _collect(self, job, out=None):
+        """
+        Wait for the tiles of a region and copy the pixels out
+        of shared memory
+
+        :returns pixels of the region as numpy array
+        """
+        shm, shape, dtype, results = job
+        if shm is None:
+            return np.empty(shape, dtype=dtype) if out is None else out
+        try:
+            for result in results:
+                self.chunk_reads += result.get()
+            view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            if out is None:
+                out = view.copy()
+            else:
+                out[:shape[0], :shape[1]] = view
+            del view
+        finally:
+            shm.close()
+            shm.unlink()
+        return out
+
+    def read_region(self, region, r, c, t=0, out=None):
+        """
+        Get pixel data for a region, decoded in parallel
+
+        :param region: x, y, w, h of the region to access
+        :type region: list
+        :param r: resolution level
+        :type r: int
+        :param c: channel
+        :type c: int
+        :param t: time point
+        :type t: int
+        :param out: optional array of shape (h, w) to copy into
+        :type out: numpy array
+        :returns pixels of selected region as numpy array
+        """
+        tiles = self.slide.aligned_tiles(region, r, c, t, self.tile_size)
+        return self._collect(self._submit(tiles, region, r, c, t), out)
+
+    def read_multichannel_region(self, r, t=0, region=None, out=None):
+        """
+        Get pixel data for all channels of a region, decoded
+        in parallel
+
+        :returns pixels of selected region as numpy array
+        """
+        if region is None:
+            l_size = self.slide.level_dimensions(r)
+            region = [0, 0, l_size[-2], l_size[-1]]
+
+        size_c = self.slide.size_c
+        if out is None:
+            dtype = self.slide._dataset(r, t, 0).dtype
+            out = np.zeros((size_c, region[-1], region[-2]), dtype=dtype)
+
+        # submit every channel before waiting on any of them
+        jobs = []
+        for c in range(size_c):
+            tiles = self.slide.aligned_tiles(region, r, c, t, self.tile_size)
+            jobs.append(self._submit(tiles, region, r, c, t))
+        for c, job in enumerate(jobs):
+            self._collect(job, out[c])
+        return out
+
+    def imap_regions(self, regions, r, c, t=0):
+        """
+        Read a sequence of regions, keeping up to self.window
+        of them being decoded ahead of the caller
+
+        :param regions: iterable of x, y, w, h regions
+        :returns generator of numpy arrays in the order given
+        """
+        pending = deque()
+        try:
+            for region in regions:
+                region = list(region)
+                pending.append(self._submit([region], region, r, c, t))
+                if len(pending) >= self.window:
+                    yield self._collect(pending.popleft())
+            while pending:
+                yield self._collect(pending.popleft())
+        finally:
+            # release anything left if the caller stops early
+            for shm, _, _, results in pending:
+                if shm is not None:
+                    for result in results:
+                        result.wait()
+                    shm.close()
+                    shm.unlink()
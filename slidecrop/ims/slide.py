@@ -1,9 +1,16 @@
 import os
+import copy
 import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import h5py
 import numpy as np
-        
+
+from .cache import LRUCache
+from .chunks import ChunkDecoder
+from .index import build_index, load_index, save_index
+
 
 class SlideImage:
     """
@@ -20,18 +27,54 @@ class SlideImage:
     2. with SlideImage(path) as slide:
         # process
 
+    Decoded chunks can optionally be kept in a memory bounded
+    LRU cache so that overlapping reads are not decompressed
+    again, e.g. SlideImage(path, cache_bytes=512 * 2**20).
+
+    Structure, metadata and histograms are read once and kept
+    in an index file (see ims.index) so that reopening a slide
+    does not touch the HDF5 attributes again. The HDF5 file is
+    only opened once pixel data is needed.
+
+    In the 'raw' read mode the compressed bytes of each chunk are
+    read directly (one at a time, under a lock) and decompressed
+    on a pool of threads, so a single process can use several
+    cores while cropping, e.g. SlideImage(path, read_mode='raw').
+
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_bytes=0, use_index=True,
+                 index_dir=None, read_mode='hdf5', decode_threads=None):
         """
         Constructor
         :param filepath: path to the slide image in *.ims format
         :type filepath: str
-        """
+        :param cache_bytes: budget of the decoded chunk cache,
+        0 disables the cache
+        :type cache_bytes: int
+        :param use_index: load (or create) the slide index
+        :type use_index: bool
+        :param index_dir: directory holding index files - default
+        is $SLIDECROP_INDEX_DIR or ~/.slidecrop/index
+        :type index_dir: str
+        :param read_mode: 'hdf5' to let HDF5 decode chunks or 'raw'
+        to decode them on a thread pool
+        :type read_mode: str
+        :param decode_threads: number of decode threads in raw mode -
+        defaults to the number of cores
+        :type decode_threads: int
+        """
+        if read_mode not in ('hdf5', 'raw'):
+            raise ValueError('read_mode must be hdf5 or raw')
+
         if filepath.endswith('ims') and os.path.exists(filepath):
             self.filepath = filepath
             self.filename = os.path.basename(filepath)
             self.basename = os.path.splitext(self.filename)[0]
-            self.slide = h5py.File(filepath,'r')
+            self._h5 = None
+            self.is_closed = False
+            self._index = None
+            if use_index:
+                self._index = load_index(filepath, index_dir)
             self._size_r = self.size_r
             self._size_c = self.size_c
             self._size_t = self.size_t
@@ -39,7 +82,16 @@ class SlideImage:
             self._crop_level = 0
             self._scale_factor = self.scale_factor
             self._microscope_mode = ''
-            self.is_closed = False
+            self.chunk_reads = 0
+            self.chunk_cache = LRUCache(cache_bytes)
+            self.read_mode = read_mode
+            self.decode_threads = decode_threads
+            self._decoders = {}
+            self._executor = None
+            self._raw_lock = threading.Lock()
+            if use_index and self._index is None:
+                self._index = build_index(self)
+                save_index(self._index, index_dir)
         else:
             raise IOError('File does not exist or is not an ims file')
 
@@ -47,21 +99,41 @@ class SlideImage:
         return self
 
     def __exit__(self, type, value, traceback):
-        self.slide.close()
+        self.close()
+
+    @property
+    def slide(self):
+        """
+        h5py file handle - created on first use
+
+        :returns h5py File
+        """
+        if self._h5 is None:
+            if self.is_closed:
+                raise ValueError('The slide has been closed - reopen it with open()')
+            self._h5 = h5py.File(self.filepath, 'r')
+            self.is_closed = False
+        return self._h5
 
     def open(self):
         """
         Create an h5py file handle
         """
         if self.filepath and self.is_closed:
-            self.slide = h5py.File(self.filepath,'r')
+            self._h5 = h5py.File(self.filepath, 'r')
             self.is_closed = False
             
     def close(self):
         """
         Close the HDF5 file handle
         """
-        self.slide.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+        self._decoders = {}
         self.is_closed = True
 
     def get_histogram(self, r=None, t=0, c=0):
@@ -80,6 +152,8 @@ class SlideImage:
             r = self.segmentation_level
 
         if r <= self._size_r - 1:
+            if self._index is not None and t == 0:
+                return np.array(self._index['histograms'][r][c], dtype=np.uint64)
             histpath = (
                 '/DataSet/ResolutionLevel {0}/TimePoint {1}/Channel {2}/'.
                 format(r, t, c)
@@ -87,6 +161,31 @@ class SlideImage:
             hist = self.slide[histpath]['Histogram'][:]
             return hist
 
+    def histogram_range(self, r=None, c=0):
+        """
+        Intensities of the first and last bins of the stored
+        histogram of a channel - 0 and 255 for 8 bit slides
+
+        :param r: resolution level
+        :type r: int
+        :param c: channel
+        :type c: int
+        :returns list of min and max or None if they are not stored
+        """
+        if r is None:
+            r = self.segmentation_level
+        if self._index is not None and 'histogram_ranges' in self._index:
+            return self._index['histogram_ranges'][r][c]
+
+        group = self.slide[
+            '/DataSet/ResolutionLevel {0}/TimePoint 0/Channel {1}'.format(r, c)
+        ]
+        lo = group.attrs.get('HistogramMin')
+        hi = group.attrs.get('HistogramMax')
+        if lo is None or hi is None:
+            return None
+        return [float(self._bytes_to_str(lo)), float(self._bytes_to_str(hi))]
+
     def level_dimensions(self, r):
         """
         xy dimensions (pixels) for a resolution level
@@ -95,6 +194,8 @@ class SlideImage:
         :returns tuple of xy size
         """
         if r <= self._size_r - 1:
+            if self._index is not None:
+                return tuple(self._index['level_dimensions'][r])
             path = '/DataSet/ResolutionLevel {}/TimePoint 0/'.format(r)
             folder = 'Channel 0'
             size_x_bytes = self.slide[path + folder].attrs.get('ImageSizeX')
@@ -121,12 +222,17 @@ class SlideImage:
                 'exist in the slide image'
             )
         
-    def read_region(self, region, r, c, t=0):
+    def read_region(self, region, r, c, t=0, out=None):
         """
         Get pixel data from the *.ims image
         Note that the data is stored in the HDF5 image
         as chunks. This plays no role in data access.
 
+        Pixels are returned in the dtype they are stored in.
+        If an output array is supplied the pixels are read
+        straight into it (without an intermediate copy) and
+        any part of it outside the stored extent is left as is.
+
         :param r: resolution level
         :type r: int
         :param c: channel
@@ -135,41 +241,293 @@ class SlideImage:
         :type t: int
         :param region: x, y, w, h of the region to access
         :type regions: list
+        :param out: optional C-contiguous array of shape (h, w)
+        :type out: numpy array
         :returns pixels of selected region as numpy array
         """
         # region should be x0, y0, w, h
-        impath = (
-            '/DataSet/ResolutionLevel {0}/TimePoint {1}/Channel {2}'.
-            format(r, t, c)
-        )
         try:
-            data = self.slide[impath]['Data']
+            data = self._dataset(r, t, c)
+            if self.chunk_cache.enabled or self.read_mode == 'raw':
+                return self._read_chunked_region(data, region, r, c, t, out)
+            rows, cols = data.shape[-2:]
             row_min = region[1]
             col_min = region[0]
-            row_max = region[1] + region[3]
-            col_max = region[0] + region[2]
-            return data[0, row_min:row_max, col_min: col_max]
+            row_max = min(region[1] + region[3], rows)
+            col_max = min(region[0] + region[2], cols)
+            if out is None:
+                pix = data[0, row_min:row_max, col_min: col_max]
+            else:
+                h = max(row_max - row_min, 0)
+                w = max(col_max - col_min, 0)
+                if h and w:
+                    data.read_direct(
+                        out,
+                        np.s_[0, row_min:row_max, col_min:col_max],
+                        np.s_[0:h, 0:w]
+                    )
+                pix = out
+            self.chunk_reads += len(self.chunks_in_region(region, r, c, t))
+            return pix
         except:
             return None
 
-    def read_multichannel_region(self, r, t=0, region=None):
+    def _read_chunked_region(self, data, region, r, c, t, out=None):
+        """
+        Private method used to assemble a region from whole
+        chunks. Chunks are taken from the chunk cache when it is
+        enabled, otherwise they are decoded by HDF5 or - in raw
+        read mode - on the decode thread pool.
+
+        :returns pixels of selected region as numpy array
+        """
+        rows, cols = data.shape[-2:]
+        ch, cw = data.chunks[-2:] if data.chunks else (rows, cols)
+        row_min = region[1]
+        col_min = region[0]
+        row_max = min(region[1] + region[3], rows)
+        col_max = min(region[0] + region[2], cols)
+        pix = out
+        if pix is None:
+            pix = np.empty(
+                (max(row_max - row_min, 0), max(col_max - col_min, 0)),
+                dtype=data.dtype
+            )
+
+        decoder = None
+        if self.read_mode == 'raw':
+            decoder = self._chunk_decoder(data, r, t, c)
+
+        # start decoding every missing chunk before copying any
+        blocks = []
+        for cr, cc in self.chunks_in_region(region, r, c, t):
+            key = (r, t, c, (cr, cc))
+            block = None
+            if self.chunk_cache.enabled:
+                block = self.chunk_cache.get(key)
+            if block is None:
+                if decoder is not None:
+                    block = self._decode_pool().submit(
+                        self._read_raw_chunk, data, decoder, (cr, cc)
+                    )
+                else:
+                    block = data[0, cr * ch:(cr + 1) * ch, cc * cw:(cc + 1) * cw]
+                    self._chunk_decoded(key, block)
+            blocks.append(((cr, cc), block))
+
+        for (cr, cc), block in blocks:
+            if isinstance(block, Future):
+                block = block.result()
+                self._chunk_decoded((r, t, c, (cr, cc)), block)
+
+            y0 = max(cr * ch, row_min)
+            y1 = min((cr + 1) * ch, row_max)
+            x0 = max(cc * cw, col_min)
+            x1 = min((cc + 1) * cw, col_max)
+            pix[y0 - row_min:y1 - row_min, x0 - col_min:x1 - col_min] = (
+                block[y0 - cr * ch:y1 - cr * ch, x0 - cc * cw:x1 - cc * cw]
+            )
+        return pix
+
+    def _chunk_decoded(self, key, block):
+        """
+        Private method used to count a decoded chunk and
+        add it to the cache
+        """
+        self.chunk_reads += 1
+        if self.chunk_cache.enabled:
+            self.chunk_cache.put(key, block)
+
+    def _chunk_decoder(self, data, r, t, c):
+        """
+        Private method used to get the raw chunk decoder for a
+        dataset
+
+        :returns ChunkDecoder or None if the dataset can only
+        be read through HDF5
+        """
+        key = (r, t, c)
+        if key not in self._decoders:
+            try:
+                self._decoders[key] = ChunkDecoder(data)
+            except ValueError:
+                self._decoders[key] = None
+        return self._decoders[key]
+
+    def _decode_pool(self):
+        """
+        Private method used to get (or start) the decode threads
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.decode_threads)
+        return self._executor
+
+    def _read_raw_chunk(self, data, decoder, index):
+        """
+        Private method used to read the compressed bytes of a
+        chunk and decode them. Only the read is serialised - the
+        decompression runs in parallel on the decode threads.
+
+        :returns chunk as 2D numpy array
+        """
+        offset = (0, index[0] * decoder.shape[-2], index[1] * decoder.shape[-1])
+        with self._raw_lock:
+            try:
+                filter_mask, raw = data.id.read_direct_chunk(offset)
+            except (KeyError, ValueError, RuntimeError):
+                # chunk was never written
+                filter_mask, raw = 0, None
+        return decoder.decode(raw, filter_mask)[0]
+
+    @property
+    def cache_budget(self):
+        """
+        :returns byte budget of the decoded chunk cache
+        """
+        return self.chunk_cache.budget
+
+    @cache_budget.setter
+    def cache_budget(self, value):
+        """
+        Sets the byte budget of the decoded chunk cache,
+        0 disables it
+        """
+        self.chunk_cache.budget = value
+
+    @property
+    def cache_stats(self):
+        """
+        :returns dict of chunk cache hits, misses and bytes held
+        """
+        return self.chunk_cache.stats
+
+    def chunk_shape(self, r, c=0, t=0):
+        """
+        Shape of the HDF5 chunks holding the pixel data of a
+        resolution level and channel. Any read touching part of
+        a chunk has to decompress all of it.
+
+        :param r: resolution level
+        :type r: int
+        :param c: channel
+        :type c: int
+        :param t: time point
+        :type t: int
+        :returns tuple of yx chunk size or None if not chunked
+        """
+        chunks = self._dataset(r, t, c).chunks
+        if chunks is None:
+            return None
+        return tuple(chunks[-2:])
+
+    def aligned_tiles(self, region, r, c=0, t=0, tile_size=(1024, 1024)):
+        """
+        Split a region into read tiles whose edges line up with
+        the chunk grid of the dataset. The tile size is padded
+        out to whole chunks so every chunk falls in one tile.
+
+        :param region: x, y, w, h of the region
+        :type region: list
+        :param r: resolution level
+        :type r: int
+        :param c: channel
+        :type c: int
+        :param t: time point
+        :type t: int
+        :param tile_size: minimum yx tile size
+        :type tile_size: tuple
+        :returns list of x, y, w, h tiles
+        """
+        th, tw = tile_size
+        chunks = self.chunk_shape(r, c, t)
+        if chunks is not None:
+            th = int(math.ceil(float(th) / chunks[0])) * chunks[0]
+            tw = int(math.ceil(float(tw) / chunks[1])) * chunks[1]
+
+        x0, y0 = region[0], region[1]
+        x1, y1 = x0 + region[2], y0 + region[3]
+        tiles = []
+        for tile_y in range((y0 // th) * th, y1, th):
+            y = max(tile_y, y0)
+            h = min(tile_y + th, y1) - y
+            for tile_x in range((x0 // tw) * tw, x1, tw):
+                x = max(tile_x, x0)
+                w = min(tile_x + tw, x1) - x
+                tiles.append((x, y, w, h))
+        return tiles
+
+    def chunks_in_region(self, region, r, c=0, t=0):
+        """
+        Indices of the chunks a region overlaps, clipped to the
+        stored extent of the dataset
+
+        :param region: x, y, w, h of the region
+        :type region: list
+        :param r: resolution level
+        :type r: int
+        :param c: channel
+        :type c: int
+        :param t: time point
+        :type t: int
+        :returns list of (row, col) chunk indices
+        """
+        data = self._dataset(r, t, c)
+        rows, cols = data.shape[-2:]
+        chunks = data.chunks[-2:] if data.chunks else (rows, cols)
+        row_min = max(region[1], 0)
+        col_min = max(region[0], 0)
+        row_max = min(region[1] + region[3], rows)
+        col_max = min(region[0] + region[2], cols)
+        if row_max <= row_min or col_max <= col_min:
+            return []
+        return [
+            (cr, cc)
+            for cr in range(row_min // chunks[0], (row_max - 1) // chunks[0] + 1)
+            for cc in range(col_min // chunks[1], (col_max - 1) // chunks[1] + 1)
+        ]
+
+    def read_multichannel_region(self, r, t=0, region=None, out=None):
+        """
+        Get pixel data for all channels of a region
+
+        :param r: resolution level
+        :type r: int
+        :param t: time point
+        :type t: int
+        :param region: x, y, w, h of the region to access
+        :type regions: list
+        :param out: optional C-contiguous array of shape (c, h, w)
+        that the pixels are read into
+        :type out: numpy array
+        :returns pixels of selected region as numpy array in
+        the dtype of the stored data
+        """
         if r >= 0 and r <= self._size_r - 1:
             if region is None:
                 l_size = self.level_dimensions(r)
                 region = [0, 0, l_size[-2], l_size[-1]]
 
-            pix = np.zeros((self.size_c, region[-1], region[-2]))
-            for c in range(self.size_c):
-                pix[c, :, :] = self.read_region(region, r, c)
-            
-            return pix
+            shape = (self._size_c, region[-1], region[-2])
+            if out is None:
+                dtype = self._dataset(r, t, 0).dtype
+                out = np.zeros(shape, dtype=dtype)
+            elif out.shape != shape:
+                raise ValueError(
+                    'out has shape {} but the region needs {}'.
+                    format(out.shape, shape)
+                )
+
+            for c in range(self._size_c):
+                self.read_region(region, r, c, t, out=out[c])
+
+            return out
         else:
             raise IOError(
                 'resolution level specified does not'
                 'exist in the slide image'
             )
 
-    def low_resolution_image(self, r=None):
+    def low_resolution_image(self, r=None, out=None):
         """
         Get the whole slide image from the level
         specified or whichever level is currently
@@ -177,6 +535,8 @@ class SlideImage:
 
         :param r: resolution level
         :type r: int
+        :param out: optional array of shape (c, h, w) to read into
+        :type out: numpy array
         :returns whole slide image as numpy array
         """        
         if r is None:
@@ -185,7 +545,7 @@ class SlideImage:
         if r <= self._size_r - 1:
             l_size = self.level_dimensions(r)
             region = [0, 0, l_size[-2], l_size[-1]]
-            low_res = self.read_multichannel_region(r, region=region)
+            low_res = self.read_multichannel_region(r, region=region, out=out)
             return low_res
         else:
             raise IOError(
@@ -228,6 +588,19 @@ class SlideImage:
             for i in range(level_count)
         )
 
+    def _dataset(self, r, t, c):
+        """
+        Private method used to get the HDF5 dataset holding
+        the pixels of a resolution level, time point and channel
+
+        :returns h5py dataset
+        """
+        impath = (
+            '/DataSet/ResolutionLevel {0}/TimePoint {1}/Channel {2}'.
+            format(r, t, c)
+        )
+        return self.slide[impath]['Data']
+
     def _bytes_to_int(self, byte_list):
         """
         Integer values are stored in HDF metadata as byte strings
@@ -252,6 +625,8 @@ class SlideImage:
 
         :returns number of resolution levels
         """
+        if self._index is not None:
+            return self._index['size_r']
         levels = len(self.slide['/DataSet'])
         return levels if levels is not None else 0
 
@@ -261,7 +636,9 @@ class SlideImage:
         Number of slide channels
 
         :returns number of channels
-        """        
+        """
+        if self._index is not None:
+            return self._index['size_c']
         channels = len(self.slide['/DataSet/ResolutionLevel 0/TimePoint 0/'])
         return channels if channels is not None else 0
 
@@ -271,7 +648,9 @@ class SlideImage:
         Number of slide time points (usually 1)
 
         :returns number of time points
-        """        
+        """
+        if self._index is not None:
+            return self._index['size_t']
         time_points = len(self.slide['/DataSet/ResolutionLevel 0/'])
         return time_points if time_points is not None else 0
 
@@ -280,6 +659,8 @@ class SlideImage:
         """
         :returns list of channel names
         """
+        if self._index is not None:
+            return list(self._index['channel_names'])
         names = []
         for channel in range(self._size_c):
             c = 'Channel {}'.format(channel)
@@ -293,6 +674,8 @@ class SlideImage:
         """
         :returns list of channel colors
         """
+        if self._index is not None:
+            return [list(color) for color in self._index['channel_colors']]
         colors = []
         for channel in range(self._size_c):
             c = 'Channel {}'.format(channel)
@@ -374,8 +757,11 @@ class SlideImage:
         """
         :returns microscope modality 'bright' or 'fluoro'
         """
-        mm = self.slide['DataSetInfo/Image'].attrs.get('MicroscopeMode')
-        mm = self._bytes_to_str(mm)
+        if self._index is not None:
+            mm = self._index['attributes']['MicroscopeMode']
+        else:
+            mm = self.slide['DataSetInfo/Image'].attrs.get('MicroscopeMode')
+            mm = self._bytes_to_str(mm)
         if 'MetaCyte TL' in mm:
             self._microscope_mode = 'bright'
         elif 'MetaCyte FL' in mm:
@@ -394,13 +780,16 @@ class SlideImage:
             attributes[attr[0]] = self._bytes_to_str(attr[-1])
         return attributes
 
-    @property
-    def metadata(self):
+    def _attributes(self):
         """
-        Extracts all group attributes from HDF file.
+        Private method used to collect the attributes of the
+        channel and image groups from the HDF file (or index).
 
         :returns dict of attributes
-        """        
+        """
+        if self._index is not None:
+            return copy.deepcopy(self._index['attributes'])
+
         # as key, value pairs
         metadata = {}
         # DataSetInfo/Channel
@@ -421,7 +810,16 @@ class SlideImage:
 
         for group in groups:
             metadata.update(self._group_attributes(group))
+        return metadata
+
+    @property
+    def metadata(self):
+        """
+        Extracts all group attributes from HDF file.
 
+        :returns dict of attributes
+        """
+        metadata = self._attributes()
         metadata['crop_scale_factor'] = self.scale_factor
         slidex = float(metadata['ExtMax0']) - float(metadata['ExtMin0'])
         slidey = float(metadata['ExtMax1']) - float(metadata['ExtMin1'])
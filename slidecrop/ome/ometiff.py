@@ -1,15 +1,13 @@
 import os
-from math import floor
-from tempfile import mkdtemp
+from math import ceil
 import os.path as path
 import datetime
 from uuid import uuid4 as uuid
 
 import numpy as np
-from tifffile import memmap, imwrite
-from matplotlib import pyplot as plt
+from tifffile import imwrite, TiffWriter
 
-from .omexml import OMEXML
+from .omexml import OMEXML, PT_DOUBLE, PT_FLOAT
 
 comment = """<!-- Warning: this comment is an OME-XML metadata block, which contains"
                   crucial dimensional parameters and other important metadata. Please edit
@@ -23,6 +21,20 @@ def xsd_now():
 
 DEFAULT_NOW = xsd_now()
 
+# compression options and the matching tifffile codec
+COMPRESSION = {
+    None: None,
+    'deflate': 'zlib',
+    'zstd': 'zstd',
+    'lzw': 'lzw'
+}
+
+# OME pixel types whose names differ from the numpy ones
+PIXEL_TYPES = {
+    'float32': PT_FLOAT,
+    'float64': PT_DOUBLE
+}
+
 NS_DEFAULT = "http://www.openmicroscopy.org/Schemas/{ns_key}/2016-06"
 
 default_xml = """<?xml version="1.0" encoding="UTF-8"?>
@@ -58,7 +70,8 @@ class OMETiffGenerator:
     cropped from an slide scanner image (*.ims format)
     """    
     def __init__(self, slide, filename, outputdir, 
-                 channels, level, rotation):
+                 channels, level, rotation, reader=None, pyramid=False,
+                 compression=None, encode_workers=None, cancel=None):
         """
         Constructor
 
@@ -75,7 +88,26 @@ class OMETiffGenerator:
         :type level: int
         :param rotation: the rotation to applied when writing
         :type rotation: int
+        :param reader: optional ParallelReader used to decode
+        pixels on several processes
+        :type reader: ParallelReader class instance
+        :param pyramid: also write the lower resolution levels
+        of the slide as SubIFDs
+        :type pyramid: bool
+        :param compression: 'deflate', 'zstd', 'lzw' or None
+        for uncompressed output
+        :type compression: str
+        :param encode_workers: number of threads encoding tiles -
+        None lets tifffile decide
+        :type encode_workers: int
+        :param cancel: optional CancelToken checked between tiles -
+        a cancelled file is removed
+        :type cancel: CancelToken class instance
         """
+        if compression not in COMPRESSION:
+            raise ValueError(
+                'compression must be one of {}'.format(list(COMPRESSION))
+            )
         self.slide = slide
         self.filename = filename
         print(self.filename)
@@ -86,6 +118,22 @@ class OMETiffGenerator:
         self.tile_width = 1024
         self.tile_height = 1024
         self.channels = channels
+        self.reader = reader
+        self.pyramid = pyramid
+        self.compression = compression
+        self.encode_workers = encode_workers
+        self.cancel = cancel
+        # smallest pyramid level written (pixels along the longest side)
+        self.pyramid_min_size = 256
+
+    @property
+    def dtype(self):
+        """
+        :returns numpy dtype the pixels are stored in, which they
+        are written in too
+        """
+        channels = self.channels if isinstance(self.channels, list) else [self.channels]
+        return self.slide._dataset(self.crop_level, 0, channels[0]).dtype
 
     def get_num_channels(self):
         """
@@ -104,6 +152,8 @@ class OMETiffGenerator:
         :returns pixels being written as numpy array
         """
         roi = [x + self.roi[0], y + self.roi[1], w, h]
+        if self.reader is not None:
+            return self.reader.read_region(roi, self.crop_level, channel)
         return self.slide.read_region(
             roi, self.crop_level, channel
         )
@@ -162,6 +212,9 @@ class OMETiffGenerator:
         xml.image().Pixels.SizeX = str(self.size_x)
         xml.image().Pixels.SizeY = str(self.size_y)
         xml.image().Pixels.SizeZ = '1'
+        xml.image().Pixels.PixelType = PIXEL_TYPES.get(
+            self.dtype.name, self.dtype.name
+        )
         xml.image().Pixels.PhysicalSizeX = metadata['crop_xresolution']
         xml.image().Pixels.PhysicalSizeY = metadata['crop_yresolution']
         xml.image().Pixels.PhysicalSizeZ = metadata['crop_zresolution']
@@ -190,64 +243,265 @@ class OMETiffGenerator:
 
         return xml.to_xml()
 
-    def write_tiles(self):
+    def write_tiles(self, tiles=None):
         """
         If the region cropped has a size in pixels
         above 4096 in any dimension the *.ome.tiff will
-        be written as tiled data using a numpy memmap.
-        Writing of the *.ome.tiff is done using tifffile.
-
+        be written as tiled data. Tiles are streamed to the
+        file in order by tifffile so only a few tiles (and
+        one row of chunks) are held in memory however large
+        the region is.
+
+        The number of chunks decompressed while writing is kept
+        in self.chunk_reads and the number of distinct chunks
+        the region spans in self.chunk_count - the two match
+        when no chunk is decoded more than once.
+
+        :param tiles: optional iterator of tiles (channel by channel,
+        row major) supplied by the caller instead of being read here
         :returns number of tiles written
         """
-        tw = self.tile_width
+        # TODO: apply rotation
+        region = [self.roi[0], self.roi[1], self.size_x, self.size_y]
+        if tiles is not None:
+            return self._write_tiled([(self.crop_level, region)], tiles)
+
+        self.chunk_count = sum(
+            len(self.slide.chunks_in_region(region, self.crop_level, c))
+            for c in self.channels
+        )
+        source = self.reader if self.reader is not None else self.slide
+        reads_before = source.chunk_reads
+        tile_count = self._write_tiled([(self.crop_level, region)])
+        self.chunk_reads = source.chunk_reads - reads_before
+        return tile_count
+
+    def _level_regions(self):
+        """
+        The region being written in the crop level and in every
+        lower resolution level of the slide that is large enough
+        to be worth adding to the pyramid. Lower levels are
+        scaled with the level downsample rather than recomputed.
+
+        :returns list of (level, [x, y, w, h]) tuples
+        """
+        region = [self.roi[0], self.roi[1], self.size_x, self.size_y]
+        levels = [(self.crop_level, region)]
+        base = float(self.slide.get_level_downsample(self.crop_level))
+        for level in range(self.crop_level + 1, self.slide.size_r):
+            ds = self.slide.get_level_downsample(level) / base
+            w = int(ceil(self.size_x / ds))
+            h = int(ceil(self.size_y / ds))
+            if max(w, h) < self.pyramid_min_size:
+                break
+            levels.append(
+                (level, [int(region[0] // ds), int(region[1] // ds), w, h])
+            )
+        return levels
+
+    def _tile_plan(self, region, chunks):
+        """
+        Geometry of the streaming writer. For every output tile,
+        in row major order, gives the tile and the block of the
+        slide to read for it. Block edges lie on the chunk grid
+        (or the region edge) and the blocks cover the region
+        exactly once, so no chunk is decoded twice. Rows and
+        columns read beyond a tile are kept for the next tiles.
+
+        :param region: x, y, w, h of the region
+        :type region: list
+        :param chunks: yx chunk shape
+        :type chunks: tuple
+        :returns list of (band_y, band_end, read_y, strip_end,
+        x, x_end, read_x, col_end) tuples
+        """
         th = self.tile_height
-        size_x = self.size_x
-        size_y = self.size_y
-        size_c = self.size_c
+        tw = self.tile_width
+        ch, cw = chunks
+        x0, y0 = region[0], region[1]
+        x1, y1 = x0 + region[2], y0 + region[3]
+        plan = []
+        read_y = y0
+        for band_y in range(y0, y1, th):
+            band_end = min(band_y + th, y1)
+            strip_end = max(read_y, min(int(ceil(float(band_end) / ch)) * ch, y1))
+            read_x = x0
+            for x in range(x0, x1, tw):
+                x_end = min(x + tw, x1)
+                col_end = max(read_x, min(int(ceil(float(x_end) / cw)) * cw, x1))
+                plan.append(
+                    (band_y, band_end, read_y, strip_end, x, x_end, read_x, col_end)
+                )
+                read_x = col_end
+            read_y = strip_end
+        return plan
+
+    def _read_blocks(self, level, channel, blocks):
+        """
+        Pixels of each block, zero padded where a block runs past
+        the data stored in the slide. With a ParallelReader the
+        blocks are decoded ahead of the writer by the workers.
 
-        # initialise the numpy memmap
-        fp = memmap(
-            self.outputpath,
-            dtype='uint8',
-            mode='r+',
-            shape=(size_c, size_y, size_x),
-            description=self.xml,
-            photometric='MINISBLACK'
-        )
+        :returns generator of numpy arrays
+        """
+        if self.reader is not None:
+            pixels = self.reader.imap_regions(blocks, level, channel)
+        else:
+            pixels = (
+                self.slide.read_region(block, level, channel)
+                for block in blocks
+            )
+
+        dtype = self.dtype
+        for block, pix in zip(blocks, pixels):
+            out = np.zeros((block[3], block[2]), dtype=dtype)
+            if pix is not None:
+                out[:pix.shape[0], :pix.shape[1]] = pix
+            yield out
+
+    def _iter_channel_tiles(self, level, region, channel):
+        """
+        Output tiles of one channel in row major order
 
-        tile_count = 0
-        for c in range(0, self.size_c):
-            channel = self.channels[c]
+        :param level: resolution level read
+        :type level: int
+        :param region: x, y, w, h of the region in that level
+        :type region: list
+        :param channel: channel read
+        :type channel: int
+        :returns generator of tiles as numpy arrays
+        """
+        chunks = self.slide.chunk_shape(level, channel) or (1, 1)
+        plan = self._tile_plan(region, chunks)
+        blocks = [
+            [read_x, read_y, col_end - read_x, strip_end - read_y]
+            for _, _, read_y, strip_end, _, _, read_x, col_end in plan
+        ]
+
+        x0 = region[0]
+        x1 = region[0] + region[2]
+        dtype = self.dtype
+        # rows [band_y, read_y) already read, across the whole region
+        carry = np.zeros((0, region[2]), dtype=dtype)
+        for item, block in zip(plan, self._read_blocks(level, channel, blocks)):
+            band_y, band_end, read_y, strip_end, x, x_end, read_x, col_end = item
+            if x == x0:
+                # columns [x, read_x) of the rows being read
+                col_carry = np.zeros((strip_end - read_y, 0), dtype=dtype)
+                # rows [band_end, strip_end) kept for the next band
+                next_carry = np.zeros((strip_end - band_end, region[2]), dtype=dtype)
+                if read_y > band_end:
+                    next_carry[:read_y - band_end] = carry[band_end - band_y:]
+
+            tile = np.empty((band_end - band_y, x_end - x), dtype=dtype)
+            top = min(read_y, band_end) - band_y
+            tile[:top] = carry[:top, x - x0: x_end - x0]
+
+            new = np.concatenate((col_carry, block), axis=1)
+            col_carry = new[:, x_end - x:]
+            new = new[:, :x_end - x]
+            tile[top:] = new[:max(band_end - read_y, 0)]
+            next_carry[max(read_y - band_end, 0):, x - x0: x_end - x0] = (
+                new[max(band_end - read_y, 0):]
+            )
+            yield tile
+
+            if x_end == x1:
+                carry = next_carry
+
+    def _iter_tiles(self, level, region):
+        """
+        Output tiles of one resolution level, channel by channel
+        in row major order.
+
+        :param level: resolution level read
+        :type level: int
+        :param region: x, y, w, h of the region in that level
+        :type region: list
+        :returns generator of tiles as numpy arrays
+        """
+        for c in range(self.size_c):
+            for tile in self._iter_channel_tiles(level, region, self.channels[c]):
+                yield tile
 
-            for tile_offset_y in range(0, floor((size_y + th - 1) / th)):
-
-                for tile_offset_x in range(0, floor((size_x + tw - 1) / tw)):
-
-                    x = tile_offset_x * tw
-                    y = tile_offset_y * tw
-                    
-                    w = tw
-                    if (w + x > size_x):
-                        w = size_x - x
-
-                    h = th
-                    if (h + y > size_y):
-                        h = size_y - y
-                    
-                    # get the pixel data out of the SlideImage
-                    chunk = self._get_pixels(channel, x, y, w, h)
-                    print(chunk.shape)
-                    if (w != chunk.shape[-1]) or (h != chunk.shape[-2]):
-                        w = chunk.shape[-1]
-                        h = chunk.shape[-2]
-
-                    # add the data to the memmap
-                    # TODO: apply rotation
-                    fp[c, y: y + h, x: x + w] = chunk[:, :]
-                    fp.flush()
-        del fp
+    def _write_tiled(self, levels, tiles=None):
+        """
+        Stream tiles to a tiled *.ome.tiff. The first level is
+        written to the main IFDs and any others to SubIFDs.
+        When compression is set tiles are encoded by a pool of
+        threads and written to the file in order.
+
+        :param levels: list of (level, [x, y, w, h]) to write
+        :type levels: list
+        :param tiles: optional iterator of the tiles of the first
+        level - by default they are read from the slide
+        :returns number of tiles written
+        """
+        th = self.tile_height
+        tw = self.tile_width
+        nbytes = (
+            sum(r[2] * r[3] for _, r in levels) *
+            self.size_c * self.dtype.itemsize
+        )
+        tile_count = 0
+        with TiffWriter(self.outputpath, bigtiff=nbytes > 2**31, ome=False) as tif:
+            for i, (level, region) in enumerate(levels):
+                options = dict(
+                    shape=(self.size_c, region[3], region[2]),
+                    dtype=self.dtype,
+                    tile=(th, tw),
+                    photometric='minisblack',
+                    compression=COMPRESSION[self.compression],
+                    maxworkers=self.encode_workers,
+                    metadata=None
+                )
+                if i == 0:
+                    options['description'] = self.xml
+                    options['subifds'] = len(levels) - 1
+                else:
+                    options['subfiletype'] = 1
+                if i == 0 and tiles is not None:
+                    data = tiles
+                else:
+                    data = self._iter_tiles(level, region)
+                if self.cancel is not None:
+                    data = self._checked(data)
+                try:
+                    tif.write(data, **options)
+                except:
+                    if self.cancel is not None and self.cancel.cancelled:
+                        tif.close()
+                        os.remove(self.outputpath)
+                    raise
+                tile_count += (
+                    self.size_c *
+                    int(ceil(float(region[3]) / th)) *
+                    int(ceil(float(region[2]) / tw))
+                )
         return tile_count
 
+    def _checked(self, tiles):
+        """
+        Pass tiles through, checking the cancel token before each
+        """
+        for tile in tiles:
+            self.cancel.check()
+            yield tile
+
+    def write_pyramid(self, tiles=None):
+        """
+        Write the crop as a tiled pyramidal *.ome.tiff - the
+        crop level is written to the main IFDs and the matching
+        regions of the lower resolution levels already stored in
+        the slide are written to SubIFDs.
+
+        :param tiles: optional iterator of the crop level tiles
+        :returns number of resolution levels written
+        """
+        levels = self._level_regions()
+        self._write_tiled(levels, tiles)
+        return len(levels)
+
     def write_plane(self):
         """
         If the region cropped has a size in pixels
@@ -259,7 +513,7 @@ class OMETiffGenerator:
         size_y = self.size_y
         size_c = self.size_c
 
-        image_data = np.zeros((size_c, size_y, size_x), dtype=np.uint8)
+        image_data = np.zeros((size_c, size_y, size_x), dtype=self.dtype)
         print('num channels = {}'.format(size_c))
         for c in range(size_c):
 
@@ -282,13 +536,15 @@ class OMETiffGenerator:
             image_data,
             shape=(size_c, size_y, size_x),
             description=self.xml,
-            photometric='MINISBLACK'
+            photometric='MINISBLACK',
+            compression=COMPRESSION[self.compression],
+            maxworkers=self.encode_workers
         )
 
-    def run(self, region):
+    def prepare(self, region):
         """
-        Access point to the class. Determines whether to
-        write tiled data or not.
+        Set the sizes and build the ome-xml for a region
+        without writing any pixels
 
         :param region: x, y, w, h of region to be written to *.ome.tiff
         :type region: list
@@ -302,7 +558,19 @@ class OMETiffGenerator:
         self.roi = region
         self.xml = self.make_xml(self.slide.metadata)
 
-        if self.size_x >= 4096 or self.size_y >= 4096:
+    def run(self, region):
+        """
+        Access point to the class. Determines whether to
+        write tiled data or not.
+
+        :param region: x, y, w, h of region to be written to *.ome.tiff
+        :type region: list
+        """
+        self.prepare(region)
+
+        if self.pyramid:
+            self.write_pyramid()
+        elif self.size_x >= 4096 or self.size_y >= 4096:
             self.write_tiles()
         else:
             self.write_plane()
\ No newline at end of file
@@ -0,0 +1,625 @@
+import os
+import time
+import signal
+import queue
+import traceback
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ..ims.slide import SlideImage
+from ..ims import lowres
+from .multicrop import MultiCrop
+from .segmentation import Segment
+from .threshold import histogram_threshold
+from .threshold_cache import ThresholdCache, threshold_cache
+
+
+# progress queue shared by the worker processes
+_worker_progress = None
+
+
+def _init_worker(progress, pids):
+    """
+    Runs once in every worker - keeps the queue used to send
+    progress back to the parent process and tells the parent
+    the id of the process so it can be stopped
+    """
+    global _worker_progress
+    _worker_progress = progress
+    pids.put(os.getpid())
+
+
+def available_memory():
+    """
+    Physical memory that is currently free
+
+    :returns number of bytes or None if it cannot be found
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# memo of thresholds copied into each scanning worker
+_worker_thresholds = None
+
+
+def _init_scan(items):
+    """
+    Runs once in every scanning worker - keeps a copy of the
+    thresholds the parent process already holds
+    """
+    global _worker_thresholds
+    _worker_thresholds = ThresholdCache()
+    _worker_thresholds.update(items)
+
+
+def _scan_slide(sid, slide_path, method):
+    """
+    Read the channel count of a slide and threshold each of
+    its channels, from their stored histograms, in a worker.
+    Slides thresholded with this method before are answered
+    from the memo.
+
+    :returns tuple of slide id, number of channels, level the
+    histograms were taken from, thresholds, whether they were
+    newly found and the error if the slide could not be read
+    """
+    try:
+        with SlideImage(slide_path) as slide:
+            size_c = slide.size_c
+            level = slide.segmentation_level
+            thresholds = None
+            if _worker_thresholds is not None:
+                thresholds = _worker_thresholds.get_channels(
+                    slide_path, level, method, size_c
+                )
+            if thresholds is not None:
+                return (sid, size_c, level, thresholds, False, None)
+            thresholds = [
+                float(histogram_threshold(
+                    lowres.histogram(slide, c=c), method,
+                    lowres.bin_centers(slide, c=c)
+                ))
+                for c in range(size_c)
+            ]
+            return (sid, size_c, level, thresholds, True, None)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        return (sid, None, None, None, False, error)
+
+
+def scan_slides(slide_paths, method, workers=None, result=None, error=None,
+                cancel=None):
+    """
+    Threshold a list of slides on a pool of processes
+
+    :param slide_paths: path of each slide
+    :type slide_paths: list
+    :param method: auto threshold method
+    :type method: str
+    :param workers: number of worker processes - defaults to the
+    number of cores
+    :type workers: int
+    :param result: optional callable given (slide id, number of
+    channels, thresholds) as soon as each slide is done
+    :type result: function
+    :param error: optional callable given (slide id, error) for
+    each slide that could not be thresholded
+    :type error: function
+    :param cancel: optional CancelToken checked while waiting for
+    each slide - thresholds already found are still memoised
+    :type cancel: CancelToken class instance
+    :returns tuple of lists of channel counts and thresholds
+    in the order of slide_paths - None for slides that could
+    not be thresholded
+    """
+    channels = [None] * len(slide_paths)
+    thresholds = [None] * len(slide_paths)
+    if not slide_paths:
+        return (channels, thresholds)
+
+    # the workers look slides up in a copy of the memo so that
+    # opening them (and building any missing index) is done in
+    # parallel - new thresholds are memoised here and saved once
+    cache = threshold_cache()
+    jobs = [(sid, path, method) for sid, path in enumerate(slide_paths)]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    ctx = mp.get_context('spawn')
+    try:
+        # leaving the pool early terminates the workers
+        with ctx.Pool(workers, _init_scan, (cache.items(),)) as pool:
+            scans = pool.imap_unordered(_scan_star, jobs)
+            for _ in jobs:
+                sid, size_c, level, thresh, fresh, message = \
+                    _next_scan(scans, cancel)
+                if message is not None:
+                    if error is not None:
+                        error(sid, message)
+                    continue
+                if fresh:
+                    cache.put_channels(slide_paths[sid], level, method, thresh)
+                channels[sid] = size_c
+                thresholds[sid] = thresh
+                if result is not None:
+                    result(sid, size_c, thresh)
+    finally:
+        cache.save()
+    return (channels, thresholds)
+
+
+def _next_scan(scans, cancel, poll=0.1):
+    """
+    Wait for the next slide scanned, checking the cancel token
+    every poll seconds so a stop is not held up by a slow slide
+    """
+    if cancel is None:
+        return next(scans)
+    while True:
+        cancel.check()
+        try:
+            return scans.next(timeout=poll)
+        except mp.TimeoutError:
+            pass
+
+
+def _scan_star(args):
+    return _scan_slide(*args)
+
+
+def _chunk_bytes(slide, level):
+    """
+    :returns uncompressed bytes of one chunk of a level
+    """
+    ch, cw = slide.chunk_shape(level, 0) or (1, 1)
+    return ch * cw * slide._dataset(level, 0, 0).dtype.itemsize
+
+
+def _segment_slide(sid, slide_path, channel, threshold):
+    """
+    Segment a slide in a worker
+
+    :returns tuple of slide id, regions as x, y, w, h lists in the
+    crop level, the estimated memory needed to crop them and a
+    dict of the time taken and bytes decoded
+    """
+    tic = time.time()
+    with SlideImage(slide_path) as slide:
+        segmenter = Segment(
+            slide.microscope_mode, slide.scale_factor, channel=channel,
+            thresh_method='manual', threshold=threshold
+        )
+        regions = [list(r[:4]) for r in segmenter.run(lowres.low_resolution_image(slide))]
+        crop = MultiCrop(slide, None, list(range(slide.size_c)))
+        nbytes = crop.working_bytes(regions)
+        stats = {
+            'segment_seconds': time.time() - tic,
+            'segment_bytes_read':
+                slide.chunk_reads * _chunk_bytes(slide, slide.segmentation_level)
+        }
+    return (sid, regions, nbytes, stats)
+
+
+def _section_file(slide_path, rid):
+    """
+    :returns filename of the rid-th section cropped from a slide
+    """
+    basename = os.path.splitext(os.path.basename(slide_path))[0]
+    return basename + '_section_{}.ome.tif'.format(rid)
+
+
+def slide_file_key(filepath):
+    """
+    Size and modification time of a slide - a plan is only
+    run against the file it was made from
+
+    :returns dict
+    """
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _prepare_planned(sid, entry):
+    """
+    Check a planned slide has not changed and estimate the memory
+    needed to crop its regions, in a worker
+
+    :returns tuple matching _segment_slide
+    """
+    if slide_file_key(entry['path']) != entry['file']:
+        raise ValueError(
+            '{} has changed since it was planned'.format(entry['path'])
+        )
+    os.makedirs(entry['output'], exist_ok=True)
+    regions = [r['region'] for r in entry['regions']]
+    with SlideImage(entry['path']) as slide:
+        crop = MultiCrop(slide, None, entry['channels'], entry['crop_level'])
+        nbytes = crop.working_bytes(regions)
+    return (sid, regions, nbytes, {})
+
+
+def _crop_slide(sid, slide_path, outputdir, regions, filenames,
+                channels=None, level=0, rotation=0):
+    """
+    Crop the regions of a slide in a worker, reporting each
+    region to the parent as it is finished. The slide id is sent
+    with no region once the slide is done so that the parent sees
+    it after the progress of every region.
+
+    Each message carries a dict of timings and sizes - for a
+    region the seconds since the crop started and the size of
+    its file, for the slide the time taken and the bytes decoded
+    and written.
+    """
+    tic = time.time()
+    written = [0]
+    with SlideImage(slide_path) as slide:
+
+        def done(rid):
+            nbytes = os.path.getsize(os.path.join(outputdir, filenames[rid]))
+            written[0] += nbytes
+            _worker_progress.put((sid, rid, {
+                'file': filenames[rid],
+                'seconds': time.time() - tic,
+                'bytes_written': nbytes
+            }))
+
+        if channels is None:
+            channels = [c for c in range(slide.size_c)]
+        crop = MultiCrop(slide, outputdir, channels, level, rotation)
+        crop.run(regions, filenames, progress=done)
+        bytes_read = crop.chunk_reads * _chunk_bytes(slide, level)
+    _worker_progress.put((sid, None, {
+        'crop_seconds': time.time() - tic,
+        'bytes_read': bytes_read,
+        'bytes_written': written[0]
+    }))
+
+
+def _crop_with_kwargs(sid, regions, kwargs):
+    return _crop_slide(sid, regions=regions, **kwargs)
+
+
+def _wait_exit(pid):
+    """
+    Wait for a worker process to exit without reaping it, so the
+    pool still sees how it ended - where this cannot be done the
+    pool waits for it when it is shut down
+    """
+    if not hasattr(os, 'waitid'):
+        return
+    try:
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        # already reaped
+        pass
+
+
+def _terminate(pool, pids):
+    """
+    Stop the worker processes of a ProcessPoolExecutor straight
+    away rather than waiting for their jobs to finish, and wait
+    for them to exit so their files are closed
+
+    :param pool: the pool, its workers started with _init_worker
+    :type pool: ProcessPoolExecutor class instance
+    :param pids: queue the workers put their process ids on
+    :type pids: multiprocessing SimpleQueue
+    """
+    workers = set()
+    while not pids.empty():
+        workers.add(pids.get())
+    if hasattr(pool, 'terminate_workers'):
+        pool.terminate_workers()
+    # a worker killed here breaks the pool, which then stops any
+    # worker that had not yet sent its id
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            # already exited
+            pass
+    for pid in workers:
+        _wait_exit(pid)
+
+
+class BatchCrop:
+    """
+    Segments and crops a batch of slides on a pool of processes.
+
+    Every slide is segmented as soon as a worker is free. Its crop
+    is then started once there is room for it in the memory budget,
+    so several large slides are never cropped at the same time if
+    together they would not fit in memory. A slide is always let
+    through when nothing else is being cropped.
+
+    Progress is reported through callables which are run on the
+    thread that calls run() - a QRunnable can pass the emit method
+    of its signals. What happened to each slide (regions, timings,
+    bytes read and written, any error) is kept in self.records.
+
+    Can be used as follows:
+    batch = BatchCrop(workers=8)
+    failures = batch.run(input_paths, output_dirs, channels, thresholds)
+    """
+    def __init__(self, workers=None, memory_budget=None):
+        """
+        Constructor
+
+        :param workers: number of worker processes - defaults to the
+        number of cores
+        :type workers: int
+        :param memory_budget: bytes that cropping may use at once -
+        defaults to half of the free memory
+        :type memory_budget: int
+        """
+        self.workers = workers or os.cpu_count() or 1
+        if memory_budget is None:
+            free = available_memory()
+            memory_budget = free // 2 if free else None
+        self.memory_budget = memory_budget
+        # how often progress is checked (seconds)
+        self.poll_interval = 0.05
+        # slide id -> dict describing what happened to the slide
+        self.records = {}
+
+    def _admit(self, nbytes, in_use, running):
+        """
+        Decide if a crop needing nbytes can start
+        """
+        if running == 0 or self.memory_budget is None:
+            return True
+        return in_use + nbytes <= self.memory_budget
+
+    def run(self, input_paths, output_dirs, channels, thresholds,
+            sections=None, progress=None, cancel=None):
+        """
+        Segment and crop every slide
+
+        :param input_paths: path of each slide
+        :type input_paths: list
+        :param output_dirs: output directory for each slide
+        :type output_dirs: list
+        :param channels: segmentation channel of each slide
+        :type channels: list
+        :param thresholds: segmentation threshold of each slide
+        :type thresholds: list
+        :param sections: optional callable given (slide id, number of
+        regions) once a slide is segmented
+        :type sections: function
+        :param progress: optional callable given (slide id, region id)
+        as each region is written
+        :type progress: function
+        :param cancel: optional CancelToken - once cancelled no more
+        slides are started and those running are stopped
+        :type cancel: CancelToken class instance
+        :returns list of (slide id, traceback) for slides that failed
+        """
+        self.records = {
+            sid: {
+                'path': path, 'output': output_dirs[sid],
+                'channel': channels[sid], 'threshold': thresholds[sid],
+                'status': 'waiting', 'regions': []
+            }
+            for sid, path in enumerate(input_paths)
+        }
+        jobs = [
+            (_segment_slide, (sid, path, channels[sid], thresholds[sid]))
+            for sid, path in enumerate(input_paths)
+        ]
+        crops = [
+            {'slide_path': path, 'outputdir': output_dirs[sid]}
+            for sid, path in enumerate(input_paths)
+        ]
+        return self._run(jobs, crops, sections, progress, cancel)
+
+    def run_plan(self, plan, progress=None, cancel=None):
+        """
+        Crop the slides of a CropPlan - the planned regions, levels,
+        channels and output names are used as they are. A slide
+        that has changed since it was planned is not cropped.
+
+        :param plan: plan to crop
+        :type plan: CropPlan class instance
+        :param progress: optional callable given (slide id, region id)
+        as each region is written
+        :type progress: function
+        :param cancel: optional CancelToken
+        :type cancel: CancelToken class instance
+        :returns list of (slide id, traceback) for slides that failed
+        """
+        self.records = {
+            sid: {
+                'path': entry['path'], 'output': entry['output'],
+                'status': 'waiting', 'regions': []
+            }
+            for sid, entry in enumerate(plan.slides)
+        }
+        jobs = [
+            (_prepare_planned, (sid, entry))
+            for sid, entry in enumerate(plan.slides)
+        ]
+        crops = [
+            {
+                'slide_path': entry['path'], 'outputdir': entry['output'],
+                'filenames': [r['file'] for r in entry['regions']],
+                'ids': [r['id'] for r in entry['regions']],
+                'channels': entry['channels'], 'level': entry['crop_level'],
+                'rotation': entry['rotation']
+            }
+            for entry in plan.slides
+        ]
+        return self._run(jobs, crops, None, progress, cancel)
+
+    def _run(self, jobs, crops, sections, progress, cancel):
+        """
+        Run the first job of every slide (segmentation, or checking
+        a planned slide) and then crop each as the memory budget
+        allows
+
+        :param jobs: worker function and arguments of each slide,
+        returning slide id, regions, estimated bytes and stats
+        :type jobs: list
+        :param crops: keyword arguments of _crop_slide for each
+        slide - filenames and region ids are found from the number
+        of regions if they are not given
+        :type crops: list
+        :returns list of (slide id, traceback) for slides that failed
+        """
+        ctx = mp.get_context('spawn')
+        messages = ctx.Queue()
+        # written straight to the pipe so an id is never held back
+        # in a feeder thread when the workers are stopped
+        pids = ctx.SimpleQueue()
+        events = queue.Queue()
+        failures = []
+
+        def error(sid, e):
+            tb = ''.join(
+                traceback.format_exception(type(e), e, e.__traceback__)
+            )
+            events.put(('error', sid, tb, 0, None))
+
+        def segmented(sid):
+            def on_done(future):
+                e = future.exception()
+                if e is not None:
+                    error(sid, e)
+                else:
+                    events.put(('segmented',) + future.result())
+            return on_done
+
+        def cropped(sid):
+            # a finished crop is seen through its last progress
+            # message - only failures are passed on from here
+            def on_done(future):
+                e = future.exception()
+                if e is not None:
+                    error(sid, e)
+            return on_done
+
+        def submit(sid, fn, args, done):
+            # a worker that dies (e.g. killed when out of memory)
+            # breaks the pool - its jobs, and any submitted after,
+            # fail with BrokenProcessPool rather than never ending
+            try:
+                future = pool.submit(fn, *args)
+            except BrokenProcessPool as e:
+                error(sid, e)
+                return
+            future.add_done_callback(done(sid))
+
+        pool = ProcessPoolExecutor(
+            self.workers, mp_context=ctx,
+            initializer=_init_worker, initargs=(messages, pids)
+        )
+        try:
+            for sid, (fn, args) in enumerate(jobs):
+                submit(sid, fn, args, segmented)
+
+            waiting = deque()
+            running = {}
+            remaining = len(jobs)
+            while remaining:
+                if cancel is not None and cancel.cancelled:
+                    # the workers cannot see the token - stop them
+                    # and remove what they left half written
+                    _terminate(pool, pids)
+                    self._remove_partial()
+                    cancel.check()
+                for sid in self._forward(messages, progress):
+                    if sid in running:
+                        running.pop(sid)
+                        remaining -= 1
+                try:
+                    kind, sid, result, nbytes, stats = events.get(
+                        timeout=self.poll_interval
+                    )
+                except queue.Empty:
+                    kind = None
+
+                if kind == 'segmented':
+                    record = self.records[sid]
+                    record.update(stats)
+                    record['status'] = 'segmented'
+                    crop = crops[sid]
+                    crop.setdefault('filenames', [
+                        _section_file(crop['slide_path'], rid)
+                        for rid in range(len(result))
+                    ])
+                    ids = crop.pop('ids', range(len(result)))
+                    record['regions'] = [
+                        {'id': rid, 'region': region, 'file': filename}
+                        for rid, region, filename in
+                        zip(ids, result, crop['filenames'])
+                    ]
+                    if sections is not None:
+                        sections(sid, len(result))
+                    waiting.append((sid, result, nbytes))
+                elif kind == 'error' and self.records[sid]['status'] != 'done':
+                    self.records[sid].update(status='failed', error=result)
+                    failures.append((sid, result))
+                    running.pop(sid, None)
+                    remaining -= 1
+
+                # start as many waiting crops as the budget allows
+                while waiting and self._admit(
+                        waiting[0][2], sum(running.values()), len(running)):
+                    sid, regions, nbytes = waiting.popleft()
+                    running[sid] = nbytes
+                    self.records[sid]['status'] = 'cropping'
+                    submit(
+                        sid, _crop_with_kwargs,
+                        (sid, regions, crops[sid]),
+                        cropped
+                    )
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        return failures
+
+    def _remove_partial(self):
+        """
+        Delete the sections of slides that were stopped part way
+        through cropping - a slide is either cropped whole or not
+        at all
+        """
+        for record in self.records.values():
+            if record['status'] != 'cropping':
+                continue
+            for region in record['regions']:
+                path = os.path.join(record['output'], region['file'])
+                if os.path.exists(path):
+                    os.remove(path)
+            record['status'] = 'cancelled'
+
+    def _forward(self, messages, progress):
+        """
+        Pass progress sent by the workers on to the callback
+
+        :returns list of slides that have finished cropping
+        """
+        finished = []
+        while True:
+            try:
+                sid, rid, info = messages.get_nowait()
+            except queue.Empty:
+                return finished
+            record = self.records[sid]
+            if rid is None:
+                record.update(info)
+                if record['status'] != 'failed':
+                    record['status'] = 'done'
+                finished.append(sid)
+            else:
+                region = record['regions'][rid]
+                region.update(info)
+                if progress is not None:
+                    progress(sid, region['id'])
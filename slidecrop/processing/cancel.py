@@ -0,0 +1,39 @@
+import threading
+
+
+class Cancelled(Exception):
+    """
+    Raised by CancelToken.check once a job has been cancelled
+    """
+    pass
+
+
+class CancelToken:
+    """
+    Flag shared between a long running job and whoever started
+    it. The job calls check() between units of work (tiles,
+    regions, slides) and stops with Cancelled once cancel() has
+    been called from any thread.
+
+    Can be used as follows:
+    token = CancelToken()
+    crop = MultiCrop(slide, outputdir, channels, cancel=token)
+    # from another thread
+    token.cancel()
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """
+        :raises Cancelled: if the job has been cancelled
+        """
+        if self._event.is_set():
+            raise Cancelled()
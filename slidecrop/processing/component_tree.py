@@ -0,0 +1,278 @@
+import numpy as np
+from scipy.ndimage import grey_dilation, grey_erosion
+from skimage.measure import label
+
+from .segmentation import RectRegion, Segment, filter_boxes
+
+
+class ComponentTree:
+    """
+    Component tree (max-tree) of the segmentation channel of a
+    low resolution image, used to find the regions Segment would
+    find at any threshold without touching the pixels again.
+
+    A 3x3 binary closing of a thresholded plane is the same as
+    thresholding a grey opening of the plane for bright field
+    (pixels < t) or a grey closing for fluorescence (pixels > t),
+    so the segmentation at any threshold is a set of connected
+    components of the level sets of one grey image. The boxes of
+    the components are found once, as the nodes of the max-tree,
+    and a lookup picks the nodes that are components at the
+    threshold and applies the shape filters of Segment to them.
+
+    Can be used as follows:
+    tree = ComponentTree(low[channel], slide.microscope_mode)
+    regions = tree.regions(threshold, slide.scale_factor)
+    """
+    def __init__(self, plane, mode, filters=None, kernel=3):
+        """
+        Constructor
+
+        :param plane: segmentation channel of the low resolution image
+        :type plane: numpy array
+        :param mode: microscope mode - 'bright' or 'fluoro'
+        :type mode: str
+        :param filters: shape filters of the regions kept, as in
+        Segment.filters - default is those of Segment
+        :type filters: dict
+        :param kernel: size of the square used for closing
+        :type kernel: int
+        """
+        self.mode = mode
+        if filters is None:
+            filters = Segment(mode, (1, 1)).filters
+        self.filters = dict(filters)
+        self.shape = plane.shape
+        self._build(self._grey_image(np.asarray(plane), kernel))
+
+    def _grey_image(self, plane, kernel):
+        """
+        Grey image whose upper level sets (values > s) are the
+        closed, thresholded plane
+
+        :returns numpy array
+        """
+        size = (kernel, kernel)
+        # outside the image counts as background for the dilation
+        # and foreground for the erosion, as in binary_closing
+        if plane.dtype.kind in 'ui':
+            hi, lo = np.iinfo(plane.dtype).max, np.iinfo(plane.dtype).min
+            # signed so that bright field levels can be negated
+            dtype = np.int64
+        else:
+            dtype = plane.dtype
+            hi, lo = np.inf, -np.inf
+
+        if 'bright' in self.mode:
+            # pixels < t - closing the set is an opening of the plane
+            opened = grey_dilation(
+                grey_erosion(plane, size, mode='constant', cval=hi),
+                size, mode='constant', cval=lo
+            )
+            return -opened.astype(dtype)
+        elif 'fluoro' in self.mode:
+            closed = grey_erosion(
+                grey_dilation(plane, size, mode='constant', cval=lo),
+                size, mode='constant', cval=hi
+            )
+            return closed.astype(dtype)
+        raise ValueError('unknown microscope mode {}'.format(self.mode))
+
+    def _build(self, image):
+        """
+        Build the max-tree of the grey image in one pass down its
+        grey levels, from the brightest.
+
+        The image is first split into flat zones - connected pixels
+        of one level - which are labelled, measured and joined to
+        their neighbours all at once. Going down the levels, the
+        zones of a level are merged with the components of the
+        higher zones they touch, found through a union-find of the
+        nodes made so far, and each group becomes a node whose area
+        and box are summed from its parts. The nodes clear of the
+        border are kept with the range of levels over which each
+        is a component.
+        """
+        h, w = image.shape
+        if image.dtype.kind in 'ui' and np.ptp(image) < image.size:
+            # integer levels are ranked by counting rather than sorting
+            shifted = (image - image.min()).ravel()
+            used = np.bincount(shifted) > 0
+            levels = np.flatnonzero(used) + image.min()
+            rank = (np.cumsum(used) - 1)[shifted]
+        else:
+            levels, rank = np.unique(image, return_inverse=True)
+            rank = rank.ravel()
+        zones = label(rank.reshape(h, w) + 1, connectivity=2).ravel() - 1
+        count = zones.max() + 1
+
+        # number the zones by level so the zones of each level, and
+        # the pairs of zones whose lower one is at that level, are
+        # runs of the arrays - a small type is sorted by counting
+        zone_rank = np.zeros(count, dtype=np.intp)
+        zone_rank[zones] = rank
+        order = np.argsort(
+            zone_rank.astype(np.min_scalar_type(levels.size)), kind='stable'
+        )
+        number = np.empty(count, dtype=np.intp)
+        number[order] = np.arange(count)
+        zones = number[zones]
+        zone_stops = np.cumsum(
+            np.bincount(zone_rank, minlength=levels.size)
+        )
+
+        zone_area = np.bincount(zones, minlength=count)
+        rows, cols = np.divmod(np.arange(h * w), w)
+        zone_spans = np.zeros((count, 4), dtype=np.int64)
+        zone_spans[:, :2] = [w, h]
+        np.minimum.at(zone_spans[:, 0], zones, cols)
+        np.minimum.at(zone_spans[:, 1], zones, rows)
+        np.maximum.at(zone_spans[:, 2], zones, cols + 1)
+        np.maximum.at(zone_spans[:, 3], zones, rows + 1)
+
+        # pairs of touching zones - touching zones are never at the
+        # same level, so the lower numbered one is the lower zone
+        zones = zones.reshape(h, w)
+        keys = []
+        for a, b in ((zones[:, :-1], zones[:, 1:]), (zones[:-1], zones[1:]),
+                     (zones[:-1, :-1], zones[1:, 1:]),
+                     (zones[:-1, 1:], zones[1:, :-1])):
+            touch = a != b
+            a, b = a[touch], b[touch]
+            keys.append(np.minimum(a, b) * count + np.maximum(a, b))
+        keys = np.sort(np.concatenate(keys))
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+        low, high = np.divmod(keys, count)
+        pair_stops = np.searchsorted(low, zone_stops)
+
+        # union-find of the components - each set of nodes is named
+        # by the node of its largest part, which knows the latest
+        # node of the component, so no path is longer than the log
+        # of the number of pixels
+        up = np.arange(count)
+        latest = np.arange(count)
+        zone_node = np.zeros(count, dtype=np.intp)
+        slot = np.zeros(count, dtype=np.intp)
+        parent = np.full(count, -1, dtype=np.intp)
+        node_rank = np.zeros(count, dtype=np.intp)
+        area = np.zeros(count, dtype=np.int64)
+        spans = np.zeros((count, 4), dtype=np.int64)
+        made = 0
+
+        for k in range(levels.size - 1, -1, -1):
+            first_zone = zone_stops[k - 1] if k else 0
+            new = slice(first_zone, zone_stops[k])
+            m = zone_stops[k] - first_zone
+            edges = slice(pair_stops[k - 1] if k else 0, pair_stops[k])
+            src = low[edges] - first_zone
+
+            # the higher zones stand for the set of their component
+            sets = up[zone_node[high[edges]]]
+            while True:
+                above = up[sets]
+                if np.array_equal(above, sets):
+                    break
+                sets = above
+            zone_node[high[edges]] = sets
+            # each set is one vertex - that of the first edge to it
+            slot[sets] = np.arange(sets.size)
+            dst = slot[sets]
+            first = dst == np.arange(sets.size)
+            sets = sets[first]
+            children = latest[sets]
+
+            # components of the zones and sets by hooking each to
+            # the smallest vertex it is joined to - zones come first
+            # so every component is named after one of its zones
+            vertex = np.arange(m + first.size)
+            dst += m
+            while True:
+                a, b = vertex[src], vertex[dst]
+                if np.array_equal(a, b):
+                    break
+                least = np.minimum(a, b)
+                np.minimum.at(vertex, a, least)
+                np.minimum.at(vertex, b, least)
+                while True:
+                    above = vertex[vertex]
+                    if np.array_equal(above, vertex):
+                        break
+                    vertex = above
+            named = vertex[:m] == np.arange(m)
+            found = np.count_nonzero(named)
+            ids = np.cumsum(named) - 1
+            node = made + ids[vertex[:m]]
+            joins = ids[vertex[m:][first]]
+            nodes = np.arange(made, made + found)
+
+            # the new nodes are made of the zones of the level and
+            # the components they join
+            node_rank[nodes] = k
+            spans[nodes] = [w, h, 0, 0]
+            for into, sizes, source in (
+                    (node, zone_area[new], zone_spans[new]),
+                    (made + joins, area[children], spans[children])):
+                np.add.at(area, into, sizes)
+                np.minimum.at(spans[:, 0], into, source[:, 0])
+                np.minimum.at(spans[:, 1], into, source[:, 1])
+                np.maximum.at(spans[:, 2], into, source[:, 2])
+                np.maximum.at(spans[:, 3], into, source[:, 3])
+            parent[children] = made + joins
+
+            # the sets joined go under the one of the largest child
+            largest = np.full(found, -1, dtype=np.int64)
+            np.maximum.at(largest, joins, area[children] * count + sets)
+            owner = np.where(largest >= 0, largest % count, nodes)
+            up[sets] = owner[joins]
+            up[nodes] = owner
+            latest[owner] = nodes
+            zone_node[new] = node
+            made += found
+
+        spans = spans[:made]
+        clear = np.flatnonzero(
+            (spans[:, 0] > 0) & (spans[:, 1] > 0) &
+            (spans[:, 2] < w) & (spans[:, 3] < h)
+        )
+        parent = parent[clear]
+        self._level = levels[node_rank[clear]]
+        # the level at and below which a node is part of a larger one
+        self._merged = np.where(
+            parent >= 0, levels[node_rank[parent]], -np.inf
+        )
+        self._spans = spans[clear]
+        self._area = area[clear]
+
+    def boxes_at(self, threshold):
+        """
+        Bounding boxes of the regions found at a threshold
+
+        :param threshold: threshold in the grey levels of the plane
+        :type threshold: float
+        :returns list of x, y, w, h sorted as Segment sorts
+        its regions
+        """
+        s = -threshold if 'bright' in self.mode else threshold
+        # regions are the components of the level set values > s -
+        # the nodes above s whose parent is not
+        alive = (self._level > s) & (self._merged <= s)
+        boxes = filter_boxes(
+            self._spans[alive], self._area[alive], **self.filters
+        )
+        return boxes.tolist()
+
+    def regions(self, threshold, scale_factor):
+        """
+        Regions found at a threshold
+
+        :param threshold: threshold in the grey levels of the plane
+        :type threshold: float
+        :param scale_factor: scale from the low resolution image to
+        the crop level
+        :type scale_factor: tuple
+        :returns list of RectRegion
+        """
+        return [
+            RectRegion(*box, scale_factor)
+            for box in self.boxes_at(threshold)
+        ]
@@ -2,8 +2,8 @@ import os
 import time
 
 from ..ims.slide import SlideImage
-from ..ome.ometiff import OMETiffGenerator
-from .segmentation import Segment
+from ..ims.parallel import ParallelReader
+from .plan import find_regions, plan_slide, run_slide
 
 
 class CropSlide:
@@ -11,7 +11,8 @@ class CropSlide:
     def __init__(self, slide, outputdir, crop_channels=None,
                  crop_level=None, seg_channel=0, seg_level=None,
                  threshold_method='manual', threshold=None,
-                 rotation=0, skip_segmentation=False):
+                 rotation=0, skip_segmentation=False, workers=1,
+                 pyramid=False, refine=False, progress=None):
 
         # self.slide = SlideImage(slidepath)
         self.slide = slide
@@ -42,19 +43,22 @@ class CropSlide:
 
             self.rotation = rotation
             self.skip_segmentation = skip_segmentation
+            self.workers = workers
+            self.pyramid = pyramid
+            self.refine = refine
+            self.progress = progress
             self._crop()
             self.slide.close()
         else:
             raise ValueError('The slide has been closed - repoen to crop')
 
     def _segment(self):
-        image = self.slide.low_resolution_image()
         try:
-            segmenter = Segment(
-                self.mode, self.scale_factor, channel=self.seg_channel,
-                thresh_method=self.threshold_method, threshold=self.threshold
+            return find_regions(
+                self.slide, self.seg_channel, self.seg_level,
+                self.crop_level, self.threshold_method, self.threshold,
+                refine=self.refine
             )
-            return segmenter.run(image)
         except:
             raise IOError('Could not segment slide')
 
@@ -65,20 +69,27 @@ class CropSlide:
         else:
             regions = self.slide.regions
 
+        self.plan = plan_slide(
+            self.slide, self.outputdir, self.crop_channels, self.crop_level,
+            self.seg_channel, self.seg_level, self.threshold_method,
+            self.threshold, self.rotation, self.refine, regions=regions
+        )
+
+        # decompression is spread over several processes
+        # each with their own handle on the slide
+        reader = None
+        if self.workers > 1:
+            reader = ParallelReader(self.slide, workers=self.workers)
+
         try:
-            for rid, region in enumerate(regions):
-                print(rid)
-                filename = (
-                    self.slide.basename + '_section_{}.ome.tif'.format(rid)
-                )
-                ometiff = OMETiffGenerator(
-                    self.slide,
-                    filename,
-                    self.outputdir,
-                    self.crop_channels,
-                    self.crop_level,
-                    self.rotation
-                )
-                ometiff.run(region)
+            # every region is cut in one sweep over the slide so
+            # chunks shared between regions are decoded once
+            self.record = run_slide(
+                self.slide, self.plan, reader=reader,
+                pyramid=self.pyramid, progress=self.progress
+            )
         except:
-            raise IOError('Could not crop slide')
\ No newline at end of file
+            raise IOError('Could not crop slide')
+        finally:
+            if reader is not None:
+                reader.close()
\ No newline at end of file
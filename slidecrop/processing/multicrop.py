@@ -0,0 +1,296 @@
+import queue
+import threading
+from math import ceil
+
+import numpy as np
+
+from ..ome.ometiff import OMETiffGenerator
+
+
+def _merge_intervals(intervals):
+    """
+    Merge overlapping or touching [start, end) intervals
+
+    :returns sorted list of merged intervals
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _queue_items(pieces):
+    """
+    Items put on a queue until the None sentinel - iter(get, None)
+    cannot be used as it compares numpy arrays with None
+    """
+    while True:
+        item = pieces.get()
+        if item is None:
+            return
+        yield item
+
+
+def _tiles_from_pieces(pieces, size_c, size_y, size_x, th, tw):
+    """
+    Turn the row pieces of a region sent by the sweep (channel
+    by channel, top to bottom) into output tiles in row major
+    order
+
+    :returns generator of tiles as numpy arrays
+    """
+    for _ in range(size_c):
+        held = []
+        rows = 0
+        for y in range(0, size_y, th):
+            need = min(th, size_y - y)
+            while rows < need:
+                piece = next(pieces)
+                held.append(piece)
+                rows += piece.shape[0]
+            band = np.concatenate(held) if len(held) > 1 else held[0]
+            held = [band[need:]] if rows > need else []
+            rows -= need
+            for x in range(0, size_x, tw):
+                yield band[:need, x: x + tw]
+
+
+class MultiCrop:
+    """
+    Crops several regions of a slide in a single sweep over
+    its chunk grid.
+
+    Cropping each region on its own decodes any chunk shared by
+    neighbouring or overlapping regions more than once. Here the
+    slide is read one row of chunks at a time, each row only
+    across the union of the regions it meets, and the decoded
+    pixels are handed to every region they overlap. Each region
+    is written by its own OMETiffGenerator on a writer thread -
+    at most max_writers at once, so slides with many regions are
+    swept in batches of neighbouring regions.
+
+    Can be used as follows:
+    with SlideImage(path) as slide:
+        crop = MultiCrop(slide, outputdir, channels, level=0)
+        crop.run(regions, filenames)
+    """
+    def __init__(self, slide, outputdir, channels, level=0, rotation=0,
+                 reader=None, pyramid=False, compression=None,
+                 encode_workers=None, cancel=None):
+        """
+        Constructor - the options match OMETiffGenerator
+
+        :param slide: SlideImage instance
+        :type slide: SlideImage class instance
+        :param outputdir: directory where the *.ome.tiff files are saved
+        :type outputdir: str
+        :param channels: the channels to be written
+        :type channels: list
+        :param level: the resolution level being cropped
+        :type level: int
+        :param cancel: optional CancelToken checked between rows
+        of chunks and between tiles
+        :type cancel: CancelToken class instance
+        """
+        self.slide = slide
+        self.outputdir = outputdir
+        self.channels = channels
+        self.level = level
+        self.rotation = rotation
+        self.reader = reader
+        self.options = dict(
+            reader=reader, pyramid=pyramid, compression=compression,
+            encode_workers=encode_workers, cancel=cancel
+        )
+        self.cancel = cancel
+        # number of pieces a writer may fall behind the sweep
+        self.queue_size = 4
+        # rows of a region held by its writer - the output tile height
+        self.band_rows = 1024
+        # regions written at once, each with a thread and an open
+        # file - slides with more regions are swept in batches
+        self.max_writers = 32
+        self.chunk_reads = 0
+
+    def _generator(self, filename):
+        return OMETiffGenerator(
+            self.slide, filename, self.outputdir,
+            self.channels, self.level, self.rotation, **self.options
+        )
+
+    def working_bytes(self, regions):
+        """
+        Estimate of the memory needed to crop a set of regions -
+        the rows of the sweep queued for each region and the band
+        of output tiles each writer is assembling
+
+        :param regions: x, y, w, h of each region in the crop level
+        :type regions: list
+        :returns number of bytes
+        """
+        channel = self.channels[0] if self.channels else 0
+        ch, _ = self.slide.chunk_shape(self.level, channel) or (1, 1)
+        itemsize = self.slide._dataset(self.level, 0, channel).dtype.itemsize
+        sizes = []
+        for x, y, w, h in (region[:4] for region in regions):
+            rows = (self.queue_size + 1) * min(ch, h) + 2 * min(self.band_rows, h)
+            sizes.append(rows * w * itemsize)
+        # only one batch of regions is held at a time
+        return max(
+            [sum(sizes[i] for i in batch) for batch in self._batches(regions)],
+            default=0
+        )
+
+    def _batches(self, regions):
+        """
+        Split the regions into batches of at most max_writers,
+        taking them from the top of the slide so each batch is
+        swept over as few rows as possible
+
+        :returns list of lists of region indices
+        """
+        order = sorted(range(len(regions)), key=lambda i: (regions[i][1], regions[i][0]))
+        size = max(self.max_writers, 1)
+        return [order[i: i + size] for i in range(0, len(order), size)]
+
+    def _sweep(self, regions, queues, channel):
+        """
+        Read one channel of the union of the regions, one row of
+        chunks at a time, and send each region its rows
+        """
+        ch, cw = self.slide.chunk_shape(self.level, channel) or (1, 1)
+        dtype = self.slide._dataset(self.level, 0, channel).dtype
+        source = self.reader if self.reader is not None else self.slide
+        top = min(r[1] for r in regions)
+        bottom = max(r[1] + r[3] for r in regions)
+        for row in range(top // ch, int(ceil(float(bottom) / ch))):
+            if self.cancel is not None:
+                self.cancel.check()
+            y0 = row * ch
+            y1 = y0 + ch
+            active = [
+                i for i, r in enumerate(regions)
+                if r[1] < y1 and r[1] + r[3] > y0
+            ]
+            if not active:
+                continue
+
+            # read each run of chunks met by a region once
+            intervals = _merge_intervals([
+                [(regions[i][0] // cw) * cw,
+                 int(ceil(float(regions[i][0] + regions[i][2]) / cw)) * cw]
+                for i in active
+            ])
+            strips = []
+            for x0, x1 in intervals:
+                strip = np.zeros((ch, x1 - x0), dtype=dtype)
+                pix = source.read_region([x0, y0, x1 - x0, ch], self.level, channel)
+                if pix is not None:
+                    strip[:pix.shape[0], :pix.shape[1]] = pix
+                strips.append((x0, x1, strip))
+
+            for i in active:
+                x, y, w, h = regions[i]
+                for x0, x1, strip in strips:
+                    if x0 <= x and x + w <= x1:
+                        break
+                rows = slice(max(y, y0) - y0, min(y + h, y1) - y0)
+                queues[i].put(strip[rows, x - x0: x - x0 + w])
+
+    def _write(self, ometiff, pieces, errors, done):
+        """
+        Writer thread - writes one region from the pieces sent
+        to it. On failure the remaining pieces are drained so
+        the sweep is never blocked.
+        """
+        tiles = _tiles_from_pieces(
+            pieces, ometiff.size_c, ometiff.size_y, ometiff.size_x,
+            ometiff.tile_height, ometiff.tile_width
+        )
+        try:
+            if ometiff.pyramid:
+                ometiff.write_pyramid(tiles)
+            else:
+                ometiff.write_tiles(tiles)
+        except Exception as e:
+            errors.append(e)
+            for _ in pieces:
+                pass
+        else:
+            done()
+
+    def run(self, regions, filenames, progress=None):
+        """
+        Crop every region to its own *.ome.tiff
+
+        :param regions: x, y, w, h of each region in the crop level
+        :type regions: list
+        :param filenames: filename of each *.ome.tiff
+        :type filenames: list
+        :param progress: optional callable given the index of
+        each region as it is finished
+        :type progress: function
+        """
+        regions = [[int(v) for v in region[:4]] for region in regions]
+        if not regions:
+            return
+
+        if self.rotation != 0:
+            # rotated output is only supported one region at a time
+            for rid, (region, filename) in enumerate(zip(regions, filenames)):
+                if self.cancel is not None:
+                    self.cancel.check()
+                self._generator(filename).run(region)
+                if progress is not None:
+                    progress(rid)
+            return
+
+        source = self.reader if self.reader is not None else self.slide
+        reads_before = source.chunk_reads
+        try:
+            for batch in self._batches(regions):
+                self._run_batch(
+                    [regions[i] for i in batch], [filenames[i] for i in batch],
+                    batch, progress
+                )
+        finally:
+            self.chunk_reads = source.chunk_reads - reads_before
+
+    def _run_batch(self, regions, filenames, rids, progress):
+        """
+        Crop a batch of regions in one sweep, one writer thread
+        per region
+
+        :param rids: index of each region passed to progress
+        :type rids: list
+        """
+        errors = []
+        queues = []
+        threads = []
+        for rid, region, filename in zip(rids, regions, filenames):
+            ometiff = self._generator(filename)
+            ometiff.prepare(region)
+            pieces = queue.Queue(self.queue_size)
+            done = (lambda rid=rid: progress(rid)) if progress else (lambda: None)
+            thread = threading.Thread(
+                target=self._write,
+                args=(ometiff, _queue_items(pieces), errors, done)
+            )
+            thread.start()
+            queues.append(pieces)
+            threads.append(thread)
+
+        try:
+            for channel in self.channels:
+                self._sweep(regions, queues, channel)
+        finally:
+            for pieces in queues:
+                pieces.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
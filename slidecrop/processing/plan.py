@@ -0,0 +1,282 @@
+import os
+import json
+import time
+
+from ..ims import lowres
+from .batch import BatchCrop, slide_file_key
+from .multicrop import MultiCrop
+from .refine import RefineRegions
+from .segmentation import Segment
+from .tiled_segmentation import TiledSegment
+
+
+PLAN_VERSION = 1
+
+
+def find_regions(slide, seg_channel=0, seg_level=None, crop_level=None,
+                 threshold_method='manual', threshold=None, refine=False):
+    """
+    Segment a slide - the segmentation level is used whole and
+    finer levels are segmented a tile at a time
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :param seg_channel: channel to segment
+    :type seg_channel: int
+    :param seg_level: level to segment - default is the slide
+    segmentation level
+    :type seg_level: int
+    :param crop_level: level the regions are scaled to - default
+    is the slide crop level
+    :type crop_level: int
+    :param threshold_method: 'manual' or an auto threshold method
+    :type threshold_method: str
+    :param threshold: threshold used with 'manual'
+    :type threshold: float
+    :param refine: tighten the borders at the finer levels
+    :type refine: bool
+    :returns list of RectRegion
+    """
+    if seg_level is None:
+        seg_level = slide.segmentation_level
+    if crop_level is None:
+        crop_level = slide.crop_level
+
+    if seg_level != slide.segmentation_level:
+        segmenter = TiledSegment(
+            slide, seg_level, channel=seg_channel,
+            thresh_method=threshold_method,
+            threshold=threshold, crop_level=crop_level
+        )
+        regions = segmenter.run()
+    else:
+        segmenter = Segment(
+            slide.microscope_mode, slide.scale_factor, channel=seg_channel,
+            thresh_method=threshold_method, threshold=threshold
+        )
+        regions = segmenter.run(lowres.low_resolution_image(slide))
+
+    if refine and seg_level > crop_level:
+        # boxes scaled up from the segmentation level are only
+        # accurate to a pixel of that level - tighten them by
+        # reading strips across their edges at the finer levels
+        refiner = RefineRegions(
+            slide, channel=seg_channel, threshold=threshold,
+            thresh_method=threshold_method,
+            seg_level=seg_level, crop_level=crop_level
+        )
+        regions = refiner.run(regions)
+    return regions
+
+
+def plan_slide(slide, outputdir, crop_channels=None, crop_level=None,
+               seg_channel=0, seg_level=None, threshold_method='manual',
+               threshold=None, rotation=0, refine=False, regions=None):
+    """
+    Plan the crop of a slide - the slide is segmented (unless
+    regions are given) but nothing is written
+
+    :param slide: SlideImage instance
+    :type slide: SlideImage class instance
+    :param outputdir: directory the sections are written to
+    :type outputdir: str
+    :param crop_channels: channels written - default is all
+    :type crop_channels: list
+    :param regions: optional x, y, w, h of each region in the crop
+    level, e.g. drawn in the GUI, used instead of segmenting
+    :type regions: list
+    :returns dict describing the crop of the slide
+    """
+    if crop_channels is None:
+        crop_channels = list(range(slide.size_c))
+    if crop_level is None:
+        crop_level = slide.crop_level
+    if seg_level is None:
+        seg_level = slide.segmentation_level
+    if 'manual' in threshold_method and threshold is None and regions is None:
+        raise ValueError('You must supply a value for thresholding')
+
+    if regions is None:
+        regions = find_regions(
+            slide, seg_channel, seg_level, crop_level,
+            threshold_method, threshold, refine
+        )
+    itemsize = slide._dataset(crop_level, 0, 0).dtype.itemsize
+
+    planned = []
+    for rid, region in enumerate(regions):
+        x, y, w, h = [int(v) for v in region[:4]]
+        planned.append({
+            'id': rid,
+            'region': [x, y, w, h],
+            'file': slide.basename + '_section_{}.ome.tif'.format(rid),
+            'bytes': w * h * len(crop_channels) * itemsize
+        })
+
+    return {
+        'path': os.path.abspath(slide.filepath),
+        'file': slide_file_key(slide.filepath),
+        'output': outputdir,
+        'crop_level': crop_level,
+        'channels': list(crop_channels),
+        'seg_level': seg_level,
+        'seg_channel': seg_channel,
+        'method': threshold_method,
+        'threshold': None if threshold is None else float(threshold),
+        'rotation': rotation,
+        'regions': planned,
+        'bytes': sum(r['bytes'] for r in planned)
+    }
+
+
+def run_slide(slide, entry, reader=None, pyramid=False, compression=None,
+              progress=None, cancel=None):
+    """
+    Crop the regions planned for a slide
+
+    :param slide: SlideImage instance of the planned slide
+    :type slide: SlideImage class instance
+    :param entry: plan of the slide made by plan_slide
+    :type entry: dict
+    :param progress: optional callable given the id of each
+    region as it is finished
+    :type progress: function
+    :returns dict of the time taken and bytes decoded and written
+    for the slide and each of its regions
+    """
+    tic = time.time()
+    planned = entry['regions']
+    record = {
+        'path': entry['path'], 'output': entry['output'],
+        'status': 'cropping',
+        'regions': [
+            {'id': r['id'], 'file': r['file'], 'region': r['region']}
+            for r in planned
+        ]
+    }
+
+    def done(rid):
+        path = os.path.join(entry['output'], planned[rid]['file'])
+        record['regions'][rid].update(
+            seconds=time.time() - tic, bytes_written=os.path.getsize(path)
+        )
+        if progress is not None:
+            progress(planned[rid]['id'])
+
+    crop = MultiCrop(
+        slide, entry['output'], entry['channels'], entry['crop_level'],
+        entry['rotation'], reader=reader, pyramid=pyramid,
+        compression=compression, cancel=cancel
+    )
+    crop.run(
+        [r['region'] for r in planned], [r['file'] for r in planned],
+        progress=done
+    )
+    ch, cw = slide.chunk_shape(entry['crop_level'], 0) or (1, 1)
+    itemsize = slide._dataset(entry['crop_level'], 0, 0).dtype.itemsize
+    record.update(
+        status='done',
+        seconds=time.time() - tic,
+        bytes_read=crop.chunk_reads * ch * cw * itemsize,
+        bytes_written=sum(r.get('bytes_written', 0) for r in record['regions'])
+    )
+    return record
+
+
+class CropPlan:
+    """
+    The work of a crop - for each slide the levels and channels,
+    the regions in crop level coordinates, their output names and
+    the bytes they are expected to take - kept apart from doing it.
+
+    A plan can be saved as JSON, looked over or edited, and run
+    later or on another machine.
+
+    Can be used as follows:
+    plan = CropPlan()
+    with SlideImage(path) as slide:
+        plan.add(plan_slide(slide, outputdir, threshold=200))
+    plan.save('plan.json')
+    ...
+    records = CropPlan.load('plan.json').run(workers=8)
+    """
+    def __init__(self, slides=None):
+        """
+        Constructor
+
+        :param slides: plans of the slides as made by plan_slide
+        :type slides: list
+        """
+        self.slides = list(slides or [])
+
+    def __len__(self):
+        return len(self.slides)
+
+    def __iter__(self):
+        return iter(self.slides)
+
+    def add(self, entry):
+        self.slides.append(entry)
+
+    @property
+    def nbytes(self):
+        """
+        :returns estimated bytes of every section planned
+        """
+        return sum(entry['bytes'] for entry in self.slides)
+
+    @property
+    def region_count(self):
+        return sum(len(entry['regions']) for entry in self.slides)
+
+    def to_dict(self):
+        return {'version': PLAN_VERSION, 'slides': self.slides}
+
+    @classmethod
+    def from_dict(cls, plan):
+        if plan.get('version') != PLAN_VERSION:
+            raise ValueError(
+                'Crop plan version {} is not supported'.
+                format(plan.get('version'))
+            )
+        return cls(plan['slides'])
+
+    def save(self, path):
+        """
+        Write the plan as JSON
+
+        :returns path
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+    def run(self, workers=None, memory_budget=None, progress=None,
+            cancel=None):
+        """
+        Crop every slide of the plan on a pool of processes, as
+        BatchCrop does after segmenting. A slide that fails, or has
+        changed since it was planned, is recorded and the rest are
+        still cropped.
+
+        :param workers: number of worker processes - defaults to the
+        number of cores
+        :type workers: int
+        :param memory_budget: bytes that cropping may use at once -
+        defaults to half of the free memory
+        :type memory_budget: int
+        :param progress: optional callable given (slide index,
+        region id) as each region is finished
+        :type progress: function
+        :param cancel: optional CancelToken
+        :type cancel: CancelToken class instance
+        :returns list of dicts of what happened to each slide
+        """
+        batch = BatchCrop(workers=workers, memory_budget=memory_budget)
+        batch.run_plan(self, progress=progress, cancel=cancel)
+        return [batch.records[sid] for sid in range(len(self.slides))]
@@ -0,0 +1,192 @@
+import copy
+from math import ceil, floor
+
+import numpy as np
+from scipy.ndimage import label
+
+from ..ims import lowres
+from .segmentation import Segment
+from .threshold import histogram_threshold
+
+
+class RefineRegions:
+    """
+    Tightens the boxes found by segmenting the low resolution image.
+
+    Scaling a low resolution box up to the crop level leaves each
+    edge uncertain by about a low resolution pixel - tens to
+    hundreds of pixels at the crop level. Here each box is moved
+    down the pyramid one level at a time and at every level only
+    thin strips across its four edges are read, thresholded and
+    closed. The edge is moved to the outermost pixel of the
+    foreground that reaches into the box. The pixels read are
+    roughly the perimeter of the box times the strip width at
+    each level rather than the whole area of a finer level.
+
+    Can be used as follows:
+    with SlideImage(path) as slide:
+        regions = Segment(...).run(slide.low_resolution_image())
+        regions = RefineRegions(slide, channel, threshold).run(regions)
+    """
+    def __init__(self, slide, channel=0, threshold=None,
+                 thresh_method='manual', seg_level=None, crop_level=0,
+                 margin=2, kernel=3):
+        """
+        Constructor
+
+        :param slide: SlideImage instance
+        :type slide: SlideImage class instance
+        :param channel: channel that was segmented
+        :type channel: int
+        :param threshold: threshold used with 'manual'
+        :type threshold: float
+        :param thresh_method: 'manual' or an auto threshold method
+        found from the histogram of the segmentation level
+        :type thresh_method: str
+        :param seg_level: level the regions were segmented at -
+        defaults to the slide segmentation level
+        :type seg_level: int
+        :param crop_level: level the regions are refined down to
+        :type crop_level: int
+        :param margin: half width of the strips in pixels of the
+        coarser level - how far an edge may move at each level
+        :type margin: int
+        :param kernel: size of the square used for closing
+        :type kernel: int
+        """
+        self.slide = slide
+        self.channel = channel
+        self.seg_level = seg_level
+        if seg_level is None:
+            self.seg_level = slide.segmentation_level
+        self.crop_level = crop_level
+        self.margin = margin
+        self.kernel = kernel
+
+        if 'manual' not in thresh_method:
+            hist = lowres.histogram(slide, r=self.seg_level, c=channel)
+            centers = lowres.bin_centers(slide, r=self.seg_level, c=channel)
+            threshold = histogram_threshold(hist, thresh_method, centers)
+        elif threshold is None:
+            raise ValueError('You must supply a value for thresholding')
+        self.threshold = threshold
+        self.segmenter = Segment(
+            slide.microscope_mode, slide.scale_factor, channel=channel,
+            thresh_method='manual', threshold=threshold
+        )
+        self.pixels_read = 0
+
+    def _strip(self, level, x0, y0, x1, y1):
+        """
+        Read, threshold and close a strip of a level - the strip
+        is clipped to the level
+
+        :returns tuple of the clipped x0, y0 and binary numpy array
+        """
+        size_x, size_y = self.slide.level_dimensions(level)
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, size_x), min(y1, size_y)
+        if x1 <= x0 or y1 <= y0:
+            return (x0, y0, np.zeros((0, 0), dtype=bool))
+        pix = self.slide.read_region(
+            [x0, y0, x1 - x0, y1 - y0], level, self.channel
+        )
+        if pix is None:
+            raise IOError(
+                'Could not read strip {} of level {}'.
+                format([x0, y0, x1 - x0, y1 - y0], level)
+            )
+        self.pixels_read += pix.size
+        binary = self.segmenter._manual_threshold(pix, self.threshold)
+        return (x0, y0, self.segmenter._close_binary(binary, self.kernel))
+
+    def _reaching(self, binary, side):
+        """
+        Foreground of a strip connected to one side of it
+
+        :param side: 'left', 'right', 'top' or 'bottom'
+        :returns boolean numpy array
+        """
+        if binary.size == 0:
+            return binary
+        labels, _ = label(binary, structure=np.ones((3, 3), dtype=bool))
+        edge = {
+            'left': labels[:, 0], 'right': labels[:, -1],
+            'top': labels[0, :], 'bottom': labels[-1, :]
+        }[side]
+        ids = np.unique(edge[edge > 0])
+        return np.isin(labels, ids)
+
+    def _refine_box(self, box, coarse, fine):
+        """
+        Move a box from a coarse level to the next finer one and
+        tighten its edges there
+
+        :param box: x0, y0, x1, y1 of the box in the coarse level
+        :type box: list
+        :returns x0, y0, x1, y1 of the box in the fine level
+        """
+        cx, cy = self.slide.level_dimensions(coarse)
+        fx, fy = self.slide.level_dimensions(fine)
+        sx, sy = float(fx) / cx, float(fy) / cy
+        x0, y0 = int(floor(box[0] * sx)), int(floor(box[1] * sy))
+        x1, y1 = int(ceil(box[2] * sx)), int(ceil(box[3] * sy))
+        mx = int(ceil(self.margin * sx)) + 1
+        my = int(ceil(self.margin * sy)) + 1
+
+        # each edge moves to the outermost foreground that reaches
+        # the inner side of its strip, or to the inner side itself
+        # if the strip is empty - which pulls that edge in by the
+        # margin, shrinking the box
+        sx0, sy0, strip = self._strip(fine, x0 - mx, y0 - my, x0 + mx, y1 + my)
+        cols = np.flatnonzero(self._reaching(strip, 'right').any(axis=0))
+        nx0 = sx0 + cols[0] if cols.size else x0 + mx
+
+        sx0, sy0, strip = self._strip(fine, x1 - mx, y0 - my, x1 + mx, y1 + my)
+        cols = np.flatnonzero(self._reaching(strip, 'left').any(axis=0))
+        nx1 = sx0 + cols[-1] + 1 if cols.size else x1 - mx
+
+        sx0, sy0, strip = self._strip(fine, x0 - mx, y0 - my, x1 + mx, y0 + my)
+        rows = np.flatnonzero(self._reaching(strip, 'bottom').any(axis=1))
+        ny0 = sy0 + rows[0] if rows.size else y0 + my
+
+        sx0, sy0, strip = self._strip(fine, x0 - mx, y1 - my, x1 + mx, y1 + my)
+        rows = np.flatnonzero(self._reaching(strip, 'top').any(axis=1))
+        ny1 = sy0 + rows[-1] + 1 if rows.size else y1 - my
+
+        if nx1 <= nx0 or ny1 <= ny0:
+            # nothing sensible was found - keep the scaled box
+            return [x0, y0, x1, y1]
+        return [int(nx0), int(ny0), int(nx1), int(ny1)]
+
+    def refine(self, region):
+        """
+        Refine one region
+
+        :param region: region found at the segmentation level
+        :type region: RectRegion
+        :returns x, y, w, h of the region in the crop level
+        """
+        x, y, w, h = region.roi
+        box = [x, y, x + w, y + h]
+        for level in range(self.seg_level, self.crop_level, -1):
+            box = self._refine_box(box, level, level - 1)
+        if self.seg_level == self.crop_level:
+            return [x, y, w, h]
+        return [box[0], box[1], box[2] - box[0], box[3] - box[1]]
+
+    def run(self, regions):
+        """
+        Refine a list of regions
+
+        :param regions: regions found at the segmentation level
+        :type regions: list of RectRegion
+        :returns list of RectRegion whose segmentation_roi holds
+        the refined box in the crop level
+        """
+        refined = []
+        for region in regions:
+            region = copy.copy(region)
+            region.segmentation_roi = self.refine(region)
+            refined.append(region)
+        return refined
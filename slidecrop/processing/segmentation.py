@@ -1,11 +1,9 @@
 from math import ceil
 
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 import numpy as np
-from scipy.ndimage import binary_fill_holes, binary_erosion
+from scipy.ndimage import binary_fill_holes, binary_erosion, find_objects
 from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.morphology import (
     closing, binary_closing, binary_opening, square
 )
@@ -18,6 +16,112 @@ from skimage.filters import (
     threshold_yen
 )
 
+from .threshold import histogram_threshold
+
+
+def auto_threshold(plane, method='otsu'):
+    """
+    Threshold of a plane found by the named method. Unsigned
+    integer planes are reduced to a histogram first.
+
+    :param plane: image plane
+    :type plane: numpy array
+    :param method: 'isodata', 'mean', 'otsu', 'triangle' or 'yen'
+    :type method: str
+    :returns threshold value
+    """
+    if plane.dtype.kind == 'u':
+        return histogram_threshold(np.bincount(plane.ravel()), method)
+
+    if 'isodata' in method:
+        thresh = threshold_isodata(plane)
+    elif 'mean' in method:
+        thresh = threshold_mean(plane)
+    elif 'otsu' in method:
+        thresh = threshold_otsu(plane)
+    elif 'triangle' in method:
+        thresh = threshold_triangle(plane)
+    elif 'yen' in method:
+        thresh = threshold_yen(plane)
+    else:
+        raise NotImplementedError(
+            'thresholding method not supported'
+        )
+    return thresh
+
+
+def region_boxes(label_image, min_area=100, max_area=None, min_side=0,
+                 max_aspect=None, min_extent=0.0):
+    """
+    Bounding boxes of the labelled regions of an image that pass
+    a set of shape filters. Areas come from a single bincount of
+    the label image, boxes from find_objects and the filters are
+    applied to arrays. Turning the find_objects slices into boxes
+    is still a Python loop over every region, but a much cheaper
+    one than building a regionprops object for each.
+
+    :param label_image: labelled image - 0 is background
+    :type label_image: numpy array
+    :param min_area: smallest area (pixels) kept
+    :type min_area: int
+    :param max_area: largest area (pixels) kept - None for no limit
+    :type max_area: int
+    :param min_side: smallest width or height (pixels) kept
+    :type min_side: int
+    :param max_aspect: largest ratio of the long to the short
+    side of the box kept - None for no limit
+    :type max_aspect: float
+    :param min_extent: smallest fraction of its box a region must fill
+    :type min_extent: float
+    :returns numpy array of x, y, w, h rows sorted by x, y, w then h
+    """
+    objects = find_objects(label_image)
+    if not objects:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    area = np.bincount(label_image.ravel(), minlength=len(objects) + 1)[1:]
+    # labels that are not used have no box
+    used = np.array([obj is not None for obj in objects])
+    spans = np.array([
+        (obj[1].start, obj[0].start, obj[1].stop, obj[0].stop)
+        if obj is not None else (0, 0, 0, 0) for obj in objects
+    ], dtype=np.int64)
+    area[~used] = 0
+    return filter_boxes(
+        spans, area, min_area=min_area, max_area=max_area, min_side=min_side,
+        max_aspect=max_aspect, min_extent=min_extent
+    )
+
+
+def filter_boxes(spans, area, min_area=100, max_area=None, min_side=0,
+                 max_aspect=None, min_extent=0.0):
+    """
+    Apply the shape filters of region_boxes to regions given
+    by their extents and areas
+
+    :param spans: x0, y0, x1, y1 rows of each region
+    :type spans: numpy array
+    :param area: area (pixels) of each region
+    :type area: numpy array
+    :returns numpy array of x, y, w, h rows sorted by x, y, w then h
+    """
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 4)
+    w = spans[:, 2] - spans[:, 0]
+    h = spans[:, 3] - spans[:, 1]
+
+    keep = (area > 0) & (area >= min_area)
+    if max_area is not None:
+        keep &= area <= max_area
+    if min_side:
+        keep &= np.minimum(w, h) >= min_side
+    if max_aspect is not None:
+        keep &= np.maximum(w, h) <= max_aspect * np.maximum(np.minimum(w, h), 1)
+    if min_extent:
+        keep &= area >= min_extent * w * h
+
+    boxes = np.stack([spans[:, 0], spans[:, 1], w, h], axis=1)[keep]
+    return boxes[np.lexsort(boxes.T[::-1])]
+
 
 class RectRegion:
 
@@ -41,7 +145,8 @@ class RectRegion:
 class Segment:
 
     def __init__(self, mode, scale_factor, channel=None,
-                 thresh_method='auto', threshold=None):
+                 thresh_method='auto', threshold=None, min_area=100,
+                 max_area=None, min_side=0, max_aspect=None, min_extent=0.0):
 
         self.mode = mode
         self.scale_factor = scale_factor
@@ -54,6 +159,12 @@ class Segment:
             # set to 0 for now
             self.channel = 0
 
+        # shape filters applied to the segmented regions
+        self.filters = dict(
+            min_area=min_area, max_area=max_area, min_side=min_side,
+            max_aspect=max_aspect, min_extent=min_extent
+        )
+
     def _apply_threshold(self, plane, thresh):
         if 'bright' in self.mode:
             return plane < thresh
@@ -61,20 +172,7 @@ class Segment:
             return plane > thresh
 
     def _auto_threshold(self, plane, method='otsu'):
-        if 'isodata' in method:
-            thresh = threshold_isodata(plane)        
-        elif 'mean' in method:
-            thresh = threshold_mean(plane)
-        elif 'otsu' in method:
-            thresh = threshold_otsu(plane)
-        elif 'triangle' in method:
-            thresh = threshold_triangle(plane)
-        elif 'yen' in method:
-            thresh = threshold_yen(plane)
-        else:
-            raise NotImplementedError(
-                'thresholding method not supported'
-            )
+        thresh = auto_threshold(plane, method)
         return self._apply_threshold(plane, thresh)
 
     def _manual_threshold(self, plane, thresh):
@@ -105,32 +203,10 @@ class Segment:
 
     def _find_regions(self, binary, image, scale_factor):
         label_image = label(binary)
-        # image_label_overlay = label2rgb(label_image, image=image)
-
-        # fig, ax = plt.subplots(figsize=(10, 6))
-        # ax.imshow(image_label_overlay)
-        regions = []
-        for region in regionprops(label_image):
-            # take regions with large enough areas
-            if region.area >= 100:
-                # draw rectangle around segmented coins
-                minr, minc, maxr, maxc = region.bbox
-                regions.append([minc, minr, maxc - minc, maxr - minr])
-                # rect = mpatches.Rectangle((minc, minr), maxc - minc, maxr - minr,
-                #                         fill=False, edgecolor='red', linewidth=2)
-                # ax.add_patch(rect)
-
-        # ax.set_axis_off()
-        # plt.tight_layout()
-        # plt.show()
-        regions = sorted(regions)
-        scaled_regions = []
-        for region in regions:
-            scaled_regions.append(
-                RectRegion(*region, scale_factor)
-            )
-
-        return scaled_regions
+        boxes = region_boxes(label_image, **self.filters)
+        return [
+            RectRegion(*[int(v) for v in box], scale_factor) for box in boxes
+        ]
 
     def run(self, image):
 
@@ -0,0 +1,159 @@
+import json
+import hashlib
+
+from .plan import CropPlan
+
+
+def region_cost(entry, region):
+    """
+    Estimated cost of cropping a region - its area in the crop
+    level times the number of channels written
+
+    :returns int
+    """
+    _, _, w, h = region['region']
+    return w * h * len(entry['channels'])
+
+
+def plan_digest(plan):
+    """
+    Digest of a plan - shards are only merged if they were cut
+    from the same plan
+
+    :returns str
+    """
+    text = json.dumps(plan.to_dict(), sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def shard_costs(plan, count):
+    """
+    Split the regions of a plan between count shards so the total
+    cost of each is as even as possible. The largest regions are
+    placed first, each on the shard with the least work so far -
+    ties go by slide, region and shard index so every process
+    cutting the same plan gets the same answer.
+
+    :param plan: plan to split
+    :type plan: CropPlan class instance
+    :param count: number of shards
+    :type count: int
+    :returns list of the (slide index, region index) of each shard
+    and list of the cost of each shard
+    """
+    if count < 1:
+        raise ValueError('The number of shards must be at least 1')
+    items = []
+    for sid, entry in enumerate(plan.slides):
+        for rid, region in enumerate(entry['regions']):
+            items.append((-region_cost(entry, region), sid, rid))
+    items.sort()
+
+    shards = [[] for _ in range(count)]
+    costs = [0] * count
+    for cost, sid, rid in items:
+        index = min(range(count), key=lambda i: (costs[i], i))
+        shards[index].append((sid, rid))
+        costs[index] -= cost
+    return shards, costs
+
+
+def shard_plan(plan, index, count):
+    """
+    Part of a plan given to shard index of count - the slides it
+    keeps only hold the regions of this shard, with their ids and
+    output names unchanged
+
+    :param plan: plan to split
+    :type plan: CropPlan class instance
+    :param index: shard index starting at 0
+    :type index: int
+    :param count: number of shards
+    :type count: int
+    :returns CropPlan class instance and estimated cost of the shard
+    """
+    if not 0 <= index < count:
+        raise ValueError('Shard {} is not one of {}'.format(index, count))
+    shards, costs = shard_costs(plan, count)
+    mine = set(shards[index])
+
+    slides = []
+    for sid, entry in enumerate(plan.slides):
+        regions = [
+            region for rid, region in enumerate(entry['regions'])
+            if (sid, rid) in mine
+        ]
+        if regions:
+            entry = dict(entry)
+            entry['regions'] = regions
+            entry['bytes'] = sum(region['bytes'] for region in regions)
+            slides.append(entry)
+    return CropPlan(slides), costs[index]
+
+
+def merge_manifests(manifests):
+    """
+    Combine the manifests written by every shard of a plan into
+    one report - the regions of a slide split between shards are
+    put back together
+
+    :param manifests: manifest of each shard as written by
+    'slidecrop run --shard'
+    :type manifests: list
+    :returns dict
+    """
+    if not manifests:
+        raise ValueError('No shard manifests to merge')
+    if any('shard' not in m for m in manifests):
+        raise ValueError('Only the manifests of shards can be merged')
+    digests = set(m['plan_digest'] for m in manifests)
+    counts = set(m['shards'] for m in manifests)
+    if len(digests) > 1 or len(counts) > 1:
+        raise ValueError('The shards were not cut from the same plan')
+    count = counts.pop()
+    manifests = sorted(manifests, key=lambda m: m['shard'])
+    indices = [m['shard'] for m in manifests]
+    missing = sorted(set(range(count)) - set(indices))
+    if missing or len(indices) != len(set(indices)):
+        raise ValueError(
+            'Expected each of {} shards once, missing {} in {}'.
+            format(count, missing, indices)
+        )
+
+    slides = {}
+    for manifest in manifests:
+        for record in manifest['slides']:
+            key = (record['path'], record['output'])
+            merged = slides.get(key)
+            if merged is None:
+                merged = slides[key] = {
+                    'path': record['path'], 'output': record['output'],
+                    'status': 'done', 'shards': [], 'crop_seconds': 0,
+                    'bytes_read': 0, 'bytes_written': 0, 'regions': []
+                }
+            merged['shards'].append(manifest['shard'])
+            merged['crop_seconds'] += record.get('crop_seconds', 0)
+            merged['bytes_read'] += record.get('bytes_read', 0)
+            merged['bytes_written'] += record.get('bytes_written', 0)
+            merged['regions'].extend(record['regions'])
+            if record['status'] != 'done':
+                merged['status'] = record['status']
+                merged.setdefault('errors', []).append(record.get('error'))
+
+    records = list(slides.values())
+    for record in records:
+        record['regions'].sort(key=lambda region: region['id'])
+    return {
+        'plan': manifests[0]['plan'],
+        'plan_digest': manifests[0]['plan_digest'],
+        'shards': count,
+        'seconds': max(m['seconds'] for m in manifests),
+        'shard_seconds': [m['seconds'] for m in manifests],
+        'shard_costs': [m['cost'] for m in manifests],
+        'slides': records,
+        'failures': sum(r['status'] != 'done' for r in records),
+        'regions': sum(len(r['regions']) for r in records),
+        'bytes_planned': sum(m['bytes_planned'] for m in manifests),
+        'bytes_read': sum(r['bytes_read'] for r in records),
+        'bytes_written': sum(r['bytes_written'] for r in records)
+    }
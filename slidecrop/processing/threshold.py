@@ -0,0 +1,156 @@
+import numpy as np
+
+
+def _trim(hist, bin_centers=None):
+    """
+    Drop the empty bins at either end of a histogram - this
+    matches the histogram scikit-image builds from an integer
+    image, which runs from the smallest to the largest value
+
+    :param hist: counts in each bin
+    :type hist: numpy array
+    :param bin_centers: intensity of each bin - defaults to
+    the bin index
+    :type bin_centers: numpy array
+    :returns tuple of counts and bin centers
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    if bin_centers is None:
+        bin_centers = np.arange(hist.size)
+    filled = np.flatnonzero(hist)
+    if filled.size == 0:
+        raise ValueError('histogram is empty')
+    start, end = filled[0], filled[-1] + 1
+    return hist[start:end], np.asarray(bin_centers)[start:end]
+
+
+def threshold_isodata(hist, bin_centers=None):
+    """
+    Ridler-Calvard (isodata) threshold found from a histogram
+
+    :returns threshold value
+    """
+    counts, centers = _trim(hist, bin_centers)
+    if centers.size == 1:
+        return centers[0]
+    csuml = np.cumsum(counts)
+    csumh = csuml[-1] - csuml
+    csum_intensity = np.cumsum(counts * centers)
+    lower = csum_intensity[:-1] / csuml[:-1]
+    higher = (csum_intensity[-1] - csum_intensity[:-1]) / csumh[:-1]
+    all_mean = (lower + higher) / 2.0
+    distances = all_mean - centers[:-1]
+    bin_width = centers[1] - centers[0]
+    thresholds = centers[:-1][(distances >= 0) & (distances < bin_width)]
+    return thresholds[0]
+
+
+def threshold_mean(hist, bin_centers=None):
+    """
+    Mean grey value found from a histogram
+
+    :returns threshold value
+    """
+    counts, centers = _trim(hist, bin_centers)
+    return np.sum(counts * centers) / np.sum(counts)
+
+
+def threshold_otsu(hist, bin_centers=None):
+    """
+    Otsu's threshold found from a histogram
+
+    :returns threshold value
+    """
+    counts, centers = _trim(hist, bin_centers)
+    if centers.size == 1:
+        return centers[0]
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centers) / weight1
+    mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    # the last value of weight1/mean1 pairs with a class 2 that is empty
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return centers[np.argmax(variance12)]
+
+
+def threshold_triangle(hist, bin_centers=None):
+    """
+    Triangle threshold found from a histogram
+
+    :returns threshold value
+    """
+    counts, centers = _trim(hist, bin_centers)
+    if centers.size == 1:
+        return centers[0]
+    nbins = counts.size
+    arg_peak = np.argmax(counts)
+    peak_height = counts[arg_peak]
+    arg_low, arg_high = 0, nbins - 1
+
+    # work along the longer tail of the histogram
+    flip = arg_peak - arg_low < arg_high - arg_peak
+    if flip:
+        counts = counts[::-1]
+        arg_low = nbins - arg_high - 1
+        arg_peak = nbins - arg_peak - 1
+
+    width = arg_peak - arg_low
+    x1 = np.arange(width)
+    y1 = counts[x1 + arg_low]
+    norm = np.sqrt(peak_height ** 2 + width ** 2)
+    length = (peak_height / norm) * x1 - (width / norm) * y1
+    arg_level = np.argmax(length) + arg_low
+
+    if flip:
+        arg_level = nbins - arg_level - 1
+    return centers[arg_level]
+
+
+def threshold_yen(hist, bin_centers=None):
+    """
+    Yen's threshold found from a histogram
+
+    :returns threshold value
+    """
+    counts, centers = _trim(hist, bin_centers)
+    if centers.size == 1:
+        return centers[0]
+    pmf = counts / counts.sum()
+    p1 = np.cumsum(pmf)
+    p1_sq = np.cumsum(pmf ** 2)
+    p2_sq = np.cumsum(pmf[::-1] ** 2)[::-1]
+    crit = np.log(
+        ((p1_sq[:-1] * p2_sq[1:]) ** -1) * (p1[:-1] * (1.0 - p1[:-1])) ** 2
+    )
+    return centers[crit.argmax()]
+
+
+METHODS = {
+    'isodata': threshold_isodata,
+    'mean': threshold_mean,
+    'otsu': threshold_otsu,
+    'triangle': threshold_triangle,
+    'yen': threshold_yen
+}
+
+
+def histogram_threshold(hist, method='otsu', bin_centers=None):
+    """
+    Threshold found from a histogram by the named method. Only
+    the (256) bins of the histogram are visited - the slide
+    pixels are never read.
+
+    :param hist: counts in each bin, such as the histogram
+    stored for a channel in the *.ims file
+    :type hist: numpy array
+    :param method: 'isodata', 'mean', 'otsu', 'triangle' or 'yen'
+    :type method: str
+    :param bin_centers: intensity of each bin - defaults to
+    the bin index
+    :type bin_centers: numpy array
+    :returns threshold value
+    """
+    for name, fn in METHODS.items():
+        if name in method:
+            return fn(hist, bin_centers)
+    raise NotImplementedError('thresholding method not supported')
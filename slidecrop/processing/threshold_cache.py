@@ -0,0 +1,183 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.slidecrop', 'thresholds.json'
+)
+
+
+def slide_identity(filepath):
+    """
+    Identity of a slide file - thresholds are only reused while
+    path, size and modification time all match
+
+    :returns str
+    """
+    stat = os.stat(filepath)
+    return '{}|{}|{}'.format(
+        os.path.realpath(filepath), stat.st_size, stat.st_mtime
+    )
+
+
+class ThresholdCache:
+    """
+    Memo of auto thresholds keyed by slide identity, resolution
+    level, channel and method. The least recently used thresholds
+    are dropped once more than max_items are held, and thresholds
+    of a slide that has been rewritten are never returned.
+
+    When a path is given the thresholds are loaded from it and
+    written back by save() so they are kept between sessions.
+
+    Can be used as follows:
+    cache = ThresholdCache()
+    thresholds = cache.get_channels(path, level, 'otsu', size_c)
+    if thresholds is None:
+        thresholds = ...
+        cache.put_channels(path, level, 'otsu', thresholds)
+    """
+    def __init__(self, path=None, max_items=10000):
+        """
+        Constructor
+
+        :param path: optional *.json file the thresholds are kept in
+        :type path: str
+        :param max_items: number of thresholds held before the
+        least recently used are dropped
+        :type max_items: int
+        """
+        self.path = path
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            self.load()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _key(self, filepath, level, channel, method):
+        return '{}|{}|{}|{}'.format(
+            slide_identity(filepath), level, channel, method.lower()
+        )
+
+    def get(self, filepath, level, channel, method):
+        """
+        :returns threshold or None
+        """
+        key = self._key(filepath, level, channel, method)
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, filepath, level, channel, method, threshold):
+        key = self._key(filepath, level, channel, method)
+        with self._lock:
+            self._items[key] = float(threshold)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def get_channels(self, filepath, level, method, size_c):
+        """
+        :returns list of the thresholds of every channel or None
+        if any of them is not held
+        """
+        thresholds = []
+        for c in range(size_c):
+            value = self.get(filepath, level, c, method)
+            if value is None:
+                return None
+            thresholds.append(value)
+        return thresholds
+
+    def put_channels(self, filepath, level, method, thresholds):
+        for c, threshold in enumerate(thresholds):
+            self.put(filepath, level, c, method, threshold)
+
+    def load(self):
+        """
+        Read the thresholds kept in path - a missing or
+        unreadable file leaves the cache empty
+        """
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if saved.get('version') != CACHE_VERSION:
+            return
+        self.update(saved.get('thresholds', []))
+
+    def items(self):
+        """
+        :returns list of (key, threshold) from least to most
+        recently used
+        """
+        with self._lock:
+            return list(self._items.items())
+
+    def update(self, items):
+        """
+        Add thresholds returned by items() of another cache
+        """
+        with self._lock:
+            for key, value in items:
+                self._items[key] = value
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def save(self):
+        """
+        Write the thresholds to path, replacing the file atomically
+
+        :returns path or None if there is no path or it could
+        not be written
+        """
+        if self.path is None:
+            return None
+        saved = {'version': CACHE_VERSION, 'thresholds': self.items()}
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(saved, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            return None
+        return self.path
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# shared by everything in the process that thresholds slides
+_cache = ThresholdCache()
+
+
+def threshold_cache():
+    """
+    :returns the ThresholdCache shared by the process
+    """
+    return _cache
+
+
+def set_threshold_cache(cache):
+    """
+    Replace the shared cache, e.g. with one kept on disk:
+    set_threshold_cache(ThresholdCache(DEFAULT_CACHE_PATH))
+    """
+    global _cache
+    _cache = cache
@@ -0,0 +1,252 @@
+import numpy as np
+from scipy.ndimage import find_objects, label
+
+from ..ims import lowres
+from .segmentation import RectRegion, Segment, filter_boxes
+from .threshold import histogram_threshold
+
+
+class _UnionFind:
+    """
+    Disjoint sets of labels - used to join the parts of a
+    component that were labelled in different tiles
+    """
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, a):
+        root = a
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        # compress the path walked
+        while a != root:
+            self.parent[a], a = root, self.parent.get(a, a)
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def roots(self, count):
+        """
+        :returns numpy array holding the root of labels 0 to count
+        """
+        roots = np.arange(count + 1)
+        for a in self.parent:
+            roots[a] = self.find(a)
+        return roots
+
+
+def _seam_pairs(a, b):
+    """
+    Labels that touch across a seam - a and b are the rows (or
+    columns) either side of it. With 8-connectivity each pixel
+    touches the three nearest pixels on the other side.
+
+    :returns numpy array of label pairs
+    """
+    pairs = [np.stack([a, b], axis=1)]
+    if a.size > 1:
+        pairs.append(np.stack([a[1:], b[:-1]], axis=1))
+        pairs.append(np.stack([a[:-1], b[1:]], axis=1))
+    pairs = np.concatenate(pairs)
+    pairs = pairs[(pairs[:, 0] > 0) & (pairs[:, 1] > 0)]
+    return np.unique(pairs, axis=0)
+
+
+class TiledSegment:
+    """
+    Segments a resolution level of a slide tile by tile so that
+    finer levels than the low resolution image can be used
+    without holding the whole level in memory.
+
+    Each tile is read with a margin wide enough for the closing
+    to be exact in its interior, then thresholded, closed and
+    labelled. Components cut by the tile seams are joined with a
+    union-find over the labels either side of each seam. Only
+    one tile, the bottom row of the previous row of tiles and the
+    area and box of each label are held at any time. The regions
+    are the same as Segment would find on the whole level.
+
+    Can be used as follows:
+    with SlideImage(path) as slide:
+        segmenter = TiledSegment(slide, 2, threshold=200)
+        regions = segmenter.run()
+    """
+    def __init__(self, slide, level, channel=0, thresh_method='manual',
+                 threshold=None, crop_level=0, tile_size=(2048, 2048),
+                 kernel=3, min_area=None, **filters):
+        """
+        Constructor
+
+        :param slide: SlideImage instance
+        :type slide: SlideImage class instance
+        :param level: resolution level to segment
+        :type level: int
+        :param channel: channel to segment
+        :type channel: int
+        :param thresh_method: 'manual' or an auto threshold method
+        found from the histogram of the level
+        :type thresh_method: str
+        :param threshold: threshold used with 'manual'
+        :type threshold: float
+        :param crop_level: level the regions are scaled to
+        :type crop_level: int
+        :param tile_size: minimum yx size of the tiles read - tiles
+        are padded out to whole chunks
+        :type tile_size: tuple
+        :param kernel: size of the square used for closing
+        :type kernel: int
+        :param min_area: smallest region (pixels of this level) kept -
+        defaults to the 100 pixels Segment keeps in the low resolution
+        image scaled to this level
+        :type min_area: int
+        :param filters: other shape filters as taken by Segment
+        """
+        self.slide = slide
+        self.level = level
+        self.channel = channel
+        self.crop_level = crop_level
+        self.tile_size = tile_size
+        self.kernel = kernel
+
+        size_x, size_y = slide.level_dimensions(level)
+        low_x, low_y = slide.level_dimensions(slide.segmentation_level)
+        if min_area is None:
+            min_area = int(round(
+                100 * (float(size_x) / low_x) * (float(size_y) / low_y)
+            ))
+        crop_x, crop_y = slide.level_dimensions(crop_level)
+        self.scale_factor = (
+            float(crop_x) / size_x, float(crop_y) / size_y
+        )
+
+        if 'manual' not in thresh_method:
+            hist = lowres.histogram(slide, r=level, c=channel)
+            centers = lowres.bin_centers(slide, r=level, c=channel)
+            threshold = histogram_threshold(hist, thresh_method, centers)
+        elif threshold is None:
+            raise ValueError('You must supply a value for thresholding')
+        self.threshold = threshold
+
+        # used for thresholding and closing so tiles are
+        # treated exactly as Segment treats a whole plane
+        self.segmenter = Segment(
+            slide.microscope_mode, self.scale_factor, channel=channel,
+            thresh_method='manual', threshold=threshold,
+            min_area=min_area, **filters
+        )
+
+    def _read_tile(self, tile, size_x, size_y):
+        """
+        Read, threshold and close a tile
+
+        :returns binary numpy array of the tile
+        """
+        x, y, w, h = tile
+        # the closing is a dilation then an erosion, each reaching
+        # kernel // 2 pixels, so this margin makes the tile exact
+        margin = 2 * (self.kernel // 2)
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        x1, y1 = min(x + w + margin, size_x), min(y + h + margin, size_y)
+        pix = self.slide.read_region(
+            [x0, y0, x1 - x0, y1 - y0], self.level, self.channel
+        )
+        if pix is None:
+            raise IOError(
+                'Could not read tile {} of level {}'.format(tile, self.level)
+            )
+        binary = self.segmenter._manual_threshold(pix, self.threshold)
+        closed = self.segmenter._close_binary(binary, self.kernel)
+        return closed[y - y0: y - y0 + h, x - x0: x - x0 + w]
+
+    def run(self):
+        """
+        Segment the level
+
+        :returns list of RectRegion scaled to the crop level
+        """
+        size_x, size_y = self.slide.level_dimensions(self.level)
+        tiles = self.slide.aligned_tiles(
+            [0, 0, size_x, size_y], self.level, self.channel,
+            tile_size=self.tile_size
+        )
+        structure = np.ones((3, 3), dtype=bool)
+        sets = _UnionFind()
+        spans = []
+        areas = []
+        count = 0
+
+        above = None
+        bottom = np.zeros(size_x, dtype=np.int64)
+        top = np.zeros(size_x, dtype=np.int64)
+        left = None
+        row_y = None
+        for tile in tiles:
+            x, y, w, h = tile
+            if y != row_y:
+                # a new row of tiles - join the row just finished
+                # to the row above it
+                if above is not None:
+                    for a, b in _seam_pairs(above, top):
+                        sets.union(a, b)
+                above = bottom
+                bottom = np.zeros(size_x, dtype=np.int64)
+                top = np.zeros(size_x, dtype=np.int64)
+                left = None
+                row_y = y
+
+            local, n = label(self._read_tile(tile, size_x, size_y), structure)
+            if n:
+                # ndimage.label numbers the components 1 to n
+                areas.append(np.bincount(local.ravel(), minlength=n + 1)[1:])
+                for rows, cols in find_objects(local):
+                    spans.append((
+                        x + cols.start, y + rows.start,
+                        x + cols.stop, y + rows.stop
+                    ))
+            labels = np.where(local > 0, local.astype(np.int64) + count, 0)
+            count += n
+
+            if left is not None:
+                for a, b in _seam_pairs(left, labels[:, 0]):
+                    sets.union(a, b)
+            left = labels[:, -1]
+            top[x: x + w] = labels[0]
+            bottom[x: x + w] = labels[-1]
+
+        if above is not None:
+            for a, b in _seam_pairs(above, top):
+                sets.union(a, b)
+        if not count:
+            return []
+
+        # gather the parts of each component at its root label
+        roots = sets.roots(count)[1:]
+        spans = np.array(spans, dtype=np.int64)
+        area = np.concatenate(areas)
+        total = np.bincount(roots, weights=area, minlength=count + 1)
+        joined = np.zeros((count + 1, 4), dtype=np.int64)
+        joined[:, :2] = np.iinfo(np.int64).max
+        np.minimum.at(joined[:, 0], roots, spans[:, 0])
+        np.minimum.at(joined[:, 1], roots, spans[:, 1])
+        np.maximum.at(joined[:, 2], roots, spans[:, 2])
+        np.maximum.at(joined[:, 3], roots, spans[:, 3])
+
+        # drop components touching the edge of the level,
+        # as clear_border does
+        ids = np.unique(roots)
+        joined = joined[ids]
+        total = total[ids]
+        inside = (
+            (joined[:, 0] > 0) & (joined[:, 1] > 0) &
+            (joined[:, 2] < size_x) & (joined[:, 3] < size_y)
+        )
+        boxes = filter_boxes(
+            joined[inside], total[inside], **self.segmenter.filters
+        )
+        return [
+            RectRegion(*[int(v) for v in box], self.scale_factor)
+            for box in boxes
+        ]
@@ -0,0 +1,59 @@
+import os
+import time
+import argparse
+import tempfile
+
+from ..ims.slide import SlideImage
+from ..ome.ometiff import OMETiffGenerator
+
+
+def benchmark(filepath, region, outputdir, level=0, workers=None):
+    with SlideImage(filepath) as slide:
+        channels = [c for c in range(slide.size_c)]
+        itemsize = slide._dataset(level, 0, channels[0]).dtype.itemsize
+        raw_mb = region[2] * region[3] * len(channels) * itemsize / 2.0**20
+        print('region {} - {:.1f} MB of pixels'.format(region, raw_mb))
+        print('{:<22}{:>10}{:>12}{:>10}'.format('output', 'MB/s', 'size (MB)', 'ratio'))
+
+        for compression in (None, 'deflate', 'zstd', 'lzw'):
+            name = compression or 'uncompressed'
+            filename = 'benchmark_{}.ome.tif'.format(name)
+            ometiff = OMETiffGenerator(
+                slide, filename, outputdir, channels, level, 0,
+                compression=compression, encode_workers=workers
+            )
+            tic = time.time()
+            ometiff.run(region)
+            toc = time.time()
+
+            size_mb = os.path.getsize(ometiff.outputpath) / 2.0**20
+            print('{:<22}{:>10.1f}{:>12.1f}{:>10.2f}'.format(
+                name, raw_mb / (toc - tic), size_mb, raw_mb / size_mb
+            ))
+            os.remove(ometiff.outputpath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Throughput and size of tiled OME-TIFF output by compression'
+    )
+    parser.add_argument('--filepath', help='slide to crop - a synthetic slide is used if not given')
+    parser.add_argument('--region', type=int, nargs=4, help='x y w h of the region to crop')
+    parser.add_argument('--level', type=int, default=0, help='resolution level to crop')
+    parser.add_argument('--workers', type=int, help='number of encoding threads')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = args.filepath
+        region = args.region
+        if filepath is None:
+            # mostly white background around a single section
+            from ..tests.synthetic import make_ims, sections_image
+            import numpy as np
+            plane = sections_image(8192, 8192, [(2000, 1500, 3000, 4000)])
+            noise = np.random.RandomState(0).randint(0, 30, (4000, 3000))
+            plane[1500:5500, 2000:5000] += noise.astype(np.uint8)
+            filepath = make_ims(os.path.join(tmpdir, 'synthetic.ims'), plane,
+                                levels=1, chunks=(256, 256))
+            region = [0, 0, 8192, 8192]
+        benchmark(filepath, region, tmpdir, args.level, args.workers)
@@ -0,0 +1,71 @@
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from ..ims.slide import SlideImage
+
+
+def float64_low_resolution_image(slide, r):
+    """
+    The previous read path - a float64 array filled channel by channel
+    """
+    size_x, size_y = slide.level_dimensions(r)
+    region = [0, 0, size_x, size_y]
+    pix = np.zeros((slide.size_c, size_y, size_x))
+    for c in range(slide.size_c):
+        pix[c, :, :] = slide.read_region(region, r, c)
+    return pix
+
+
+def measure(fn):
+    tracemalloc.start()
+    tic = time.time()
+    result = fn()
+    toc = time.time()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, toc - tic
+
+
+def benchmark(filepath, r):
+    with SlideImage(filepath, use_index=False) as slide:
+        size_x, size_y = slide.level_dimensions(r)
+        print('level {} is {} x {} x {} channels'.format(r, size_x, size_y, slide.size_c))
+
+        old, old_peak, old_time = measure(
+            lambda: float64_low_resolution_image(slide, r)
+        )
+        del old
+        new, new_peak, new_time = measure(lambda: slide.low_resolution_image(r))
+        out = np.empty_like(new)
+        del new
+        _, out_peak, out_time = measure(lambda: slide.low_resolution_image(r, out=out))
+
+    print('{:<28}{:>14}{:>10}'.format('read path', 'peak (MB)', 'time (s)'))
+    for name, peak, elapsed in (('float64 (previous)', old_peak, old_time),
+                                ('source dtype', new_peak, new_time),
+                                ('source dtype, out=', out_peak, out_time)):
+        print('{:<28}{:>14.1f}{:>10.2f}'.format(name, peak / 2**20, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Peak memory of reading a whole resolution level'
+    )
+    parser.add_argument('--filepath', help='slide to read - a synthetic slide is used if not given')
+    parser.add_argument('--level', type=int, default=0, help='resolution level to read')
+    args = parser.parse_args()
+
+    if args.filepath:
+        benchmark(args.filepath, args.level)
+    else:
+        from ..tests.synthetic import make_ims, sections_image
+        with tempfile.TemporaryDirectory() as tmpdir:
+            plane = sections_image(4096, 6144, [(500, 600, 2000, 2500)])
+            path = make_ims(os.path.join(tmpdir, 'synthetic.ims'), plane,
+                            levels=1, chunks=(256, 256))
+            benchmark(path, args.level)
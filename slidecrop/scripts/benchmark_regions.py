@@ -0,0 +1,40 @@
+import time
+import argparse
+
+from skimage.measure import label
+
+from ..processing.segmentation import region_boxes
+from ..tests.synthetic import debris_image, regionprops_boxes
+
+
+def benchmark(size, count, repeat):
+    label_image = label(debris_image(size, count))
+    print('{} x {} image with {} components'.format(
+        size, size, label_image.max())
+    )
+
+    results = {}
+    for name, fn in (('regionprops loop', regionprops_boxes),
+                     ('region_boxes', region_boxes)):
+        times = []
+        for _ in range(repeat):
+            tic = time.time()
+            boxes = fn(label_image, min_area=100)
+            times.append(time.time() - tic)
+        results[name] = [list(b) for b in boxes]
+        print('{:<20}{:>10.3f} s{:>8} regions'.format(name, min(times), len(boxes)))
+
+    assert results['regionprops loop'] == [
+        [int(v) for v in b] for b in results['region_boxes']
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time region extraction from a label image'
+    )
+    parser.add_argument('--size', type=int, default=2048, help='image size (pixels)')
+    parser.add_argument('--count', type=int, default=20000, help='number of debris specks')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs')
+    args = parser.parse_args()
+    benchmark(args.size, args.count, args.repeat)
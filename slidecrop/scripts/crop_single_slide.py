@@ -41,7 +41,7 @@ if __name__=='__main__':
 
     crop_level = None
     if args.crop_level:
-        crop_level = args.crop_level
+        crop_level = int(args.crop_level)
 
     threshold_method = 'otsu'
     if args.threshold_method:
@@ -56,8 +56,8 @@ if __name__=='__main__':
         seg_channel = int(args.segmentation_channel)
 
     seg_level = None
-    if args.segmentation_channel:
-        seg_channel = int(args.segmentation_channel)
+    if args.seg_level:
+        seg_level = int(args.seg_level)
 
     rotation = 0
     parameters = [
@@ -67,4 +67,4 @@ if __name__=='__main__':
     crop_slide(filepath, outputdir, crop_level=crop_level,
                seg_channel=seg_channel, seg_level=seg_level,
                threshold_method=threshold_method,
-               threshold=threshold, rotation=rotation)
\ No newline at end of file
+               threshold=threshold, rotation=rotation, progress=print)
\ No newline at end of file
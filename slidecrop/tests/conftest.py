@@ -0,0 +1,14 @@
+import pytest
+
+from ..ims.index import INDEX_DIR_ENV
+
+
+@pytest.fixture(autouse=True)
+def index_dir(tmp_path, monkeypatch):
+    """
+    Keep the slide indexes written by a test (including those of
+    its pool workers) out of the home directory
+    """
+    path = str(tmp_path / 'index')
+    monkeypatch.setenv(INDEX_DIR_ENV, path)
+    return path
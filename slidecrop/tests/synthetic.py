@@ -0,0 +1,117 @@
+import numpy as np
+import h5py
+from skimage.measure import regionprops
+
+
+def _attr(value):
+    """
+    Imaris stores attribute values as arrays of single bytes
+    """
+    return np.array([c.encode('utf-8') for c in str(value)], dtype='|S1')
+
+
+def sections_image(size_y, size_x, sections, background=230, foreground=40):
+    """
+    Bright field style plane with dark rectangular sections
+
+    :param sections: list of x, y, w, h rectangles
+    :returns uint8 numpy array
+    """
+    plane = np.full((size_y, size_x), background, dtype=np.uint8)
+    for x, y, w, h in sections:
+        plane[y: y + h, x: x + w] = foreground
+    return plane
+
+
+def make_ims(path, plane, size_c=3, levels=3, chunks=(64, 64),
+             mode='MetaCyte TL', shuffle=False):
+    """
+    Write a minimal Imaris file holding a resolution pyramid
+    of a 2D plane (repeated for every channel) for testing
+
+    :param path: path of the *.ims file to write
+    :param plane: full resolution plane as 2D unsigned integer
+    array - the data is stored in its dtype
+    :param size_c: number of channels
+    :param levels: number of resolution levels
+    :param chunks: yx chunk shape of the Data datasets
+    :param mode: MicroscopeMode attribute
+    :param shuffle: apply the HDF5 shuffle filter
+    :returns path
+    """
+    with h5py.File(path, 'w') as f:
+        level_plane = plane
+        for r in range(levels):
+            size_y, size_x = level_plane.shape
+            # stored extent is padded out to whole chunks
+            pad_y = -(-size_y // chunks[0]) * chunks[0]
+            pad_x = -(-size_x // chunks[1]) * chunks[1]
+            data = np.zeros((1, pad_y, pad_x), dtype=plane.dtype)
+            data[0, :size_y, :size_x] = level_plane
+            hist = np.bincount(level_plane.ravel(), minlength=256)
+            for c in range(size_c):
+                group = f.create_group(
+                    '/DataSet/ResolutionLevel {}/TimePoint 0/Channel {}'.
+                    format(r, c)
+                )
+                group.create_dataset(
+                    'Data', data=data, chunks=(1,) + tuple(chunks),
+                    compression='gzip', shuffle=shuffle
+                )
+                group.create_dataset('Histogram', data=hist.astype(np.uint64))
+                group.attrs['HistogramMin'] = _attr('0.000')
+                group.attrs['HistogramMax'] = _attr(
+                    '{:.3f}'.format(hist.size - 1)
+                )
+                group.attrs['ImageSizeX'] = _attr(size_x)
+                group.attrs['ImageSizeY'] = _attr(size_y)
+            level_plane = level_plane[::2, ::2]
+
+        colors = ['1 0 0', '0 1 0', '0 0 1']
+        for c in range(size_c):
+            info = f.create_group('/DataSetInfo/Channel {}'.format(c))
+            info.attrs['Name'] = _attr('Channel {}'.format(c))
+            info.attrs['Color'] = _attr(colors[c % 3])
+            mf = f.create_group('/DataSetInfo/MF Capt Channel {}'.format(c + 1))
+            mf.attrs['Name'] = _attr('Channel {}'.format(c))
+
+        image = f.create_group('/DataSetInfo/Image')
+        size_y, size_x = plane.shape
+        for key, value in (('MicroscopeMode', mode), ('LensPower', '10'),
+                           ('RecordingDate', '2019-01-01 00:00:00'),
+                           ('ExtMin0', 0), ('ExtMax0', size_x),
+                           ('ExtMin1', 0), ('ExtMax1', size_y),
+                           ('ExtMin2', 0), ('ExtMax2', 1)):
+            image.attrs[key] = _attr(value)
+        f.create_group('/DataSetInfo/Imaris').attrs['Version'] = _attr('7.0')
+        f.create_group('/DataSetInfo/ImarisDataSet').attrs['Version'] = _attr('5.5')
+    return path
+
+
+def regionprops_boxes(label_image, min_area=100):
+    """
+    The previous extraction - a Python loop over regionprops
+    """
+    regions = []
+    for region in regionprops(label_image):
+        if region.area >= min_area:
+            minr, minc, maxr, maxc = region.bbox
+            regions.append([minc, minr, maxc - minc, maxr - minr])
+    return sorted(regions)
+
+
+def debris_image(size, count, seed=0):
+    """
+    Binary image holding a few large sections and
+    many small specks of debris
+    """
+    rng = np.random.RandomState(seed)
+    binary = np.zeros((size, size), dtype=bool)
+    for _ in range(count):
+        y, x = rng.randint(0, size - 12, 2)
+        h, w = rng.randint(1, 12, 2)
+        binary[y: y + h, x: x + w] = True
+    for _ in range(20):
+        y, x = rng.randint(0, size - 200, 2)
+        binary[y: y + 150, x: x + 120] = True
+    return binary
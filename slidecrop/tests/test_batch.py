@@ -0,0 +1,112 @@
+import os
+import signal
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import tifffile
+from skimage.filters import threshold_otsu
+
+from ..ims.slide import SlideImage
+from ..processing.batch import BatchCrop, scan_slides
+from .synthetic import make_ims, sections_image
+
+
+def test_batch_crop_on_several_processes(tmp_path):
+    sections = [[(70, 60, 200, 150), (400, 300, 180, 120)], [(50, 80, 300, 250)]]
+    paths = []
+    for i, rects in enumerate(sections):
+        plane = sections_image(512, 640, rects)
+        paths.append(make_ims(str(tmp_path / 'slide{}.ims'.format(i)), plane))
+    paths.append(str(tmp_path / 'missing.ims'))
+
+    counts = {}
+    progress = []
+    # a budget of one byte only lets one slide be cropped at a time
+    batch = BatchCrop(workers=2, memory_budget=1)
+    failures = batch.run(
+        paths, [str(tmp_path)] * 3, [0] * 3, [128] * 3,
+        sections=lambda sid, n: counts.update({sid: n}),
+        progress=lambda sid, rid: progress.append((sid, rid))
+    )
+
+    assert [sid for sid, _ in failures] == [2]
+    assert counts == {0: 2, 1: 1}
+    assert sorted(progress) == [(0, 0), (0, 1), (1, 0)]
+
+    written = tifffile.imread(str(tmp_path / 'slide1_section_0.ome.tif'))
+    assert written.shape[0] == 3
+    assert np.array_equal(written[0], written[2])
+    assert np.mean(written == 40) > 0.9
+    assert os.path.exists(str(tmp_path / 'slide0_section_1.ome.tif'))
+
+
+def test_admission_always_lets_one_crop_run():
+    batch = BatchCrop(workers=4, memory_budget=100)
+    assert batch._admit(1000, 0, 0)
+    assert not batch._admit(60, 50, 1)
+    assert batch._admit(50, 50, 1)
+
+
+def test_scan_slides_streams_each_slide(tmp_path):
+    paths = []
+    for i in range(3):
+        plane = sections_image(256, 320, [(20 + 10 * i, 30, 150, 120)])
+        plane[:] += (np.arange(320, dtype=np.uint8) % (3 + i))[None, :]
+        paths.append(make_ims(str(tmp_path / 'slide{}.ims'.format(i)), plane))
+
+    rows = {}
+    channels, thresholds = scan_slides(
+        paths, 'otsu', workers=2,
+        result=lambda sid, size_c, thresh: rows.update({sid: thresh})
+    )
+    assert channels == [3, 3, 3]
+    assert sorted(rows) == [0, 1, 2]
+    for sid, path in enumerate(paths):
+        with SlideImage(path) as slide:
+            low = slide.low_resolution_image()
+        assert rows[sid] == thresholds[sid]
+        assert thresholds[sid][1] == threshold_otsu(low[1])
+
+
+def test_scan_slides_reports_bad_slides(tmp_path):
+    path = make_ims(str(tmp_path / 'slide.ims'), sections_image(128, 128, [(20, 20, 60, 60)]))
+    paths = [path, str(tmp_path / 'missing.ims')]
+
+    errors = {}
+    channels, thresholds = scan_slides(
+        paths, 'otsu', workers=2, error=lambda sid, e: errors.update({sid: e})
+    )
+    assert channels == [3, None]
+    assert thresholds[1] is None
+    assert list(errors) == [1]
+
+    errors.clear()
+    _, thresholds = scan_slides(
+        [path], 'unknown', error=lambda sid, e: errors.update({sid: e})
+    )
+    assert thresholds == [None]
+    assert 'NotImplementedError' in errors[0]
+
+
+def test_dead_worker_fails_slides_instead_of_hanging(tmp_path):
+    paths = []
+    for i in range(2):
+        plane = sections_image(256, 256, [(50, 50, 100, 100)])
+        paths.append(make_ims(str(tmp_path / 'slide{}.ims'.format(i)), plane))
+
+    def kill_workers(sid, n):
+        # as if the workers had been killed for using too much memory
+        for process in mp.active_children():
+            os.kill(process.pid, signal.SIGKILL)
+
+    batch = BatchCrop(workers=2)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(batch.run(
+        paths, [str(tmp_path)] * 2, [0] * 2, [128] * 2, sections=kill_workers
+    )))
+    thread.start()
+    thread.join(120)
+    assert not thread.is_alive()
+    assert sorted(sid for sid, _ in result[0]) == [0, 1]
+    assert 'BrokenProcessPool' in batch.records[0]['error']
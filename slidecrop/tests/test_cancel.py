@@ -0,0 +1,131 @@
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+from ..ims.slide import SlideImage
+from ..processing.batch import BatchCrop, scan_slides, _init_worker, _terminate
+from ..processing.cancel import CancelToken, Cancelled
+from ..processing.multicrop import MultiCrop
+from ..processing.threshold_cache import (
+    ThresholdCache, set_threshold_cache, threshold_cache
+)
+from .synthetic import make_ims, sections_image
+
+
+class CountingToken(CancelToken):
+    """
+    Cancels itself on the nth check
+    """
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+
+    def check(self):
+        self.n -= 1
+        if self.n == 0:
+            self.cancel()
+        super().check()
+
+
+def test_multicrop_stops_between_rows(tmp_path):
+    plane = np.random.RandomState(0).randint(0, 255, (600, 700)).astype(np.uint8)
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(64, 64))
+    filenames = ['section_0.ome.tif']
+
+    # the tile is only checked once every row is read, so
+    # the third check is in the sweep
+    token = CountingToken(3)
+    finished = []
+    with SlideImage(path) as slide:
+        crop = MultiCrop(slide, str(tmp_path), [0], cancel=token)
+        with pytest.raises(Cancelled):
+            crop.run([[10, 20, 300, 500]], filenames, progress=finished.append)
+        assert slide.chunk_reads == 2 * 5
+
+    # the partly written file is removed
+    assert not finished
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.tif')]
+
+
+def test_batch_crop_cancelled(tmp_path):
+    plane = sections_image(512, 768, [(100, 100, 200, 300)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane)
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(Cancelled):
+        BatchCrop(workers=1).run(
+            [path], [str(tmp_path)], [0], [128], cancel=token
+        )
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.tif')]
+
+
+def test_batch_crop_cancelled_while_cropping(tmp_path):
+    # the small section is finished long before the large one
+    plane = sections_image(6144, 2048, [(20, 20, 60, 60), (100, 200, 1900, 5800)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(64, 64))
+    out = tmp_path / 'out'
+    out.mkdir()
+
+    token = CancelToken()
+    batch = BatchCrop(workers=1)
+    with pytest.raises(Cancelled):
+        batch.run(
+            [path], [str(out)], [0], [128], cancel=token,
+            progress=lambda sid, rid: token.cancel()
+        )
+    assert batch.records[0]['status'] == 'cancelled'
+    assert os.listdir(str(out)) == []
+
+
+def test_scan_slides_cancelled(tmp_path):
+    paths = []
+    for i in range(4):
+        plane = sections_image(256, 320, [(20 + 10 * i, 30, 150, 120)])
+        paths.append(make_ims(str(tmp_path / 'slide{}.ims'.format(i)), plane))
+
+    previous = threshold_cache()
+    try:
+        cache = ThresholdCache(str(tmp_path / 'thresholds.json'))
+        set_threshold_cache(cache)
+        token = CancelToken()
+        rows = []
+
+        def row(sid, size_c, thresholds):
+            rows.append(sid)
+            token.cancel()
+
+        with pytest.raises(Cancelled):
+            scan_slides(paths, 'otsu', workers=1, result=row, cancel=token)
+    finally:
+        set_threshold_cache(previous)
+
+    # the slide scanned before the stop is still memoised
+    assert len(rows) == 1
+    saved = ThresholdCache(cache.path)
+    assert saved.get_channels(paths[rows[0]], 2, 'otsu', 3) is not None
+
+
+def test_terminate_stops_busy_workers():
+    ctx = mp.get_context('spawn')
+    pids = ctx.SimpleQueue()
+    pool = ProcessPoolExecutor(
+        1, mp_context=ctx, initializer=_init_worker,
+        initargs=(ctx.Queue(), pids)
+    )
+    try:
+        pid = pool.submit(os.getpid).result()
+        busy = pool.submit(time.sleep, 60)
+        start = time.time()
+        _terminate(pool, pids)
+        with pytest.raises(BrokenProcessPool):
+            busy.result(timeout=30)
+        assert time.time() - start < 30
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    with pytest.raises(OSError):
+        os.kill(pid, 0)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from ..ims.slide import SlideImage
+from .synthetic import make_ims, sections_image
+
+
+def test_cached_reads_match_and_hit(tmp_path):
+    plane = sections_image(300, 400, [(20, 30, 150, 200)])
+    plane[:] += (np.arange(300, dtype=np.uint8) % 11)[:, None]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(32, 32))
+
+    with SlideImage(path, cache_bytes=2**20) as slide:
+        region = [10, 20, 150, 100]
+        first = slide.read_region(region, 0, 1)
+        assert np.array_equal(first, plane[20:120, 10:160])
+        misses = slide.cache_stats['misses']
+
+        # an overlapping read only decodes the new chunks
+        reads = slide.chunk_reads
+        second = slide.read_region([40, 20, 150, 100], 0, 1)
+        assert np.array_equal(second, plane[20:120, 40:190])
+        assert slide.cache_stats['hits'] > 0
+        assert slide.chunk_reads - reads == slide.cache_stats['misses'] - misses
+
+        # shrinking the budget evicts
+        slide.cache_budget = 32 * 32
+        assert slide.cache_stats['items'] == 1
+        slide.cache_budget = 0
+        assert np.array_equal(slide.read_region(region, 0, 1), first)
+
+
+def test_multichannel_read_keeps_dtype(tmp_path):
+    plane = sections_image(200, 250, [(20, 30, 100, 80)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(32, 32))
+
+    with SlideImage(path, use_index=False) as slide:
+        low = slide.low_resolution_image(0)
+        assert low.dtype == np.uint8
+        assert np.array_equal(low[2], plane)
+
+        out = np.empty((3, 80, 100), dtype=np.uint8)
+        pix = slide.read_multichannel_region(0, region=[20, 30, 100, 80], out=out)
+        assert pix is out
+        assert np.all(out == 40)
+
+
+def test_raw_read_mode_matches_hdf5(tmp_path):
+    plane = sections_image(300, 400, [(20, 30, 150, 200)])
+    plane[:] += (np.arange(400, dtype=np.uint8) % 9)[None, :]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(48, 64),
+                    shuffle=True)
+
+    region = [15, 25, 330, 270]
+    with SlideImage(path, use_index=False) as slide:
+        expected = slide.read_region(region, 0, 1)
+
+    with SlideImage(path, use_index=False, read_mode='raw',
+                    decode_threads=4, cache_bytes=2**20) as slide:
+        assert np.array_equal(slide.read_region(region, 0, 1), expected)
+        reads = slide.chunk_reads
+        assert np.array_equal(slide.read_region(region, 0, 1), expected)
+        assert slide.chunk_reads == reads
+        assert np.array_equal(slide.low_resolution_image(1)[0], plane[::2, ::2])
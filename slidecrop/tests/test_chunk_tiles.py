@@ -0,0 +1,102 @@
+import numpy as np
+import tifffile
+
+from ..ims.slide import SlideImage
+from ..ims.parallel import ParallelReader
+from ..ome.ometiff import OMETiffGenerator
+from .synthetic import make_ims, sections_image
+
+
+def test_write_tiles_decodes_each_chunk_once(tmp_path):
+    plane = sections_image(640, 704, [(30, 40, 500, 450)])
+    plane[:] += np.arange(704, dtype=np.uint8)[None, :] % 7
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(48, 80))
+
+    with SlideImage(path) as slide:
+        assert slide.chunk_shape(0, 1) == (48, 80)
+
+        ometiff = OMETiffGenerator(
+            slide, 'section.ome.tif', str(tmp_path), [0, 2], 0, 0
+        )
+        ometiff.tile_width = 112
+        ometiff.tile_height = 96
+        region = [30, 40, 500, 450]
+        ometiff.size_x, ometiff.size_y = region[-2], region[-1]
+        ometiff.size_c, ometiff.size_t, ometiff.size_z = 2, 1, 1
+        ometiff.roi = region
+        ometiff.xml = ometiff.make_xml(slide.metadata)
+        ometiff.write_tiles()
+
+    assert ometiff.chunk_reads == ometiff.chunk_count
+    written = tifffile.imread(str(tmp_path / 'section.ome.tif'))
+    expected = plane[40: 490, 30: 530]
+    assert np.array_equal(written[0], expected)
+    assert np.array_equal(written[1], expected)
+
+
+def test_parallel_reader_matches_serial_reads(tmp_path):
+    plane = sections_image(300, 420, [(10, 20, 300, 200)])
+    plane[:] += (np.arange(420, dtype=np.uint8) % 13)[None, :]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(32, 48))
+
+    with SlideImage(path) as slide:
+        with ParallelReader(slide, workers=2, tile_size=(64, 64)) as reader:
+            region = [5, 7, 400, 290]
+            assert np.array_equal(
+                reader.read_region(region, 0, 1), slide.read_region(region, 0, 1)
+            )
+            low = reader.read_multichannel_region(1)
+            assert np.array_equal(low, slide.low_resolution_image(1))
+
+            tiles = [[0, 0, 100, 100], [350, 250, 100, 100]]
+            for tile, pix in zip(tiles, reader.imap_regions(tiles, 0, 2)):
+                assert np.array_equal(pix, slide.read_region(tile, 0, 2))
+
+
+def test_compressed_tiles_round_trip(tmp_path):
+    plane = sections_image(600, 700, [(30, 40, 500, 450)])
+    plane[:] += (np.arange(600, dtype=np.uint8) % 5)[:, None]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(48, 80))
+
+    region = [30, 40, 520, 530]
+    with SlideImage(path) as slide:
+        for compression in ('deflate', 'zstd', 'lzw'):
+            filename = '{}.ome.tif'.format(compression)
+            ometiff = OMETiffGenerator(
+                slide, filename, str(tmp_path), [0, 1], 0, 0,
+                compression=compression, encode_workers=2
+            )
+            ometiff.tile_width = ometiff.tile_height = 112
+            ometiff.size_x, ometiff.size_y = region[-2], region[-1]
+            ometiff.size_c, ometiff.size_t, ometiff.size_z = 2, 1, 1
+            ometiff.roi = region
+            ometiff.xml = ometiff.make_xml(slide.metadata)
+            ometiff.write_tiles()
+            assert ometiff.chunk_reads == ometiff.chunk_count
+
+            with tifffile.TiffFile(str(tmp_path / filename)) as tif:
+                assert tif.pages[0].is_tiled
+                written = tif.asarray()
+            assert np.array_equal(written[1], plane[40:570, 30:550])
+
+
+def test_16_bit_tiles_keep_their_type(tmp_path):
+    plane = sections_image(600, 700, [(30, 40, 500, 450)]).astype(np.uint16)
+    plane *= 250
+    plane[:] += (np.arange(700, dtype=np.uint16) * 37)[None, :]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(48, 80))
+
+    region = [30, 40, 520, 530]
+    with SlideImage(path) as slide:
+        ometiff = OMETiffGenerator(
+            slide, 'section.ome.tif', str(tmp_path), [0, 1], 0, 0
+        )
+        ometiff.tile_width = ometiff.tile_height = 112
+        ometiff.prepare(region)
+        ometiff.write_tiles()
+
+    with tifffile.TiffFile(str(tmp_path / 'section.ome.tif')) as tif:
+        written = tif.asarray()
+        assert 'Type="uint16"' in tif.pages[0].description
+    assert written.dtype == np.uint16
+    assert np.array_equal(written[1], plane[40:570, 30:550])
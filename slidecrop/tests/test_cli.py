@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+import sys
+
+import tifffile
+
+from ..cli import main
+from .synthetic import make_ims, sections_image
+
+
+def test_crop_folder_and_manifest(tmp_path):
+    plane = sections_image(512, 768, [(100, 100, 200, 300), (400, 80, 250, 200)])
+    slides = tmp_path / 'slides'
+    slides.mkdir()
+    for name in ('a', 'b'):
+        make_ims(str(slides / '{}.ims'.format(name)), plane)
+    out = tmp_path / 'out'
+    report_path = str(tmp_path / 'report.json')
+
+    status = main([
+        'crop', str(slides), '-o', str(out), '--threshold', '128',
+        '--workers', '2', '--report', report_path
+    ])
+    assert status == 0
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report['failures'] == 0
+    assert report['regions'] == 4
+    assert report['bytes_written'] > 0 and report['bytes_read'] > 0
+    for record in report['slides']:
+        assert record['status'] == 'done'
+        assert record['crop_seconds'] >= 0
+        for region in record['regions']:
+            written = tifffile.imread(str(out / region['file']))
+            x, y, w, h = region['region']
+            assert written.shape == (3, h, w)
+            assert region['bytes_written'] == os.path.getsize(str(out / region['file']))
+
+    # per slide settings from a manifest, with a missing slide
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({'slides': [
+        {'path': 'slides/a.ims', 'threshold': 128, 'output': 'manifest_out'},
+        {'path': 'slides/b.ims', 'channel': 1, 'method': 'otsu'},
+        'slides/missing.ims'
+    ]}))
+    status = main(['crop', str(manifest), '--report', report_path])
+    assert status == 1
+    with open(report_path) as f:
+        report = json.load(f)
+    records = {os.path.basename(r['path']): r for r in report['slides']}
+    assert records['a.ims']['status'] == 'done'
+    assert len(records['a.ims']['regions']) == 2
+    assert records['b.ims']['channel'] == 1
+    assert records['b.ims']['method'] == 'otsu'
+    assert records['missing.ims']['status'] == 'failed'
+    assert (tmp_path / 'manifest_out' / 'a_section_0.ome.tif').exists()
+
+
+def test_cli_does_not_import_qt():
+    code = 'import sys, slidecrop.cli; print(any("PyQt" in m for m in sys.modules))'
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert out.strip() == b'False'
+
+
+def test_method_names_and_unknown_methods(tmp_path):
+    plane = sections_image(256, 256, [(50, 50, 100, 100)])
+    make_ims(str(tmp_path / 'a.ims'), plane)
+    make_ims(str(tmp_path / 'b.ims'), plane)
+    report_path = str(tmp_path / 'report.json')
+
+    # method names are not case sensitive
+    assert main(['crop', str(tmp_path / 'a.ims'), '--method', 'Otsu',
+                 '--report', report_path]) == 0
+
+    # a slide that cannot be thresholded is a failed record
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps([
+        {'path': 'a.ims', 'threshold': 128},
+        {'path': 'b.ims', 'method': 'unknown'}
+    ]))
+    assert main(['crop', str(manifest), '--report', report_path]) == 1
+    with open(report_path) as f:
+        report = json.load(f)
+    records = {os.path.basename(r['path']): r for r in report['slides']}
+    assert records['a.ims']['status'] == 'done'
+    assert records['b.ims']['status'] == 'failed'
+    assert 'NotImplementedError' in records['b.ims']['error']
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from ..processing.component_tree import ComponentTree
+from ..processing.segmentation import Segment
+
+
+@pytest.mark.parametrize('mode', ['bright', 'fluoro'])
+def test_tree_regions_match_segment(mode):
+    rng = np.random.RandomState(1)
+    plane = gaussian_filter(rng.normal(128, 40, (150, 200)), 3) * 4 - 384
+    plane = np.clip(plane, 0, 255).astype(np.uint8)
+
+    tree = ComponentTree(plane, mode)
+    found = 0
+    for threshold in list(range(0, 256, 5)) + [100.5, 127.25]:
+        segmenter = Segment(
+            mode, (4, 4), channel=0,
+            thresh_method='manual', threshold=threshold
+        )
+        expected = segmenter.run(plane[None])
+        regions = tree.regions(threshold, (4, 4))
+        assert [r.roi for r in regions] == [r.roi for r in expected]
+        assert [r[:] for r in regions] == [r[:] for r in expected]
+        found += len(regions)
+    assert found > 0
+
+
+@pytest.mark.parametrize('mode', ['bright', 'fluoro'])
+def test_tree_uses_segment_filters_on_16_bit_planes(mode):
+    rng = np.random.RandomState(2)
+    plane = gaussian_filter(rng.normal(2000, 600, (120, 160)), 3) * 4 - 6000
+    plane = np.clip(plane, 0, 4095).astype(np.uint16)
+    filters = dict(min_area=200, max_aspect=3, min_extent=0.3)
+
+    tree = ComponentTree(plane, mode, filters)
+    found = 0
+    for threshold in range(0, 4096, 97):
+        segmenter = Segment(
+            mode, (4, 4), channel=0,
+            thresh_method='manual', threshold=threshold, **filters
+        )
+        expected = segmenter.run(plane[None])
+        regions = tree.regions(threshold, (4, 4))
+        assert [r.roi for r in regions] == [r.roi for r in expected]
+        found += len(regions)
+    assert found > 0
@@ -0,0 +1,49 @@
+import numpy as np
+
+from ..gui.compositor import DisplayCompositor
+
+
+def test_views_and_mask():
+    image = np.random.RandomState(0).randint(0, 256, (4, 30, 40)).astype(np.uint8)
+    colors = [[1, 0, 0], [0, 1, 0], [0.2, 0.5, 1], [1, 1, 1]]
+    compositor = DisplayCompositor(image, colors)
+
+    for c, color in enumerate(colors):
+        view = compositor.rgba(c)
+        for i in range(3):
+            expected = np.zeros((30, 40), dtype=np.uint8)
+            expected[:] = image[c] * color[i]
+            assert np.array_equal(view[:, :, i], expected)
+        assert (view[:, :, 3] == 255).all()
+        assert compositor.rgba(c) is view
+
+    view = compositor.rgba('All')
+    assert np.array_equal(np.moveaxis(view[:, :, :3], -1, 0), image[:3])
+
+    mask = compositor.mask(2, 100, 'brightfield')
+    assert np.array_equal(mask[:, :, 3] > 0, image[2] < 100)
+    assert (mask[image[2] < 100] == (255, 255, 0, 255)).all()
+    assert compositor.mask(2, 100, 'brightfield') is mask
+    mask = compositor.mask('All', 100.5, 'fluoro')
+    assert np.array_equal(mask[:, :, 3] > 0, image[0] > 100.5)
+    assert compositor.mask(0, 100, '') is None
+
+
+def test_16_bit_views_are_scaled_and_masked_unscaled():
+    image = np.random.RandomState(1).randint(0, 4096, (2, 30, 40)).astype(np.uint16)
+    colors = [[1, 1, 1], [1, 1, 1]]
+    compositor = DisplayCompositor(image, colors, [[0, 4095], None])
+
+    # the stored range goes to 0..255 rather than being clipped
+    view = compositor.rgba(0)
+    expected = (image[0] * (255.0 / 4095)).astype(np.uint8)
+    assert np.abs(view[:, :, 0].astype(int) - expected).max() <= 1
+    # without a range the channel's own minimum and maximum are used
+    view = compositor.rgba(1)
+    assert view[:, :, 0].min() == 0 and view[:, :, 0].max() == 255
+
+    mask = compositor.mask(0, 3000, 'fluoro')
+    assert np.array_equal(mask[:, :, 3] > 0, image[0] > 3000)
+    mask = compositor.mask('All', 1000.5, 'brightfield')
+    assert np.array_equal(mask[:, :, 3] > 0, image[0] < 1000.5)
+    assert (mask[image[0] < 1000.5] == (255, 0, 0, 255)).all()
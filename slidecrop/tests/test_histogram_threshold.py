@@ -0,0 +1,57 @@
+import h5py
+import numpy as np
+import pytest
+from skimage import filters
+
+from ..ims import lowres
+from ..processing.batch import _scan_slide
+from ..processing.threshold import histogram_threshold
+from ..processing.segmentation import auto_threshold
+from .synthetic import make_ims
+
+
+def _planes():
+    rng = np.random.RandomState(0)
+    # bright field - mostly bright background with darker tissue
+    bright = rng.normal(225, 8, (300, 400))
+    bright[50:200, 80:300] = rng.normal(90, 30, (150, 220))
+    # fluorescence - dark background with a few bright objects
+    fluoro = rng.gamma(2.0, 6.0, (300, 400))
+    fluoro[120:160, 40:90] += rng.normal(150, 20, (40, 50))
+    uniform = rng.randint(10, 200, (200, 200))
+    two_level = np.where(rng.rand(128, 128) > 0.3, 200, 30)
+    for plane in (bright, fluoro, uniform, two_level):
+        yield np.clip(plane, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize('method', ['isodata', 'mean', 'otsu', 'triangle', 'yen'])
+def test_histogram_thresholds_match_skimage(method):
+    skimage_fn = getattr(filters, 'threshold_' + method)
+    for plane in _planes():
+        hist = np.bincount(plane.ravel(), minlength=256)
+        expected = skimage_fn(plane)
+        assert histogram_threshold(hist, method) == pytest.approx(expected)
+        assert auto_threshold(plane, method) == pytest.approx(expected)
+
+
+def test_constant_histogram():
+    hist = np.zeros(256)
+    hist[17] = 100
+    for method in ('isodata', 'mean', 'otsu', 'triangle', 'yen'):
+        assert histogram_threshold(hist, method) == 17
+
+
+def test_stored_histogram_range_scales_thresholds(tmp_path):
+    rng = np.random.RandomState(1)
+    plane = np.clip(rng.normal(200, 20, (256, 256)), 0, 255).astype(np.uint8)
+    plane[60:180, 40:200] = np.clip(rng.normal(70, 20, (120, 160)), 0, 255)
+    path = make_ims(str(tmp_path / 'slide.ims'), plane)
+    _, _, _, eight_bit, _, _ = _scan_slide(0, path, 'otsu')
+
+    # as if the 256 bins covered a 10 bit range
+    with h5py.File(path, 'r+') as f:
+        for group in f['/DataSet/ResolutionLevel 2/TimePoint 0'].values():
+            group.attrs['HistogramMax'] = np.array([c.encode() for c in '1020'], dtype='|S1')
+    lowres.clear()
+    _, _, _, ten_bit, _, _ = _scan_slide(0, path, 'otsu')
+    assert ten_bit == [4 * t for t in eight_bit]
@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import pytest
+
+from ..ims import lowres
+from ..ims.slide import SlideImage
+from .synthetic import make_ims, sections_image
+
+
+@pytest.fixture
+def slide_path(tmp_path):
+    lowres.clear()
+    plane = sections_image(512, 768, [(100, 100, 200, 300)])
+    return make_ims(str(tmp_path / 'slide.ims'), plane)
+
+
+def test_low_resolution_image_is_read_once(slide_path):
+    with SlideImage(slide_path) as slide:
+        first = lowres.low_resolution_image(slide)
+        reads = slide.chunk_reads
+        assert not first.flags.writeable
+        np.testing.assert_array_equal(first, slide.low_resolution_image())
+
+    # a new handle on the same slide is served from the cache
+    with SlideImage(slide_path) as slide:
+        assert lowres.low_resolution_image(slide) is first
+        assert lowres.histograms(slide)[1] is lowres.histogram(slide, c=1)
+        assert slide.chunk_reads == 0
+    assert reads > 0
+
+
+def test_rewritten_slide_is_read_again(slide_path):
+    with SlideImage(slide_path) as slide:
+        first = lowres.low_resolution_image(slide)
+    stat = os.stat(slide_path)
+    os.utime(slide_path, (stat.st_atime, stat.st_mtime + 10))
+    with SlideImage(slide_path) as slide:
+        assert lowres.low_resolution_image(slide) is not first
+
+
+def test_budget(slide_path):
+    try:
+        lowres.set_budget(0)
+        with SlideImage(slide_path) as slide:
+            lowres.low_resolution_image(slide)
+            assert lowres.stats()['items'] == 0
+    finally:
+        lowres.set_budget(512 * 2**20)
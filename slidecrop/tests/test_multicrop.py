@@ -0,0 +1,88 @@
+import threading
+
+import numpy as np
+import tifffile
+
+from ..ims.slide import SlideImage
+from ..processing.multicrop import MultiCrop
+from .synthetic import make_ims
+
+
+def test_overlapping_regions_decode_union_once(tmp_path):
+    plane = np.random.RandomState(0).randint(0, 255, (600, 700)).astype(np.uint8)
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(64, 64))
+    regions = [[10, 20, 300, 250], [200, 100, 330, 400], [600, 560, 120, 60]]
+    filenames = ['section_{}.ome.tif'.format(i) for i in range(3)]
+
+    finished = []
+    with SlideImage(path) as slide:
+        crop = MultiCrop(slide, str(tmp_path), [0, 2])
+        crop.run(regions, filenames, progress=finished.append)
+
+        union = set()
+        for x, y, w, h in regions:
+            union.update(slide.chunks_in_region([x, y, w, h], 0))
+    assert sorted(finished) == [0, 1, 2]
+    assert crop.chunk_reads == 2 * len(union)
+
+    for (x, y, w, h), filename in zip(regions, filenames):
+        written = tifffile.imread(str(tmp_path / filename))
+        expected = np.zeros((h, w), dtype=np.uint8)
+        src = plane[y: y + h, x: x + w]
+        expected[:src.shape[0], :src.shape[1]] = src
+        assert written.shape == (2, h, w)
+        assert np.array_equal(written[1], expected)
+
+
+class CountingCrop(MultiCrop):
+    """
+    Keeps the largest number of writers seen at once
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = 0
+        self.most_writing = 0
+        self.lock = threading.Lock()
+
+    def _write(self, *args):
+        with self.lock:
+            self.writing += 1
+            self.most_writing = max(self.most_writing, self.writing)
+        try:
+            super()._write(*args)
+        finally:
+            with self.lock:
+                self.writing -= 1
+
+
+def test_writers_are_bounded(tmp_path):
+    plane = np.random.RandomState(1).randint(0, 255, (400, 500)).astype(np.uint8)
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(64, 64))
+    regions = [[20 + 90 * i, 10 + 70 * i, 60, 50] for i in range(5)]
+    filenames = ['section_{}.ome.tif'.format(i) for i in range(5)]
+
+    finished = []
+    with SlideImage(path) as slide:
+        crop = CountingCrop(slide, str(tmp_path), [1])
+        crop.max_writers = 2
+        crop.run(regions, filenames, progress=finished.append)
+    assert crop.most_writing <= 2
+    assert sorted(finished) == [0, 1, 2, 3, 4]
+    for (x, y, w, h), filename in zip(regions, filenames):
+        written = tifffile.imread(str(tmp_path / filename))
+        assert np.array_equal(written, plane[y: y + h, x: x + w])
+
+
+def test_16_bit_sections_are_not_wrapped(tmp_path):
+    plane = np.random.RandomState(2).randint(0, 65535, (300, 400)).astype(np.uint16)
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(64, 64))
+    regions = [[10, 20, 200, 150], [150, 100, 230, 180]]
+    filenames = ['section_{}.ome.tif'.format(i) for i in range(2)]
+
+    with SlideImage(path) as slide:
+        MultiCrop(slide, str(tmp_path), [1]).run(regions, filenames)
+
+    for (x, y, w, h), filename in zip(regions, filenames):
+        written = tifffile.imread(str(tmp_path / filename))
+        assert written.dtype == np.uint16
+        assert np.array_equal(written, plane[y: y + h, x: x + w])
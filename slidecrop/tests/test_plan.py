@@ -0,0 +1,85 @@
+import json
+import os
+
+import numpy as np
+import tifffile
+
+from ..cli import main
+from ..ims.slide import SlideImage
+from ..processing.plan import CropPlan, plan_slide
+from .synthetic import make_ims, sections_image
+
+
+def test_plan_round_trip_and_run(tmp_path):
+    plane = sections_image(512, 768, [(100, 100, 200, 300), (400, 80, 250, 200)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane)
+    out = str(tmp_path / 'out')
+
+    plan = CropPlan()
+    with SlideImage(path) as slide:
+        plan.add(plan_slide(slide, out, crop_channels=[0, 2], threshold=128))
+    plan_path = plan.save(str(tmp_path / 'plan.json'))
+    assert not os.path.exists(out)
+
+    loaded = CropPlan.load(plan_path)
+    assert loaded.to_dict() == json.loads(json.dumps(plan.to_dict()))
+    entry = loaded.slides[0]
+    assert len(entry['regions']) == 2
+    for region in entry['regions']:
+        x, y, w, h = region['region']
+        assert region['bytes'] == w * h * 2
+    assert loaded.nbytes == sum(r['bytes'] for r in entry['regions'])
+
+    records = loaded.run()
+    assert records[0]['status'] == 'done'
+    for region in records[0]['regions']:
+        x, y, w, h = region['region']
+        written = tifffile.imread(os.path.join(out, region['file']))
+        assert written.shape == (2, h, w)
+        assert np.array_equal(written[0], plane[y: y + h, x: x + w])
+        assert region['bytes_written'] == os.path.getsize(os.path.join(out, region['file']))
+
+
+def test_changed_slide_is_not_run(tmp_path):
+    plane = sections_image(256, 256, [(50, 50, 100, 100)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane)
+    with SlideImage(path) as slide:
+        plan = CropPlan([plan_slide(slide, str(tmp_path), threshold=128)])
+    os.utime(path, (0, 0))
+
+    records = plan.run()
+    assert records[0]['status'] == 'failed'
+    assert 'changed' in records[0]['error']
+    assert not os.path.exists(str(tmp_path / 'slide_section_0.ome.tif'))
+
+
+def test_plan_and_run_commands(tmp_path):
+    plane = sections_image(512, 768, [(100, 100, 200, 300), (400, 80, 250, 200)])
+    slides = tmp_path / 'slides'
+    slides.mkdir()
+    make_ims(str(slides / 'a.ims'), plane)
+    plan_path = str(tmp_path / 'plan.json')
+    out = tmp_path / 'out'
+
+    assert main([
+        'plan', str(slides), '-o', str(out), '--threshold', '128',
+        '--plan', plan_path
+    ]) == 0
+    assert not out.exists()
+
+    assert main(['run', plan_path, '--workers', '2']) == 0
+    with open(str(tmp_path / 'plan_report.json')) as f:
+        report = json.load(f)
+    assert report['failures'] == 0
+    assert report['regions'] == 2
+    assert report['bytes_planned'] == CropPlan.load(plan_path).nbytes > 0
+    assert (out / 'a_section_1.ome.tif').exists()
+
+    # the auto threshold method is kept in the plan
+    assert main([
+        'plan', str(slides), '-o', str(out), '--method', 'yen',
+        '--plan', plan_path
+    ]) == 0
+    entry = CropPlan.load(plan_path).slides[0]
+    assert entry['method'] == 'yen'
+    assert entry['threshold'] is not None
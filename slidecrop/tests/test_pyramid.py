@@ -0,0 +1,32 @@
+import numpy as np
+import tifffile
+
+from ..ims.slide import SlideImage
+from ..ome.ometiff import OMETiffGenerator
+from .synthetic import make_ims, sections_image
+
+
+def test_pyramid_levels_come_from_slide_levels(tmp_path):
+    plane = sections_image(1024, 1280, [(128, 256, 800, 600)])
+    plane[:] += (np.arange(1280) % 17).astype(np.uint8)[None, :]
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, levels=4)
+
+    with SlideImage(path) as slide:
+        ometiff = OMETiffGenerator(
+            slide, 'section.ome.tif', str(tmp_path), [0, 1], 0, 0,
+            pyramid=True
+        )
+        ometiff.tile_width = ometiff.tile_height = 128
+        ometiff.pyramid_min_size = 200
+        ometiff.run([128, 256, 800, 600])
+        low = slide.read_region([32, 64, 200, 150], 2, 1)
+
+    with tifffile.TiffFile(str(tmp_path / 'section.ome.tif')) as tif:
+        levels = tif.series[0].levels
+        assert 'OME' in tif.pages[0].description
+        full = levels[0].asarray()
+        assert len(levels) == 3
+        assert full.shape == (2, 600, 800)
+        assert np.array_equal(full[0], plane[256:856, 128:928])
+        assert levels[2].shape == (2, 150, 200)
+        assert np.array_equal(levels[2].asarray()[1], low)
@@ -0,0 +1,54 @@
+import numpy as np
+import tifffile
+
+from ..ims.slide import SlideImage
+from ..processing.crop import CropSlide
+from ..processing.refine import RefineRegions
+from ..processing.segmentation import Segment
+from .synthetic import make_ims, sections_image
+
+# edges that do not fall on low resolution pixels
+SECTIONS = [(101, 77, 397, 611), (701, 203, 503, 498), (1300, 900, 333, 250)]
+
+
+def _slide(tmp_path):
+    plane = sections_image(1400, 1800, SECTIONS)
+    noise = np.random.RandomState(0).randint(-10, 10, plane.shape)
+    plane = np.clip(plane.astype(int) + noise, 0, 255).astype(np.uint8)
+    return make_ims(str(tmp_path / 'slide.ims'), plane, levels=5)
+
+
+def test_refined_boxes_are_exact(tmp_path):
+    with SlideImage(_slide(tmp_path)) as slide:
+        segmenter = Segment(
+            slide.microscope_mode, slide.scale_factor, channel=0,
+            thresh_method='manual', threshold=128
+        )
+        regions = segmenter.run(slide.low_resolution_image())
+        assert [r[:] for r in regions] != [list(s) for s in SECTIONS]
+
+        refiner = RefineRegions(slide, channel=0, threshold=128)
+        refined = refiner.run(regions)
+        assert [r[:] for r in refined] == [list(s) for s in SECTIONS]
+        # the low resolution boxes are left for display
+        assert [r.roi for r in refined] == [r.roi for r in regions]
+
+        finer = sum(
+            np.prod(slide.level_dimensions(level))
+            for level in range(slide.segmentation_level)
+        )
+        assert refiner.pixels_read < 0.1 * finer
+
+
+def test_crop_slide_refine(tmp_path):
+    path = _slide(tmp_path)
+    CropSlide(
+        SlideImage(path), str(tmp_path), threshold_method='manual',
+        threshold=128, crop_level=0, refine=True
+    )
+    for rid, (x, y, w, h) in enumerate(sorted(SECTIONS)):
+        section = tifffile.imread(
+            str(tmp_path / 'slide_section_{}.ome.tif'.format(rid))
+        )
+        assert section.shape[-2:] == (h, w)
+        assert section.max() < 128
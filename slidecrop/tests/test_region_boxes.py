@@ -0,0 +1,28 @@
+import numpy as np
+from skimage.measure import label
+
+from ..processing.segmentation import region_boxes
+from .synthetic import debris_image, regionprops_boxes
+
+
+def test_region_boxes_match_regionprops():
+    label_image = label(debris_image(512, 2000))
+    for min_area in (1, 20, 100):
+        boxes = region_boxes(label_image, min_area=min_area)
+        assert boxes.tolist() == regionprops_boxes(label_image, min_area)
+
+
+def test_shape_filters():
+    label_image = np.zeros((100, 100), dtype=np.int32)
+    label_image[5:15, 5:65] = 1     # 60 x 10 bar
+    label_image[30:60, 30:60] = 2   # 30 x 30 square
+    label_image[70:90, 70:90] = 3   # 20 x 20 box, half filled
+    label_image[70:90, 70:80] = 0
+    label_image[70:90, 70:80][np.eye(20, 10, dtype=bool)] = 3
+
+    assert len(region_boxes(label_image, min_area=1)) == 3
+    assert region_boxes(label_image, max_area=700).tolist() == [[5, 5, 60, 10], [70, 70, 20, 20]]
+    assert region_boxes(label_image, max_aspect=2).tolist() == [[30, 30, 30, 30], [70, 70, 20, 20]]
+    assert region_boxes(label_image, min_side=25).tolist() == [[30, 30, 30, 30]]
+    assert region_boxes(label_image, min_extent=0.9).tolist() == [[5, 5, 60, 10], [30, 30, 30, 30]]
+    assert region_boxes(np.zeros((10, 10), dtype=np.int32)).shape == (0, 4)
@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from ..cli import main
+from ..processing.plan import CropPlan
+from ..processing.shard import merge_manifests, shard_costs, shard_plan
+from .synthetic import make_ims, sections_image
+
+
+def _plan(sizes):
+    slides = []
+    for sid, areas in enumerate(sizes):
+        regions = [
+            {'id': rid, 'region': [0, 0, w, h], 'bytes': w * h * 2,
+             'file': 's{}_section_{}.ome.tif'.format(sid, rid)}
+            for rid, (w, h) in enumerate(areas)
+        ]
+        slides.append({
+            'path': 's{}.ims'.format(sid), 'output': 'out', 'channels': [0, 1],
+            'regions': regions, 'bytes': sum(r['bytes'] for r in regions)
+        })
+    return CropPlan(slides)
+
+
+def test_shards_balance_cost_not_files():
+    # one large slide and several small ones - by file count the
+    # first shard would hold nearly all of the work
+    plan = _plan([
+        [(1000, 1000), (900, 1000), (800, 1000)],
+        [(300, 300)], [(300, 300)], [(300, 300)], [(200, 200)]
+    ])
+    shards, costs = shard_costs(plan, 3)
+    assert sorted(sum(shards, [])) == sorted(
+        (sid, rid) for sid, e in enumerate(plan.slides) for rid in range(len(e['regions']))
+    )
+    assert max(costs) <= 2 * 1000 * 1000 * 1.2
+    assert shard_costs(plan, 3) == (shards, costs)
+
+    parts = [shard_plan(plan, i, 3)[0] for i in range(3)]
+    files = sorted(r['file'] for part in parts for e in part for r in e['regions'])
+    assert files == sorted(r['file'] for e in plan for r in e['regions'])
+    with pytest.raises(ValueError):
+        shard_plan(plan, 3, 3)
+
+
+def test_merge_needs_every_shard():
+    manifests = [
+        {'plan': 'p', 'plan_digest': 'x', 'shard': i, 'shards': 3}
+        for i in (0, 2)
+    ]
+    with pytest.raises(ValueError):
+        merge_manifests(manifests)
+
+
+def test_sharded_run_and_merge(tmp_path):
+    slides = tmp_path / 'slides'
+    slides.mkdir()
+    make_ims(str(slides / 'a.ims'), sections_image(
+        512, 768, [(100, 100, 200, 300), (400, 80, 250, 200), (100, 420, 60, 60)]
+    ))
+    make_ims(str(slides / 'b.ims'), sections_image(256, 256, [(50, 50, 100, 100)]))
+    plan_path = str(tmp_path / 'plan.json')
+    out = tmp_path / 'out'
+    assert main([
+        'plan', str(slides), '-o', str(out), '--threshold', '128',
+        '--plan', plan_path
+    ]) == 0
+
+    manifests = []
+    for index in range(2):
+        assert main(['run', plan_path, '--shard', '{}/2'.format(index)]) == 0
+        manifests.append(str(tmp_path / 'plan_shard_{}_of_2_report.json'.format(index)))
+
+    merged_path = str(tmp_path / 'merged.json')
+    assert main(['merge'] + manifests + ['--report', merged_path]) == 0
+    with open(merged_path) as f:
+        merged = json.load(f)
+    assert merged['shards'] == 2
+    assert merged['failures'] == 0
+    assert merged['regions'] == 4
+    assert merged['bytes_planned'] == CropPlan.load(plan_path).nbytes
+    records = {os.path.basename(r['path']): r for r in merged['slides']}
+    assert [r['id'] for r in records['a.ims']['regions']] == [0, 1, 2]
+    assert len(os.listdir(str(out))) == 4
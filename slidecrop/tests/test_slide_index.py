@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from ..ims.slide import SlideImage
+from ..ims.index import index_path
+from .synthetic import make_ims, sections_image
+
+
+def test_reopened_slide_loads_from_index(tmp_path):
+    plane = sections_image(256, 320, [(20, 30, 100, 120)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane)
+    index_dir = str(tmp_path / 'index')
+
+    with SlideImage(path, use_index=False) as slide:
+        expected = (
+            slide.slide_dimensions, slide.channel_names, slide.channel_colors,
+            slide.metadata, slide.microscope_mode, slide.get_histogram(c=1)
+        )
+
+    SlideImage(path, index_dir=index_dir).close()
+    assert (tmp_path / 'index').exists()
+    assert index_path(path, index_dir).startswith(index_dir)
+
+    slide = SlideImage(path, index_dir=index_dir)
+    indexed = (
+        slide.slide_dimensions, slide.channel_names, slide.channel_colors,
+        slide.metadata, slide.microscope_mode, slide.get_histogram(c=1)
+    )
+    # nothing above needed the HDF5 file
+    assert slide._h5 is None
+    assert indexed[:5] == expected[:5]
+    assert np.array_equal(indexed[5], expected[5])
+    assert slide.low_resolution_image().shape == (3, 64, 80)
+    slide.close()
+
+
+def test_index_dir_from_environment(tmp_path, index_dir):
+    path = make_ims(str(tmp_path / 'slide.ims'), sections_image(64, 64, []))
+    SlideImage(path).close()
+    assert index_path(path).startswith(index_dir)
+    assert (tmp_path / 'index').exists()
+
+
+def test_closed_slide_is_not_reopened(tmp_path):
+    path = make_ims(str(tmp_path / 'slide.ims'), sections_image(64, 64, []))
+    slide = SlideImage(path, use_index=False)
+    slide.close()
+    with pytest.raises(ValueError):
+        slide.low_resolution_image()
+    slide.open()
+    assert slide.low_resolution_image().shape[0] == 3
+    slide.close()
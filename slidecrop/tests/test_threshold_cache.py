@@ -0,0 +1,61 @@
+import os
+
+from ..ims.slide import SlideImage
+from ..processing.batch import scan_slides
+from ..processing.threshold_cache import (
+    ThresholdCache, set_threshold_cache, threshold_cache
+)
+from .synthetic import make_ims, sections_image
+
+
+def _slides(tmp_path, n=2):
+    plane = sections_image(256, 384, [(50, 50, 100, 150)])
+    return [
+        make_ims(str(tmp_path / 'slide_{}.ims'.format(i)), plane)
+        for i in range(n)
+    ]
+
+
+def test_memo_persists_and_evicts(tmp_path):
+    path = _slides(tmp_path, 1)[0]
+    cache_path = str(tmp_path / 'thresholds.json')
+    cache = ThresholdCache(cache_path, max_items=3)
+    cache.put_channels(path, 2, 'Otsu', [10, 20, 30])
+    assert cache.get_channels(path, 2, 'otsu', 3) == [10, 20, 30]
+    assert cache.get_channels(path, 1, 'otsu', 3) is None
+    cache.put(path, 2, 0, 'yen', 5)
+    assert len(cache) == 3
+    assert cache.get(path, 2, 1, 'otsu') == 20
+    assert cache.get(path, 2, 0, 'otsu') is None
+    cache.save()
+
+    loaded = ThresholdCache(cache_path)
+    assert loaded.get(path, 2, 0, 'yen') == 5
+
+    # a rewritten slide is thresholded again
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert loaded.get(path, 2, 0, 'yen') is None
+
+
+def test_scan_slides_uses_memo(tmp_path):
+    paths = _slides(tmp_path)
+    previous = threshold_cache()
+    try:
+        set_threshold_cache(ThresholdCache())
+        channels, thresholds = scan_slides(paths, 'otsu', workers=2)
+        cache = threshold_cache()
+        with SlideImage(paths[0]) as slide:
+            level = slide.segmentation_level
+        assert cache.get_channels(paths[0], level, 'otsu', 3) == thresholds[0]
+
+        # memoised thresholds are returned without thresholding
+        cache.put_channels(paths[1], level, 'otsu', [1, 2, 3])
+        done = []
+        _, again = scan_slides(
+            paths, 'otsu', workers=2, result=lambda *args: done.append(args)
+        )
+        assert again == [thresholds[0], [1, 2, 3]]
+        assert sorted(sid for sid, _, _ in done) == [0, 1]
+    finally:
+        set_threshold_cache(previous)
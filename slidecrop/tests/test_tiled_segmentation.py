@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from ..ims.slide import SlideImage
+from ..processing.segmentation import Segment
+from ..processing.tiled_segmentation import TiledSegment
+from .synthetic import make_ims
+
+
+@pytest.mark.parametrize('mode', ['MetaCyte TL', 'MetaCyte FL'])
+def test_tiled_segmentation_matches_whole_level(tmp_path, mode):
+    rng = np.random.RandomState(3)
+    plane = gaussian_filter(rng.normal(128, 40, (500, 600)), 5) * 6 - 640
+    plane = np.clip(plane, 0, 255).astype(np.uint8)
+    if 'TL' in mode:
+        plane = 255 - plane
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, chunks=(48, 80), mode=mode)
+
+    with SlideImage(path) as slide:
+        whole = slide.read_multichannel_region(0)
+        found = 0
+        for threshold in (90, 128, 165):
+            tiled = TiledSegment(
+                slide, 0, channel=1, threshold=threshold,
+                tile_size=(100, 100), min_area=30
+            )
+            segmenter = Segment(
+                slide.microscope_mode, tiled.scale_factor, channel=1,
+                thresh_method='manual', threshold=threshold, min_area=30
+            )
+            expected = [r.roi for r in segmenter.run(whole)]
+            assert [r.roi for r in tiled.run()] == expected
+            found += len(expected)
+        assert found > 0
@@ -0,0 +1,35 @@
+import numpy as np
+
+from ..gui.tiles import choose_level, level_ratios, render_tile, visible_tiles
+from ..ims.slide import SlideImage
+from .synthetic import make_ims, sections_image
+
+
+def test_level_for_zoom(tmp_path):
+    plane = sections_image(1024, 1536, [(100, 100, 400, 600)])
+    path = make_ims(str(tmp_path / 'slide.ims'), plane, levels=4)
+    with SlideImage(path) as slide:
+        ratios = level_ratios(slide)
+    assert ratios[-1] == (1.0, 1.0)
+    assert choose_level(ratios, 0.5) == 3
+    assert choose_level(ratios, 1.5) == 2
+    assert choose_level(ratios, 3) == 1
+    assert choose_level(ratios, 100) == 0
+
+
+def test_visible_tiles_centre_first():
+    tiles = visible_tiles([10, 10, 50, 30], (1000, 700), (8, 8), tile_size=128)
+    # 80-400 x 80-240 in the level
+    assert len(tiles) == 4 * 2
+    assert tiles[0] == [128, 128, 128, 128]
+    edge = visible_tiles([100, 70, 200, 100], (1000, 700), (8, 8), tile_size=128)
+    assert [896, 640, 104, 60] in edge
+    assert all(x + w <= 1000 and y + h <= 700 for x, y, w, h in edge)
+
+
+def test_render_tile():
+    pixels = np.full((3, 4, 5), 200, dtype=np.uint8)
+    rgba = render_tile(pixels[:1], 1, [[1, 0, 0], [0, 0.5, 1], [1, 1, 1]])
+    assert rgba.shape == (4, 5, 4)
+    assert rgba[0, 0].tolist() == [0, 100, 200, 255]
+    assert render_tile(pixels, 'All', [])[0, 0].tolist() == [200, 200, 200, 255]